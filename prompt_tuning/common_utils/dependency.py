@@ -3,7 +3,7 @@ import sys
 import json
 import platform
 import subprocess
-from .utils import get_parser
+from .utils import parse
 import warnings
 from dotenv import load_dotenv
 
@@ -19,11 +19,6 @@ warnings.warn(
     stacklevel=2
 )
 
-def parse(code, language):
-    parser = get_parser(language)
-    tree = parser.parse(bytes(code, "utf8"))
-    return tree
-
 def get_all_identifiers(tree):
     """
     Get all named identifiers from the AST tree with their positions and types.
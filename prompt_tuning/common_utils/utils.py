@@ -1,9 +1,9 @@
 import os
 import re
+import sys
 import json
 import torch
 import difflib
-import platform
 import warnings
 import subprocess
 import numpy as np
@@ -13,14 +13,18 @@ from .construct_input import formalize_input
 from dotenv import load_dotenv
 from jsonschema import validate
 from collections import defaultdict
-from tree_sitter import Language, Parser
 from transformers import RobertaTokenizer, RobertaModel
 
 CURR_FILE_DIR=os.path.dirname(os.path.abspath(__file__))
 ENV_DIR=os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
 ENV_PATH = os.path.join(ENV_DIR, ".config")
 load_dotenv(ENV_PATH)
+# Imported once the prompt tuning config is loaded, which takes precedence over the simulation config read by libs
+sys.path.append(os.path.normpath(os.path.join(CURR_FILE_DIR, "../../src")))
+from libs import git_mirror # shared with the simulation
+from libs.syntax import parse # shared with the simulation
 REPOS_PATH=os.getenv("REPOS_PATH")
+MIRRORS_DIR = os.getenv("MIRRORS_DIR") or os.path.join(REPOS_PATH or "", ".mirrors") # bare mirrors shared by all local clones
 
 def format_commit_data(commit_data):
     bullet_points = []
@@ -198,10 +202,8 @@ def rate_edit_hunk_pair(edit_hunk1: dict, edit_hunk2: dict, print_info=False):
 
 def find_code_structure(code, line_index, language):
     # Initialize Tree-sitter parser and set language
-    parser = get_parser(language)
-
     # Parse code to generate syntax tree
-    tree = parser.parse(bytes(code, "utf8"))
+    tree = parse(code, language)
     root_node = tree.root_node
 
     # Define node types for different languages
@@ -589,37 +591,6 @@ def find_code_structure(code, line_index, language):
     structure_path = traverse(root_node)
     return structure_path
 
-def get_parser(language):
-    assert language in ["python", "go", "java", "javascript", "typescript"], "Currently only python, go, java, javascript and typescript are supported"
-    system = platform.system().lower()
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    tree_sitter_dir = os.path.normpath(os.path.join(base_dir, "../lib/tree-sitter"))
-    if system == "darwin":
-        build_file_path = os.path.join(tree_sitter_dir, "macos_build/my-languages.so")
-    elif system == "linux":
-        build_file_path = os.path.join(tree_sitter_dir, "linux_build/my-languages.so")
-    elif system == "windows":
-        build_file_path = os.path.join(tree_sitter_dir, "windows_build/my-languages.dll")
-    try:
-        LANGUAGES = Language(build_file_path, language)
-    except:
-        # build so
-        Language.build_library(
-            build_file_path,
-            [
-                os.path.join(tree_sitter_dir, "tree-sitter-python"),
-                os.path.join(tree_sitter_dir, "tree-sitter-go"),
-                os.path.join(tree_sitter_dir, "tree-sitter-java"),
-                os.path.join(tree_sitter_dir, "tree-sitter-javascript"),
-                os.path.join(tree_sitter_dir, "tree-sitter-typescript")
-            ]
-        )
-        LANGUAGES = Language(build_file_path, language)
-    
-    parser = Parser()
-    parser.set_language(LANGUAGES)
-    return parser
-
 def find_control_flow(code, line_index, language):
 
     def get_statement(node, source_bytes):
@@ -666,10 +637,8 @@ def find_control_flow(code, line_index, language):
         return []
 
     assert language == "python", "Currently only python is supported"
-    parser = get_parser(language)
-
     # Parse the code
-    tree = parser.parse(bytes(code, "utf8"))
+    tree = parse(code, language)
     root_node = tree.root_node
 
     structure_path = traverse(root_node, bytes(code, "utf8"), line_index)
@@ -706,19 +675,19 @@ def check_language(file_path: str):
     else:
         return None
     
-def clone_repo(user_name: str, project_name: str, target_dir: str):
+def clone_repo(user_name: str, project_name: str, target_dir: str, commit_sha: str = None):
     """
-    Clone the repository to local
-    
+    Clone the repository to local, borrowing its objects from the bare mirror under MIRRORS_DIR, see src/libs/git_mirror.py.
+
     Args:
         user_name: str, the user name of the repository
         project_name: str, the name of the repository
         target_dir: str, the target directory to clone the repository
+        commit_sha: str | None, the commit that must exist in the clone
     Returns:
         None
     """
-    command = f"git clone https://github.com/{user_name}/{project_name}.git {target_dir}/{project_name}"
-    subprocess.run(command, shell=True)
+    git_mirror.clone_repo(user_name, project_name, target_dir, MIRRORS_DIR, commit_sha)
 
 def convert_diff_section_to_snapshot(file_w_diff: str):
     diff_content = file_w_diff.splitlines(keepends=True)
@@ -803,10 +772,9 @@ def extract_hunks(commit_url: str):
     user_name = commit_url.split("/")[-4]
     repo_path = os.path.join(REPOS_PATH, project_name)
 
-    # if not exist, clone to local
+    # if not exist or the commit is missing, clone or fetch to local
     os.makedirs(REPOS_PATH, exist_ok=True)
-    if not os.path.exists(repo_path):
-        clone_repo(user_name, project_name, REPOS_PATH)
+    clone_repo(user_name, project_name, REPOS_PATH, commit_sha)
     
     command = f"git -C {repo_path} show {commit_sha} --pretty=%B --no-patch"
     try:
@@ -931,9 +899,8 @@ def pick_identifiers(code: str, language: str):
     Returns:
         identifiers: list[str], the identifiers in the code
     """
-    parser = get_parser(language)
     # 解析代码生成语法树
-    tree = parser.parse(bytes(code, "utf8"))
+    tree = parse(code, language)
     root_node = tree.root_node
     
     # 定义不同语言的标识符节点类型
@@ -1225,10 +1192,9 @@ def tokenize_by_tree_sitter(code: str, language: str) -> list:
     Returns:
         List[str]: A sequence of tokens extracted from the syntax tree, in order.
     """
-    parser = get_parser(language)
     code_bytes = code.encode('utf-8')
 
-    tree = parser.parse(code_bytes)
+    tree = parse(code, language)
     root_node = tree.root_node
     tokens = []
 
@@ -1,5 +1,6 @@
 import os
 import subprocess
+from typing import Optional
 from .language_server import LanguageServer
 
 class GoLanguageServer(LanguageServer):
@@ -13,7 +14,7 @@ class GoLanguageServer(LanguageServer):
 
         super().__init__(language_id, server_command, log)
     
-    def initialize(self, workspace_folders: list[str] | str, wait_time: float = 0.5):
+    def initialize(self, workspace_folders: list[str] | str, wait_time: Optional[float] = None):
         if isinstance(workspace_folders, str):
             workspace_folders = [workspace_folders]
         
@@ -31,7 +32,7 @@ class GoLanguageServer(LanguageServer):
                 "capabilities": self._get_capabilities()
             }
         )
-        self._get_messages(request_id=request_id, message_num=1, wait_time=wait_time)
+        self._wait_for_initialize(request_id, wait_time)
         self._send_notification("initialized")
         
     def _parse_rename_response(self, response, edits, old_name, new_name):
@@ -1,7 +1,7 @@
 import os
 import json
 
-from typing import Dict
+from typing import Dict, Optional
 from .language_server import LanguageServer
 
 class TsLanguageServer(LanguageServer):
@@ -9,9 +9,19 @@ class TsLanguageServer(LanguageServer):
         server_command = ["typescript-language-server", "--stdio"]
         super().__init__(language_id, server_command, log)
     
-    def initialize(self, workspace_folders: list[str] | str, wait_time: float = 0.5):
+    def initialize(self, workspace_folders: list[str] | str, wait_time: Optional[float] = 0.5):
         # NOTE: TsLanguageServer initialization does not response any message
         return super().initialize(workspace_folders, wait_time)
+
+    def _wait_for_initialize(self, request_id: int, wait_time: Optional[float]):
+        """
+        Tolerate a missing initialize response, the server is used once wait_time has passed,
+        unlike other servers which are killed. Keep it until typescript-language-server is shown to respond.
+        """
+        try:
+            self._get_messages(request_id=request_id, message_num=1, wait_time=wait_time)
+        except TimeoutError:
+            pass
     
     def _get_capabilities(self) -> Dict:
         """
@@ -39,6 +49,9 @@ class TsLanguageServer(LanguageServer):
             },
             "diagnostics": {
                 "dynamicRegistration": True
+            },
+            "workspace": {
+                "workspaceFolders": True
             }
         }
 
@@ -46,6 +59,7 @@ class TsLanguageServer(LanguageServer):
         """
         Override the default diagnostics method, typescript-language-server send response for each opened file.
         """
+        self.drain_notifications()
         if self.workspace_file_version.get(file_path, 0) == 0:
             self.did_open(file_path)
         else:
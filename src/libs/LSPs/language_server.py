@@ -1,46 +1,18 @@
 import os
-import re
 import json
 import time
+import queue
 import threading
-import functools
 import subprocess
+import concurrent.futures
+from collections import deque
 from abc import ABC, abstractmethod
 from typing import List, Dict, Optional
 
-def timeout_decorator(timeout, timeout_return=None):
-    """
-    Decorator to add a timeout to any function.
-    Returns `timeout_return` when the function exceeds the timeout.
-    """
-    def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            result_container = {}
-            exception_container = {}
-
-            def target():
-                try:
-                    result_container['result'] = func(*args, **kwargs)
-                except Exception as e:
-                    exception_container['exception'] = e
-
-            thread = threading.Thread(target=target)
-            thread.daemon = True  # Set the thread as a daemon thread
-            thread.start()
-            thread.join(timeout)
-
-            if thread.is_alive():
-                raise TimeoutError(f"Function '{func.__name__}' exceeded timeout of {timeout} seconds.")
-
-            if 'exception' in exception_container:
-                raise exception_container['exception']
-
-            return result_container.get('result')
-        return wrapper
-    return decorator
-
 class LanguageServer(ABC):
+    # Seconds to wait for the response of a request before raising TimeoutError
+    response_timeout: float = 5
+
     def __init__(self, language_id: str, server_command: List[str], log: bool = False):
         """
         Initialize the language server process.
@@ -51,19 +23,33 @@ class LanguageServer(ABC):
                 server_command,
                 stdin=subprocess.PIPE,
                 stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                bufsize=0
+                stderr=subprocess.PIPE
             )
         except Exception as e:
             print(f"Failed to start language server process: {e}")
             raise
         self.request_id: int = 1
         self.log: bool = log
-        self.messages: List[Dict] = []
         self.workspace_file_version: Dict[str, int] = {}
+        # Responses are delivered to the future of their request, notifications are queued until drained
+        self.pending_responses: Dict[int, concurrent.futures.Future] = {}
+        self.pending_lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.notifications: queue.Queue = queue.Queue()
+        self.reader = threading.Thread(target=self._read_loop, daemon=True)
+        self.reader.start()
+        # Drain stderr, a long-lived server would otherwise block once the pipe is full; the last lines are kept
+        self.stderr_tail = deque(maxlen=100)
+        self.stderr_reader = threading.Thread(target=self._read_stderr, daemon=True)
+        self.stderr_reader.start()
 
-    def initialize(self, workspace_folders: list[str] | str, wait_time: float = 0.5):
+    def initialize(self, workspace_folders: list[str] | str, wait_time: Optional[float] = None):
+        """
+        Initialize the server, waiting wait_time seconds (default response_timeout) for its response.
+        
+        Raises:
+            TimeoutError: If the server does not respond in time, the server is then killed.
+        """
         if isinstance(workspace_folders, str):
             workspace_folders = [workspace_folders]
         request_id = self._send_request(
@@ -79,8 +65,17 @@ class LanguageServer(ABC):
                 "capabilities": self._get_capabilities()
             }
         )
-        self._get_messages(request_id=request_id, message_num=1, wait_time=wait_time)
+        self._wait_for_initialize(request_id, wait_time)
         self._send_notification("initialized")
+    
+    def _wait_for_initialize(self, request_id: int, wait_time: Optional[float]):
+        try:
+            self._get_messages(request_id=request_id, message_num=1, wait_time=wait_time)
+        except TimeoutError:
+            # A server that is not ready must not be used, its reader thread exits with the process
+            self.process.kill()
+            self.process.wait()
+            raise TimeoutError(f"Language server {self.language_id} did not respond to initialize.")
 
     def _get_capabilities(self) -> Dict:
         """
@@ -101,12 +96,21 @@ class LanguageServer(ABC):
             },
             "diagnostics": {
                 "dynamicRegistration": True
+            },
+            "workspace": {
+                "workspaceFolders": True
             }
         }
 
-    def did_open(self, file_path):
-        with open(file_path, 'r') as f:
-            file_content = f.read()
+    def did_open(self, file_path, text: Optional[str] = None):
+        """
+        Open the file with the given text, by default its content on disk.
+        """
+        if text is None:
+            with open(file_path, 'r') as f:
+                file_content = f.read()
+        else:
+            file_content = text
 
         self._send_notification(
             "textDocument/didOpen",
@@ -121,10 +125,16 @@ class LanguageServer(ABC):
         )
         self.workspace_file_version[file_path] = 1
     
-    def did_change(self, file_path: str):
-        # 读取整个文件内容
-        with open(file_path, 'r') as f:
-            content = f.read()
+    def did_change(self, file_path: str, text: Optional[str] = None):
+        """
+        Replace the content of the opened file with the given text, by default its content on disk.
+        """
+        if text is None:
+            # 读取整个文件内容
+            with open(file_path, 'r') as f:
+                content = f.read()
+        else:
+            content = text
         
         file_version = self.workspace_file_version.get(file_path, 0)
         self._send_notification(
@@ -143,6 +153,58 @@ class LanguageServer(ABC):
         )
         self.workspace_file_version[file_path] = file_version + 1
     
+    def did_close(self, file_path: str):
+        self._send_notification(
+            "textDocument/didClose",
+            params={
+                "textDocument": {
+                    "uri": f"file://{file_path}"
+                }
+            }
+        )
+        self.workspace_file_version.pop(file_path, None)
+    
+    def close_all_files(self):
+        """
+        Close every opened file, so that the server reads them from disk again.
+        """
+        for file_path in list(self.workspace_file_version):
+            self.did_close(file_path)
+    
+    def change_workspace_folders(self, added: List[str], removed: List[str]):
+        """
+        Replace workspace folders without restarting the server.
+        """
+        self._send_notification(
+            "workspace/didChangeWorkspaceFolders",
+            params={
+                "event": {
+                    "added": [{"uri": f"file://{folder}", "name": os.path.basename(folder)} for folder in added],
+                    "removed": [{"uri": f"file://{folder}", "name": os.path.basename(folder)} for folder in removed]
+                }
+            }
+        )
+    
+    def is_alive(self) -> bool:
+        """
+        Whether the server process is running and its messages are still read.
+        """
+        return self.process.poll() is None and self.reader.is_alive()
+    
+    def is_responsive(self, timeout: float = 2) -> bool:
+        """
+        Whether the server answers a request within timeout seconds. The request has an unknown method,
+        which the server must answer at once with a MethodNotFound error, whatever it is busy with.
+        """
+        if not self.is_alive():
+            return False
+        request_id = self._send_request("simulation/healthCheck")
+        try:
+            self.get_responses([request_id], timeout=timeout)
+        except TimeoutError:
+            return False
+        return True
+    
     def open_in_batch(self, file_paths: List[str]):
         for file_path in file_paths:
             try:
@@ -150,11 +212,18 @@ class LanguageServer(ABC):
             except Exception as e:
                 continue
             
-    def rename(self, file_path: str, position: dict[str, int], new_name: str, wait_time: float = 0.5):
+    def sync_file(self, file_path: str, text: Optional[str] = None):
+        """
+        Open the file in the server, or send its current content if it is already open.
+        The content is the given text, by default the content on disk.
+        """
         if self.workspace_file_version.get(file_path, 0) == 0:
-            self.did_open(file_path)
+            self.did_open(file_path, text)
         else:
-            self.did_change(file_path)
+            self.did_change(file_path, text)
+            
+    def rename(self, file_path: str, position: dict[str, int], new_name: str, wait_time: Optional[float] = None):
+        self.sync_file(file_path)
         
         request_id = self._send_request(
             "textDocument/rename",
@@ -169,13 +238,18 @@ class LanguageServer(ABC):
         messages = self._get_messages(request_id=request_id, message_num=1, wait_time=wait_time)
         return messages
     
-    def references(self, file_path, position, wait_time: float = 0.5, include_declaration: bool = True):
-        if self.workspace_file_version.get(file_path, 0) == 0:
-            self.did_open(file_path)
-        else:
-            self.did_change(file_path)
-        
-        request_id = self._send_request(
+    def references(self, file_path, position, wait_time: Optional[float] = None, include_declaration: bool = True):
+        self.sync_file(file_path)
+        request_id = self.send_references(file_path, position, include_declaration)
+        messages = self._get_messages(request_id=request_id, message_num=1, wait_time=wait_time)
+        return messages
+    
+    def send_references(self, file_path, position, include_declaration: bool = True) -> int:
+        """
+        Send a references request without waiting for its response, the file must be synced by the caller.
+        Wait for the response with get_responses().
+        """
+        return self._send_request(
             "textDocument/references",
             params={
                 "textDocument": {
@@ -187,16 +261,19 @@ class LanguageServer(ABC):
                 }
             }
         )
+    
+    def definitions(self, file_path, position, wait_time: Optional[float] = None):
+        self.sync_file(file_path)
+        request_id = self.send_definitions(file_path, position)
         messages = self._get_messages(request_id=request_id, message_num=1, wait_time=wait_time)
         return messages
     
-    def definitions(self, file_path, position, wait_time: float = 0.5):
-        if self.workspace_file_version.get(file_path, 0) == 0:
-            self.did_open(file_path)
-        else:
-            self.did_change(file_path)
-            
-        request_id = self._send_request(
+    def send_definitions(self, file_path, position) -> int:
+        """
+        Send a definition request without waiting for its response, the file must be synced by the caller.
+        Wait for the response with get_responses().
+        """
+        return self._send_request(
             "textDocument/definition",
             params={
                 "textDocument": {
@@ -205,24 +282,53 @@ class LanguageServer(ABC):
                 "position": position
             }
         )
-        messages = self._get_messages(request_id=request_id, message_num=1, wait_time=wait_time)
-        return messages
+    
+    def get_responses(self, request_ids: List[int], timeout: Optional[float] = None) -> List[List[Dict]]:
+        """
+        Wait together for the responses of requests in flight.
+        
+        Args:
+            request_ids (List[int]): The ids of the requests, as returned by the send_* methods.
+            timeout (Optional[float]): Seconds to wait for all responses, default response_timeout.
+            
+        Returns:
+            List[List[Dict]]: For each request, [response], or [] if the server exited before responding.
+            
+        Raises:
+            TimeoutError: If some response has not arrived in time.
+        """
+        timeout = self.response_timeout if timeout is None else timeout
+        with self.pending_lock:
+            futures = [self.pending_responses[request_id] for request_id in request_ids]
+        _, not_done = concurrent.futures.wait(futures, timeout=timeout)
+        with self.pending_lock:
+            for request_id in request_ids:
+                self.pending_responses.pop(request_id, None)
+        if not_done:
+            raise TimeoutError(f"{len(not_done)} of {len(request_ids)} requests got no response within {timeout} seconds.")
+        return [[] if future.result() is None else [future.result()] for future in futures]
     
     def diagnostics(self, file_path, wait_time: float = 0.5):
-        if self.workspace_file_version.get(file_path, 0) == 0:
-            self.did_open(file_path)
-        else:
-            self.did_change(file_path)
+        self.drain_notifications()
+        self.sync_file(file_path)
         
         messages = self._get_messages(expect_method="textDocument/publishDiagnostics", message_num=1, wait_time=wait_time)
         return messages
 
     def close(self):
         request_id = self._send_request("shutdown")
-        self._get_messages(request_id=request_id, message_num=1, wait_time=0.5)
+        try:
+            self._get_messages(request_id=request_id, message_num=1, wait_time=0.5)
+        except TimeoutError:
+            pass
         self._send_notification("exit")
         self.process.terminate()
-        self.process.wait()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.reader.join(timeout=1)
         print("[MESSAGE:SIM] Server closed")
 
     def get_all_file_paths(self, workspace_path: str) -> List[str]:
@@ -232,131 +338,124 @@ class LanguageServer(ABC):
                 file_paths.append(os.path.join(root, file))
         return file_paths
 
-    def _read_by_brace_matching(self, timeout: float = 0.1) -> Optional[str]:
+    def _read_message(self) -> Optional[Dict]:
         """
-        Read a complete JSON message by matching the braces.
+        Read one JSON-RPC message, framed by its headers and exactly `Content-Length` bytes of content.
         
-        Args:
-            timeout: Timeout for select (seconds)
-            
         Returns:
-            Optional[str]: Return a complete JSON message string, or None if timeout
+            Optional[Dict]: The parsed message, or None if the server closed its stdout
         """
-        buffer = ""
-        brace_count = 0
-        inside_str = False
-        escaped = False  # 处理转义字符
-        
+        content_length = None
         while True:
-            char = self.process.stdout.read(1)
-            
-            if buffer == "":
-                assert char == "{"
-                
-            buffer += char
-            
-            if escaped:
-                escaped = False
-                continue
-                
-            if char == '\\':
-                escaped = True
-            elif char == '"':
-                inside_str = not inside_str
-            elif not inside_str:
-                if char == '{':
-                    brace_count += 1
-                elif char == '}':
-                    brace_count -= 1
-                    
-            if brace_count == 0:
-                return buffer
+            line = self.process.stdout.readline()
+            if not line: # Exit if no more output is available
+                return None
+            line = line.strip()
+            if not line:
+                if content_length is None: # Blank line before any header
+                    continue
+                break # Blank line after the headers
+            name, _, value = line.partition(b":")
+            if name.strip().lower() == b"content-length":
+                content_length = int(value)
+        
+        content = self.process.stdout.read(content_length)
+        if len(content) < content_length:
+            return None
+        try:
+            return json.loads(content)
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            raise Exception(f"JSON Parse Error: {e}, Original Message: {content!r}")
         
-    @timeout_decorator(timeout=5, timeout_return=None)
-    def _read_lsp_messages(self, request_id: Optional[int] = None, expect_method: Optional[str] = None, message_num: Optional[int] = None, wait_time: Optional[float] = None):
+    def _read_loop(self):
         """
-        Continuously read and parse JSON-RPC messages from the server's stdout.
-        Messages are stored in the self.messages list.
-        By specifying the `request_id` or `expect_method`, the function will stop when the message is received.
-        If both parameters are set, the function will stop when either condition is met.
+        Read the server's stdout in the background, for the lifetime of the server.
+        A response resolves the future of its request, any other message is queued as a notification.
         """
-        buffer = ""
-        start_time = time.time()
         while True:
-            line = self.process.stdout.readline()
-            if not line:  # Exit if no more output is available
-                break
-            buffer += line
-            match = re.search(r"Content-Length: (\d+)", buffer)
-            if match:
-                self.process.stdout.readline()  # Skip the blank line
-                message = self._read_by_brace_matching()
-                try:
-                    json_message = json.loads(message.strip())
-                    if self._is_desired_message(json_message, request_id, expect_method):
-                        return None
-                except json.JSONDecodeError as e:
-                    raise Exception(f"JSON Parse Error: {e}, Original Message: {message}")
-                buffer = ""  # Reset buffer after processing a message
+            json_message = self._read_message()
+            if json_message is None: # The server exited, requests in flight will get no response
+                with self.pending_lock:
+                    for future in self.pending_responses.values():
+                        if not future.done():
+                            future.set_result(None)
+                return
+            if self.log:
+                print(f"[RECEIVED] {json.dumps(json_message, indent=2, ensure_ascii=False)}")
             
-            if wait_time is not None and (time.time() - start_time) >= wait_time:
-                return None
-            if message_num is not None and len(self.messages) >= message_num:
-                return None 
-    
-    def _is_desired_message(self, json_message: Dict, request_id: Optional[int] = None, expect_method: Optional[str] = None) -> bool:
-        if request_id is not None: # if request_id is specified, only add the message if it has the same request_id
-            if "id" in json_message: # if the response is a request response
-                if json_message["id"] == request_id:
-                    self.messages.append(json_message)
-                    if self.log:
-                        print(f"[RECEIVED] {json.dumps(json_message, indent=2, ensure_ascii=False)}")
-                    return True
-                else:
-                    return False
-        elif expect_method is not None: # if expect_method is specified, only add the message if it has the same method
-            if "method" in json_message and json_message["method"] == expect_method:
-                self.messages.append(json_message)
-                if self.log:
-                    print(f"[RECEIVED] {json.dumps(json_message, indent=2, ensure_ascii=False)}")
-                return True
+            if "id" in json_message and "method" not in json_message:
+                with self.pending_lock:
+                    future = self.pending_responses.get(json_message["id"])
+                if future is not None and not future.done():
+                    future.set_result(json_message)
             else:
-                return False
-        else: # if request_id is not specified, add all messages
-            self.messages.append(json_message)
-            return True
-        
+                self.notifications.put(json_message)
+    
+    def _read_stderr(self):
+        for line in self.process.stderr:
+            self.stderr_tail.append(line)
+    
+    def drain_notifications(self, method: Optional[str] = None) -> List[Dict]:
+        """
+        Remove the queued notifications and return them, e.g. to skip the stale diagnostics before waiting for new ones.
+
+        Args:
+            method (Optional[str]): Only return the notifications of this method, the others are dropped as well.
+
+        Returns:
+            List[Dict]: The queued notifications, in the order they were received.
+        """
+        messages = []
+        while True:
+            try:
+                json_message = self.notifications.get_nowait()
+            except queue.Empty:
+                return messages
+            if method is None or json_message.get("method") == method:
+                messages.append(json_message)
+    
     def _get_messages(self, request_id: Optional[int] = None, expect_method: Optional[str] = None, message_num: Optional[int] = None, wait_time: Optional[float] = None) -> List[Dict]:
         """
         Retrieve messages from the server based on specified conditions:
-        - request_id: Stop when a specific request ID is received.
-        - expect_method: Stop when a specific method is received.
-        - message_num: Stop when a specific number of messages are received.
-        - wait_time: Stop after the specified amount of time (in seconds).
-        If both parameters are set, the function will stop when either condition is met.
+        - request_id: Wait for the response of the request, up to wait_time, raise TimeoutError if it does not arrive.
+        - expect_method: Keep the notifications of this method, otherwise keep all notifications.
+        - message_num: Stop when a specific number of notifications are kept.
+        - wait_time: Stop waiting for notifications after the specified amount of time (in seconds).
 
         Args:
-            request_id (Optional[int]): Request ID of the message to retrieve.
-            expect_method (Optional[str]): Method of the message to retrieve.
-            message_num (Optional[int]): Number of messages to retrieve.
-            wait_time (Optional[float]): Time in seconds allowed to wait for messages.
+            request_id (Optional[int]): Request ID of the response to retrieve.
+            expect_method (Optional[str]): Method of the notifications to retrieve.
+            message_num (Optional[int]): Number of notifications to retrieve.
+            wait_time (Optional[float]): Time in seconds allowed to wait for the response or notifications, default response_timeout.
 
         Returns:
             List[Dict]: A list of received JSON-RPC messages.
         """
-        self._read_lsp_messages(request_id=request_id, expect_method=expect_method, message_num=message_num, 
-        wait_time=wait_time)  # Read all current messages
-        messages, self.messages = self.messages, []  # Return and clear message list
+        if request_id is not None:
+            return self.get_responses([request_id], timeout=wait_time)[0]
+        
+        messages = []
+        deadline = time.time() + (wait_time if wait_time is not None else self.response_timeout)
+        while message_num is None or len(messages) < message_num:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                json_message = self.notifications.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if expect_method is None or json_message.get("method") == expect_method:
+                messages.append(json_message)
         return messages
     
     def _send_to_process(self, message: str):
-        if self.process.poll() is not None:
-            stderr_output = self.process.stderr.read()
+        # Content-Length counts the bytes of the utf-8 encoded content, not its characters
+        content = message.encode("utf-8")
         if os.name == "nt": # Windows
             # TODO: Just a speculation, not verified.
-            self.process.stdin.write(f"Content-Length: {len(message)}\n\n{message}")
+            self.process.stdin.write(f"Content-Length: {len(content)}\n\n".encode("ascii") + content)
         elif os.name == "posix": # Linux, macOS
-            self.process.stdin.write(f"Content-Length: {len(message)}\r\n\r\n{message}")
+            self.process.stdin.write(f"Content-Length: {len(content)}\r\n\r\n".encode("ascii") + content)
         self.process.stdin.flush()
         
     def _create_message(self, method: str, params: dict = None, is_request: bool = True) -> str:
@@ -373,15 +472,20 @@ class LanguageServer(ABC):
         return message_data
 
     def _send_notification(self, method: str, params: dict = None):
-        notification = self._create_message(method, params, is_request=False)
-        notification = json.dumps(notification)
-        self._send_to_process(notification)
+        with self.send_lock:
+            notification = self._create_message(method, params, is_request=False)
+            notification = json.dumps(notification)
+            self._send_to_process(notification)
 
     def _send_request(self, method: str, params: dict = None):
-        request = self._create_message(method, params, is_request=True)
-        request_id = request["id"]
-        request_json = json.dumps(request)
-        self._send_to_process(request_json)
+        with self.send_lock:
+            request = self._create_message(method, params, is_request=True)
+            request_id = request["id"]
+            # Register the future before sending, the response may arrive before _send_to_process returns
+            with self.pending_lock:
+                self.pending_responses[request_id] = concurrent.futures.Future()
+            request_json = json.dumps(request)
+            self._send_to_process(request_json)
         return request_id
     
     @abstractmethod
@@ -0,0 +1,129 @@
+"""
+Bare mirrors of GitHub repositories shared by the local clones of the simulation and the prompt tuning.
+Only the mirror talks to GitHub, local clones borrow its objects (git alternates).
+"""
+import os
+import contextlib
+import subprocess
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+@contextlib.contextmanager
+def _path_lock(path: str):
+    # Inter-process lock held on a lock file next to path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.lock", "w") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def mirror_lock(mirror_path: str):
+    """
+    Hold an inter-process lock on the mirror, so that concurrent simulations
+    never clone or fetch into the same mirror at the same time.
+    """
+    return _path_lock(mirror_path)
+
+def repo_lock(repo_path: str):
+    """
+    Hold an inter-process lock on a local clone, so that concurrent simulations never clone or fetch into it,
+    nor add, prune or remove its worktrees at the same time. Taken before the mirror lock, never after.
+    """
+    return _path_lock(os.path.abspath(repo_path))
+
+def has_commit(repo_path: str, commit_sha: str) -> bool:
+    result = subprocess.run(["git", "-C", repo_path, "cat-file", "-e", f"{commit_sha}^{{commit}}"], capture_output=True)
+    return result.returncode == 0
+
+def disable_mirror_gc(mirror_path: str):
+    """
+    Local clones borrow their objects from the mirror (git alternates), an object pruned from the mirror breaks them,
+    e.g. a commit left unreachable by a force push upstream. Mirrors are hence never garbage collected nor pruned.
+    """
+    subprocess.run(["git", "-C", mirror_path, "config", "gc.auto", "0"], capture_output=True, text=True)
+    subprocess.run(["git", "-C", mirror_path, "config", "gc.pruneExpire", "never"], capture_output=True, text=True)
+
+def ensure_mirror(user_name: str, project_name: str, mirrors_dir: str, commit_sha: str = None) -> str:
+    """
+    Make sure the bare mirror of the repository exists under mirrors_dir and contains the given commit.
+    The mirror is only fetched when the commit is missing. It must never be garbage collected, see disable_mirror_gc().
+
+    Args:
+        user_name: str, the user name of the repository
+        project_name: str, the name of the repository
+        mirrors_dir: str, the directory keeping the bare mirror of each repository
+        commit_sha: str | None, the commit that must exist in the mirror
+    Returns:
+        mirror_path: str, the path of the bare mirror
+    """
+    mirror_path = os.path.join(mirrors_dir, user_name, f"{project_name}.git")
+    with mirror_lock(mirror_path):
+        if not os.path.exists(mirror_path):
+            print(f"[MESSAGE:SIM] Creating mirror of {user_name}/{project_name}...")
+            result = subprocess.run(
+                ["git", "clone", "--mirror", f"https://github.com/{user_name}/{project_name}.git", mirror_path],
+                capture_output=True,
+                text=True
+            )
+            if result.returncode != 0:
+                raise RuntimeError(f"Git clone --mirror failed:\n{result.stderr}")
+            disable_mirror_gc(mirror_path)
+        if commit_sha is not None and not has_commit(mirror_path, commit_sha):
+            print(f"[MESSAGE:SIM] Commit {commit_sha} not found in mirror of {user_name}/{project_name}, fetching...")
+            disable_mirror_gc(mirror_path)
+            # No --prune, it would delete the refs/simulation refs keeping fetched commits reachable
+            result = subprocess.run(["git", "-C", mirror_path, "fetch", "origin"], capture_output=True, text=True)
+            errors = result.stderr if result.returncode != 0 else ""
+            if not has_commit(mirror_path, commit_sha):
+                # The commit is not reachable from any branch, fetch it directly and keep it reachable under refs/simulation
+                result = subprocess.run(
+                    ["git", "-C", mirror_path, "fetch", "origin", f"{commit_sha}:refs/simulation/{commit_sha}"],
+                    capture_output=True,
+                    text=True
+                )
+                errors += result.stderr if result.returncode != 0 else ""
+            if not has_commit(mirror_path, commit_sha):
+                raise RuntimeError(f"Commit {commit_sha} not found in {user_name}/{project_name} after fetching:\n{errors}")
+    return mirror_path
+
+def clone_repo(user_name: str, project_name: str, target_dir: str, mirrors_dir: str, commit_sha: str = None):
+    """
+    Clone the repository to local. The clone borrows its objects from the shared bare mirror
+    of the repository (git alternates), hence costs almost no disk and no network.
+    
+    Args:
+        user_name: str, the user name of the repository
+        project_name: str, the name of the repository
+        target_dir: str, the target directory to clone the repository
+        mirrors_dir: str, the directory keeping the bare mirror of each repository
+        commit_sha: str | None, the commit that must exist in the clone
+    Returns:
+        None
+    """
+    repo_path = os.path.join(target_dir, project_name)
+    if os.path.exists(repo_path) and (commit_sha is None or has_commit(repo_path, commit_sha)):
+        return
+
+    with repo_lock(repo_path):
+        # Another process may have cloned or fetched while waiting for the lock
+        if os.path.exists(repo_path) and (commit_sha is None or has_commit(repo_path, commit_sha)):
+            return
+        mirror_path = ensure_mirror(user_name, project_name, mirrors_dir, commit_sha)
+        if os.path.exists(repo_path):
+            # A clone made before the mirror existed, take the missing objects from the mirror, whatever ref holds the commit
+            result = subprocess.run(["git", "-C", repo_path, "fetch", mirror_path, "+refs/*:refs/mirror/*"], capture_output=True, text=True)
+            if not has_commit(repo_path, commit_sha):
+                raise RuntimeError(f"Commit {commit_sha} not found in {repo_path} after fetching from {mirror_path}:\n{result.stderr}")
+            return
+
+        result = subprocess.run(["git", "clone", "--shared", mirror_path, repo_path], capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"Git clone failed:\n{result.stderr}")
+        subprocess.run(["git", "-C", repo_path, "remote", "set-url", "origin", f"https://github.com/{user_name}/{project_name}.git"], capture_output=True, text=True)
@@ -13,6 +13,7 @@ GITHUB_TOKENS = os.getenv("GITHUB_TOKENS").split(',')
 CURR_TOKEN_IDX = 0
 GITHUB_TOKENS_RST_TIME = [time.time()-3600 for _ in range(len(GITHUB_TOKENS))]
 REPOS_PATH = os.getenv("REPOS_DIR")
+MIRRORS_PATH = os.getenv("MIRRORS_DIR") or os.path.join(REPOS_PATH, ".mirrors")
 ROOT_PATH = current_path
 
 if __name__ == '__main__':
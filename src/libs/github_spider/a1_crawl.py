@@ -129,12 +129,36 @@ def get_repos(lang, repo_num):
         raise Exception("No repos found")
     return repos
 
+def git_mirror(user_name, proj_name):
+    # Create or update the bare mirror shared by every local clone of this repo
+    # The mirror is never pruned nor garbage collected, the clones borrow its objects (git alternates)
+    from a0 import MIRRORS_PATH, GITHUB_TOKENS, CURR_TOKEN_IDX
+
+    mirror_path = os.path.join(MIRRORS_PATH, user_name, f"{proj_name}.git")
+    if os.path.exists(mirror_path):
+        try:
+            subprocess.run(["git", "fetch", "origin"], check=True, cwd=mirror_path)
+        except subprocess.CalledProcessError:
+            raise Exception(f"==> Fetching mirror of {user_name}/{proj_name} failed")
+    else:
+        os.makedirs(os.path.dirname(mirror_path), exist_ok=True)
+        clone_url = f"https://{GITHUB_TOKENS[CURR_TOKEN_IDX]}@github.com/{user_name}/{proj_name}.git"
+        try:
+            subprocess.run(["git", "clone", "--mirror", clone_url, mirror_path], check=True)
+        except subprocess.CalledProcessError:
+            raise Exception(f"==> Mirroring {user_name}/{proj_name} from {clone_url} failed")
+        subprocess.run(["git", "config", "gc.auto", "0"], check=True, cwd=mirror_path)
+        subprocess.run(["git", "config", "gc.pruneExpire", "never"], check=True, cwd=mirror_path)
+    return mirror_path
+
 def git_clone(user_name, proj_name):
     # Check if this repo has been downloaded
     from a0 import REPOS_PATH, GITHUB_TOKENS, CURR_TOKEN_IDX
     
     if not os.path.exists(REPOS_PATH):
         os.mkdir(REPOS_PATH)
+    # Only the mirror talks to GitHub, the clone borrows its objects (git alternates)
+    mirror_path = git_mirror(user_name, proj_name)
     if os.path.exists(os.path.join(REPOS_PATH, proj_name)):
         result = subprocess.run(
             "git remote show origin | grep 'HEAD branch'",
@@ -153,14 +177,15 @@ def git_clone(user_name, proj_name):
             subprocess.run(reset_command, check=True, cwd=os.path.join(REPOS_PATH, proj_name))
         except:
             raise Exception(f"==> Pulling {user_name}/{proj_name} failed")
-    else: # if not, download the whole repo of the latest version
+    else: # if not, check out the latest version from the mirror
         clone_url = f"https://{GITHUB_TOKENS[CURR_TOKEN_IDX]}@github.com/{user_name}/{proj_name}.git"
         try:
-            git_clone_command = ["git", "clone", clone_url]
+            git_clone_command = ["git", "clone", "--shared", mirror_path, proj_name]
             # Run the Git clone command
             subprocess.run(git_clone_command, check=True, cwd=REPOS_PATH)
+            subprocess.run(["git", "remote", "set-url", "origin", clone_url], check=True, cwd=os.path.join(REPOS_PATH, proj_name))
         except:
-            raise Exception(f"==> Downloading {user_name}/{proj_name} from {clone_url} failed")
+            raise Exception(f"==> Cloning {user_name}/{proj_name} from {mirror_path} failed")
     
 def crawl(lang, repo_num):
     from a0 import ROOT_PATH
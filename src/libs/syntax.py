@@ -0,0 +1,136 @@
+"""
+Tree-sitter parsing shared by the simulation, the optimization and the prompt tuning:
+languages loaded once per process, one parser per language per thread and a cache of parsed trees.
+"""
+import os
+import bisect
+import hashlib
+import threading
+import platform
+
+from dotenv import load_dotenv
+from collections import OrderedDict
+from tree_sitter import Language, Parser
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+root_path = os.path.abspath(os.path.join(current_path, "../../"))
+load_dotenv(dotenv_path=os.path.join(root_path, ".config"))
+TREE_CACHE_SIZE = int(os.getenv("TREE_CACHE_SIZE") or 256) # number of parsed syntax trees kept in memory
+_LANGUAGES = {}
+_LANGUAGES_LOCK = threading.Lock()
+_PARSERS = threading.local()
+_TREES = OrderedDict()
+_TREES_LOCK = threading.Lock()
+
+def get_language(language):
+    """
+    Return the tree-sitter Language, loaded once per process.
+    The shared library is built at most once, the build is published with a rename
+    so that concurrent processes never load a half written library.
+    """
+    with _LANGUAGES_LOCK:
+        if language in _LANGUAGES:
+            return _LANGUAGES[language]
+        system = platform.system().lower()
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        tree_sitter_dir = os.path.join(base_dir, "tree-sitter")
+        if system == "darwin":
+            build_file_path = os.path.join(tree_sitter_dir, "macos_build/my-languages.so")
+        elif system == "linux":
+            build_file_path = os.path.join(tree_sitter_dir, "linux_build/my-languages.so")
+        elif system == "windows":
+            build_file_path = os.path.join(tree_sitter_dir, "windows_build/my-languages.dll")
+        try:
+            _LANGUAGES[language] = Language(build_file_path, language)
+        except:
+            # build so
+            tmp_build_file_path = f"{build_file_path}.{os.getpid()}.tmp"
+            Language.build_library(
+                tmp_build_file_path,
+                [
+                    os.path.join(tree_sitter_dir, "tree-sitter-python"),
+                    os.path.join(tree_sitter_dir, "tree-sitter-go"),
+                    os.path.join(tree_sitter_dir, "tree-sitter-java"),
+                    os.path.join(tree_sitter_dir, "tree-sitter-javascript"),
+                    os.path.join(tree_sitter_dir, "tree-sitter-typescript")
+                ]
+            )
+            os.replace(tmp_build_file_path, build_file_path)
+            _LANGUAGES[language] = Language(build_file_path, language)
+        return _LANGUAGES[language]
+
+def get_parser(language):
+    assert language in ["python", "go", "java", "javascript", "typescript"], "Currently only python, go, java, javascript and typescript are supported"
+    # Parser is not thread-safe, keep one parser per language per thread
+    parser = getattr(_PARSERS, language, None)
+    if parser is None:
+        parser = Parser()
+        parser.set_language(get_language(language))
+        setattr(_PARSERS, language, parser)
+    return parser
+
+def parse(code, language):
+    """
+    Parse code into a tree-sitter tree. Trees are cached by (language, content hash),
+    so that the same file content is parsed only once. The returned tree must not be edited.
+    """
+    code_bytes = bytes(code, "utf8")
+    key = (language, hashlib.sha1(code_bytes).hexdigest())
+    with _TREES_LOCK:
+        tree = _TREES.get(key)
+        if tree is not None:
+            _TREES.move_to_end(key)
+            return tree
+    tree = get_parser(language).parse(code_bytes)
+    with _TREES_LOCK:
+        _TREES[key] = tree
+        while len(_TREES) > TREE_CACHE_SIZE:
+            _TREES.popitem(last=False)
+    return tree
+
+class SyntaxIndex:
+    """
+    Line index over the syntax tree of one file, shared by all hunks of the file.
+    The children of a node and their end lines are collected once, on first visit,
+    so that the children containing a line are found by bisection instead of a scan.
+    """
+    def __init__(self, tree):
+        self.root_node = tree.root_node
+        self._children = {} # path of child indexes from the root -> (children, end lines of children)
+
+    def containing_children(self, node, path, line_index):
+        if path not in self._children:
+            children = node.children
+            self._children[path] = (children, [child.end_point[0] for child in children])
+        children, end_lines = self._children[path]
+        # Siblings do not overlap, so both start and end lines are sorted
+        i = bisect.bisect_left(end_lines, line_index)
+        while i < len(children) and children[i].start_point[0] <= line_index:
+            yield path + (i,), children[i]
+            i += 1
+
+    def resolve(self, line_index, visit):
+        """
+        Collect visit(node) of the nodes containing the line, from the outermost to the innermost.
+        The children containing the line are visited in order until one of them has collected an entry,
+        once an entry is collected, only the first child containing the line is followed.
+
+        Args:
+            line_index: int, the line to resolve
+            visit: callable, returns the entry of a node, or None if the node is not part of the path
+        Returns:
+            path: list, the collected entries
+        """
+        path = []
+        def traverse(node, node_path):
+            entry = visit(node)
+            if entry is not None:
+                path.append(entry)
+            for child_path, child in self.containing_children(node, node_path, line_index):
+                traverse(child, child_path)
+                if path:
+                    return
+
+        if self.root_node.start_point[0] <= line_index <= self.root_node.end_point[0]:
+            traverse(self.root_node, ())
+        return path
@@ -3,10 +3,9 @@ import math
 import time
 import json
 import requests
-import platform
 
 from dotenv import load_dotenv
-from tree_sitter import Language, Parser
+from libs.syntax import parse, SyntaxIndex
 
 current_path = os.path.abspath(os.path.dirname(__file__))
 root_path = os.path.abspath(os.path.join(current_path, "../../"))
@@ -246,44 +245,10 @@ def check_language(file_path: str): # Also used in simulation/utils.py
     else:
         return None
 
-def get_parser(language): # Also used in simulation/utils.py
-    assert language in ["python"], "Currently only Python is supported"
-    system = platform.system().lower()
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    tree_sitter_dir = os.path.normpath(os.path.join(base_dir, "../libs/tree-sitter"))
-    if system == "darwin":
-        build_file_path = os.path.join(tree_sitter_dir, "macos_build/my-languages.so")
-    elif system == "linux":
-        build_file_path = os.path.join(tree_sitter_dir, "linux_build/my-languages.so")
-    elif system == "windows":
-        build_file_path = os.path.join(tree_sitter_dir, "windows_build/my-languages.dll")
-    try:
-        LANGUAGES = Language(build_file_path, language)
-    except:
-        # build so
-        Language.build_library(
-            build_file_path,
-            [
-                os.path.join(tree_sitter_dir, "tree-sitter-python"),
-                os.path.join(tree_sitter_dir, "tree-sitter-go"),
-                os.path.join(tree_sitter_dir, "tree-sitter-java"),
-                os.path.join(tree_sitter_dir, "tree-sitter-javascript"),
-                os.path.join(tree_sitter_dir, "tree-sitter-typescript")
-            ]
-        )
-        LANGUAGES = Language(build_file_path, language)
-    
-    parser = Parser()
-    parser.set_language(LANGUAGES)
-    return parser
-
-def find_code_structure(code, line_index, language): # Also used in simulation/utils.py
-    # Initialize Tree-sitter parser and set language
-    parser = get_parser(language)
-
-    # Parse code to generate syntax tree
-    tree = parser.parse(bytes(code, "utf8"))
-    root_node = tree.root_node
+def find_code_structure(code, line_index, language, index=None): # Also used in simulation/utils.py
+    # Parse code to generate syntax tree, unless the line index of this file is given
+    if index is None:
+        index = SyntaxIndex(parse(code, language))
 
     # Define node types for different languages
     def get_declaration_text_py(node):
@@ -600,72 +565,55 @@ def find_code_structure(code, line_index, language): # Also used in simulation/u
         for child in node.children:
             print_node_structure(child, level + 1)
             
-    # Traverse the syntax tree to find the structure path of the line number
-    def traverse(node, current_structure=[]):
-        # Check if the current node contains the line number
-        if node.start_point[0] <= line_index <= node.end_point[0]:
-            # If it is a class definition, add to structure path
-            if node.type == node_types['class']:
-                class_declaration, class_name = node_types["get_signature_fn"](node)
-                current_structure.append({
-                    "type": "class",
-                    "name": class_name,
-                    "signature": class_declaration,
-                    "at_line": node.start_point[0]
-                })
+    # Return the structure entry of a node containing the line number, None if it is not part of the structure path
+    def visit(node):
+        # If it is a class definition, add to structure path
+        if node.type == node_types['class']:
+            class_declaration, class_name = node_types["get_signature_fn"](node)
+            return {
+                "type": "class",
+                "name": class_name,
+                "signature": class_declaration,
+                "at_line": node.start_point[0]
+            }
+
+        # If it is a function definition, add to structure path
+        elif node.type == node_types['function']:
+            function_declaration, function_name = node_types["get_signature_fn"](node)
+            return {
+                "type": "function",
+                "name": function_name,
+                "signature": function_declaration,
+                "at_line": node.start_point[0]
+            }
 
-            # If it is a function definition, add to structure path
-            elif node.type == node_types['function']:
-                function_declaration, function_name = node_types["get_signature_fn"](node)
-                current_structure.append({
-                    "type": "function",
+        # If it is a function call, add to structure path
+        elif node.type == node_types['call']:
+            function_name, call_signature = node_types["get_call_info_fn"](node)
+            if function_name:
+                return {
+                    "type": "call",
                     "name": function_name,
-                    "signature": function_declaration,
-                    "at_line": node.start_point[0]
-                })
-
-            # If it is a function call, add to structure path
-            elif node.type == node_types['call']:
-                function_name, call_signature = node_types["get_call_info_fn"](node)
-                if function_name:
-                    # Find which specific argument the line belongs to
-                    argument_info = find_argument_in_call(node, line_index)
-                    
-                    call_entry = {
-                        "type": "call",
-                        "name": function_name,
-                        "signature": call_signature,
-                        "at_line": node.start_point[0]
-                    }
-                    
-                    current_structure.append(call_entry)
-
-            elif node_types.get('method') and node.type == node_types['method']:
-                
-                method_declaration, method_name = node_types["get_signature_fn"](node)
-                current_structure.append({
-                    "type": "method",
-                    "name": method_name,
-                    "signature": method_declaration,
+                    "signature": call_signature,
                     "at_line": node.start_point[0]
-                })
-                
-            # Check the child in recursion
-            for child in node.children:
-                result = traverse(child, current_structure)
-                if result:
-                    return result
-
-            # return the current structure path
-            return current_structure
+                }
+
+        elif node_types.get('method') and node.type == node_types['method']:
+            method_declaration, method_name = node_types["get_signature_fn"](node)
+            return {
+                "type": "method",
+                "name": method_name,
+                "signature": method_declaration,
+                "at_line": node.start_point[0]
+            }
 
-        return []
+        return None
 
     # Get the structural path of the line number
-    structure_path = traverse(root_node)
+    structure_path = index.resolve(line_index, visit)
     return structure_path
 
-def find_control_flow(code, line_index, language): # Also used in simulation/utils.py
+def find_control_flow(code, line_index, language, index=None): # Also used in simulation/utils.py
 
     def get_statement(node, source_bytes):
         start = node.start_byte
@@ -676,48 +624,37 @@ def find_control_flow(code, line_index, language): # Also used in simulation/uti
             colon_index = end
         return source_bytes[start:colon_index + 1].decode("utf-8").strip()
     
-    def traverse(node, source_bytes, line_index, current_structure=[]):
-        CONTROL_FLOW_TYPES = {
-            "if_statement",
-            "while_statement",
-            "for_statement",
-            "try_statement",
-            "with_statement",
-            "match_statement",
-            "except_clause",  # optional: narrower scope
-            "else_clause",
-            "finally_clause"
-        }
-
-        # Check if the current node contains the line number
-        if node.start_point[0] <= line_index <= node.end_point[0]:
-            # complete here, extract the control flow structure
-            if node.type in CONTROL_FLOW_TYPES:
-                statement = get_statement(node, source_bytes)
-                current_structure.append({
-                    "type": node.type,
-                    "statement": statement,
-                    "start_line": node.start_point[0],
-                    "end_line": node.end_point[0]
-                })
-
-            for child in node.children:
-                result = traverse(child, source_bytes, line_index, current_structure)
-                if result:
-                    return result
-                
-            return current_structure
+    CONTROL_FLOW_TYPES = {
+        "if_statement",
+        "while_statement",
+        "for_statement",
+        "try_statement",
+        "with_statement",
+        "match_statement",
+        "except_clause",  # optional: narrower scope
+        "else_clause",
+        "finally_clause"
+    }
 
-        return []
+    # Return the control flow entry of a node containing the line number, None if it is not a control flow statement
+    def visit(node):
+        if node.type in CONTROL_FLOW_TYPES:
+            statement = get_statement(node, source_bytes)
+            return {
+                "type": node.type,
+                "statement": statement,
+                "start_line": node.start_point[0],
+                "end_line": node.end_point[0]
+            }
+        return None
 
     assert language == "python", "Currently only python is supported"
-    parser = get_parser(language)
-
-    # Parse the code
-    tree = parser.parse(bytes(code, "utf8"))
-    root_node = tree.root_node
+    # Parse the code, unless the line index of this file is given
+    if index is None:
+        index = SyntaxIndex(parse(code, language))
+    source_bytes = bytes(code, "utf8")
 
-    structure_path = traverse(root_node, bytes(code, "utf8"), line_index)
+    structure_path = index.resolve(line_index, visit)
     return structure_path
 
 def add_info_to_snapshots(snapshots):
@@ -725,6 +662,8 @@ def add_info_to_snapshots(snapshots):
         pre_edit_line_idx = 0
         post_edit_line_idx = 0
         parent_version_content = "".join(get_version(snapshot, "parent"))
+        # Parse each file once, all hunks of the file share the same line index
+        index = None
         for widx, window in enumerate(snapshot):
             if isinstance(window, list):
                 pre_edit_line_idx += len(window)
@@ -767,8 +706,10 @@ def add_info_to_snapshots(snapshots):
                 structural_path = []
                 control_flow = []
             else:
-                structural_path = find_code_structure(parent_version_content, line_index, language)
-                control_flow = find_control_flow(parent_version_content, line_index, language)
+                if index is None:
+                    index = SyntaxIndex(parse(parent_version_content, language))
+                structural_path = find_code_structure(parent_version_content, line_index, language, index)
+                control_flow = find_control_flow(parent_version_content, line_index, language, index)
 
             window["control_flow"] = control_flow
             window["structural_path"] = structural_path
@@ -59,6 +59,7 @@ let currentTempFile = null;
 let currentCommitUrl = null; 
 let currentsystemUnderTest = null;
 let currentsuggestion_type = null;
+let currentSessionId = null; // simulation session returned by the backend init step
 
 let isPaused = false;
 async function updateContext() {
@@ -333,6 +334,7 @@ async function simulateInitStep(commit_url, previousEdits, targetFileSegments, r
                 console.log('Backend request succeeded: ', backendResponse.data);
                 vscode.window.showInformationMessage('Backend simulation request processed successfully');
                 const response_message = backendResponse.data;
+                currentSessionId = response_message.session_id || null;
 
                 // step 1: process pred_snapshots
                 const hunks = processInitPredSnapshots(response_message["pred_snapshots"]);
@@ -444,6 +446,7 @@ async function sendBackendRequest(commit_url, system_under_test, status, suggest
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
+                'Accept-Encoding': 'gzip',
             }
         };
         
@@ -451,7 +454,10 @@ async function sendBackendRequest(commit_url, system_under_test, status, suggest
             commit_url: commit_url,
             system_under_test: system_under_test,
             status: status,
-            suggestion_type: suggestion_type
+            suggestion_type: suggestion_type,
+            session_id: status === "init" ? null : currentSessionId,
+            // ground truth snapshots and partial order graph are not shown here, only receive them once per session
+            delta: true
         };
         
         console.log('Send request to backend:', requestData);
@@ -459,15 +465,19 @@ async function sendBackendRequest(commit_url, system_under_test, status, suggest
         const client = parseInt(url.port) === 443 ? https : http;
         
         const req = client.request(backendConfig, (res) => {
-            let data = '';
+            const chunks = [];
             
             res.on('data', (chunk) => {
-                data += chunk;
+                chunks.push(chunk);
             });
             
             res.on('end', () => {
                 try {
-                    const response = JSON.parse(data);
+                    let body = Buffer.concat(chunks);
+                    if (res.headers['content-encoding'] === 'gzip') {
+                        body = require('zlib').gunzipSync(body);
+                    }
+                    const response = JSON.parse(body.toString('utf8'));
                     resolve(response);
                 } catch (error) {
                     reject(new Error('Failed to parse backend response: ' + error.message));
@@ -1048,5 +1058,5 @@ module.exports = {
     applyHunkToContent,
     validateSimulationServerConnection,
     isSimulationCompleted,
-    resetSimulation: () => { isSimulationCompleted = false; }
+    resetSimulation: () => { isSimulationCompleted = false; currentSessionId = null; }
 };
\ No newline at end of file
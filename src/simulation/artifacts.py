@@ -0,0 +1,112 @@
+import os
+import json
+import hashlib
+
+from dotenv import load_dotenv
+from .utils import write_json_atomic
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+root_path = os.path.abspath(os.path.join(current_path, "../../"))
+load_dotenv(dotenv_path=os.path.join(root_path, ".config"))
+OUTPUT_DIR = os.getenv("OUTPUT_DIR")
+ARTIFACTS_DIR = os.getenv("ARTIFACTS_DIR") or os.path.join(OUTPUT_DIR, ".artifacts")
+# Bump when extract_hunks(), analyze_dependency() or restore_edit_order() change their output,
+# so that the artifacts of the previous pipeline are no longer used
+PIPELINE_VERSION = "1"
+
+def get_artifact_key(commit_url):
+    """
+    Return the key of the preprocessing artifacts of a commit, which do not depend on the system under test.
+    """
+    return hashlib.sha1(f"{commit_url}\n{PIPELINE_VERSION}".encode("utf-8")).hexdigest()
+
+def get_artifact_path(artifact_key):
+    return os.path.join(ARTIFACTS_DIR, f"{artifact_key}.json")
+
+def load_artifacts(commit_url):
+    """
+    Load the preprocessing artifacts of a commit.
+
+    Returns:
+        artifacts: dict | None, with keys "commit_url", "pipeline_version", "commit_message", "commit_snapshots",
+            "partial_orders" and "allowed_next_edit_idxs", None if the commit has not been preprocessed yet
+    """
+    artifact_fp = get_artifact_path(get_artifact_key(commit_url))
+    if not os.path.exists(artifact_fp):
+        return None
+    with open(artifact_fp, "r") as f:
+        return json.load(f)
+
+def save_artifacts(commit_url, commit_message, commit_snapshots, partial_orders, allowed_next_edit_idxs):
+    """
+    Save the preprocessing artifacts of a commit, before any edit is simulated.
+
+    Returns:
+        artifact_key: str, the key of the saved artifacts
+    """
+    artifact_key = get_artifact_key(commit_url)
+    os.makedirs(ARTIFACTS_DIR, exist_ok=True)
+    write_json_atomic(get_artifact_path(artifact_key), {
+        "commit_url": commit_url,
+        "pipeline_version": PIPELINE_VERSION,
+        "commit_message": commit_message,
+        "commit_snapshots": commit_snapshots,
+        "partial_orders": partial_orders,
+        "allowed_next_edit_idxs": allowed_next_edit_idxs
+    })
+    return artifact_key
+
+def get_record_prefix(commit_url, system_under_test, rollout=None):
+    """
+    Return the path prefix of the simulation records of a commit under a system under test.
+    Records of seeded rollouts are kept apart, under OUTPUT_DIR/rollouts.
+    """
+    commit_sha = commit_url.split("/")[-1][:10]
+    project_name = commit_url.split("/")[-3]
+    if rollout is None:
+        return os.path.join(OUTPUT_DIR, f"{project_name}-{commit_sha}-{system_under_test}")
+    return os.path.join(OUTPUT_DIR, "rollouts", f"{project_name}-{commit_sha}-{system_under_test}-rollout{rollout}")
+
+def load_simulation_results(record_fp):
+    """
+    Load the simulation results of a commit under a system under test.
+
+    The results only hold the prediction data and the key of the commit artifacts. The commit message,
+    commit snapshots with the final edit status, partial orders, and the ground truth snapshots and
+    partial order graph of each prediction record are restored from the artifacts, so the loaded
+    results are the same as if they had been saved in full. Results saved in full are loaded as they are.
+
+    Returns:
+        record: dict, the simulation results
+    """
+    with open(record_fp, "r") as f:
+        record = json.load(f)
+    if "commit_snapshots" in record:
+        return record
+
+    artifact_fp = get_artifact_path(record["artifact_key"])
+    if not os.path.exists(artifact_fp):
+        raise RuntimeError(f"[ERROR:SIM] Artifacts {artifact_fp} of simulation results {record_fp} are missing.")
+    with open(artifact_fp, "r") as f:
+        artifacts = json.load(f)
+
+    # Saved results are complete, every edit has been simulated and none is left allowed as next
+    simulated_edit_idxs = set(record["simulation_order"])
+    edits = []
+    for file_path, snapshot in artifacts["commit_snapshots"].items():
+        for window in snapshot:
+            if isinstance(window, dict):
+                window["simulated"] = window["idx"] in simulated_edit_idxs
+                window["allowed_as_next"] = False
+                edits.append(window)
+
+    record["commit_message"] = artifacts["commit_message"]
+    record["commit_snapshots"] = artifacts["commit_snapshots"]
+    record["partial_orders"] = artifacts["partial_orders"]
+    for prediction_record in record["SUT_prediction_records"]:
+        prediction_record["gdth_snapshots"] = record["commit_snapshots"]
+        prediction_record["partial_order_graph"] = {
+            "nodes": list(edits),
+            "edges": record["partial_orders"]
+        }
+    return record
@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import argparse
+import datetime
+import traceback
+import concurrent.futures
+
+from collections import defaultdict, deque
+
+from dotenv import load_dotenv
+from .utils import clone_repo, write_json_atomic
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+root_path = os.path.abspath(os.path.join(current_path, "../../"))
+load_dotenv(dotenv_path=os.path.join(root_path, ".config"))
+REPOS_DIR = os.getenv("REPOS_DIR")
+OUTPUT_DIR = os.getenv("OUTPUT_DIR")
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS") or max(1, (os.cpu_count() or 2) // 2))
+PREPARE_WORKERS = int(os.getenv("PREPARE_WORKERS") or 2)
+CLONE_WORKERS = int(os.getenv("CLONE_WORKERS") or 4)
+PREFETCH_DEPTH = int(os.getenv("PREFETCH_DEPTH") or 2 * BATCH_WORKERS)
+
+def simulate_commit(url, sut, flow_keeper=True):
+    """
+    Simulate one commit inside a worker process.
+    Every worker process owns its own session registry, hence its own Commit state.
+
+    Returns:
+        result: dict, with keys "url", "success", "error" and "seconds"
+    """
+    # Import inside the worker, so that the parent process does not load any system under test
+    from .main import rq3_origin, rq3_flow_keeper
+
+    start = time.time()
+    try:
+        rq3_origin(url, sut)
+        if flow_keeper:
+            rq3_flow_keeper(url, sut)
+        error = None
+    except Exception as e:
+        traceback.print_exc()
+        error = f"{type(e).__name__}: {e}"
+    return {
+        "url": url,
+        "success": error is None,
+        "error": error,
+        "seconds": time.time() - start
+    }
+
+def format_seconds(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+def prepare_commit(url, sut):
+    """
+    Preprocess one commit inside a worker process, ahead of its simulation:
+    extract its hunks, analyze their dependency and restore their partial order into the artifact store.
+
+    Returns:
+        result: dict, with keys "url", "success", "error" and "seconds"
+    """
+    from .commit import Commit
+
+    start = time.time()
+    try:
+        Commit(url, REPOS_DIR, sut, preprocess_only=True)
+        error = None
+    except Exception as e:
+        traceback.print_exc()
+        error = f"{type(e).__name__}: {e}"
+    return {
+        "url": url,
+        "success": error is None,
+        "error": error,
+        "seconds": time.time() - start
+    }
+
+def run_batch(urls, sut, workers=BATCH_WORKERS, flow_keeper=True, prepare_workers=PREPARE_WORKERS, clone_workers=CLONE_WORKERS, prefetch=PREFETCH_DEPTH):
+    """
+    Simulate commits through a staged pipeline: clone -> preprocess -> simulate.
+    Each stage has its own pool, so that commits following the simulated ones are cloned and preprocessed
+    (hunk extraction, LSP dependency analysis, partial order queries) while the system under test is waited for.
+    Every simulation works in its own git worktree, so commits of the same project run in parallel.
+
+    Args:
+        urls: list[str], the commit urls to simulate
+        sut: str, the system under test
+        workers: int, the number of simulation worker processes
+        flow_keeper: bool, whether to also evaluate the flow-keeper reranking on each simulated commit
+        prepare_workers: int, the number of preprocessing worker processes
+        clone_workers: int, the number of repositories cloned at the same time
+        prefetch: int, the maximum number of commits being cloned, preprocessed or waiting to be simulated
+
+    Returns:
+        results: list[dict], the result of each commit, in completion order
+    """
+    os.makedirs(REPOS_DIR, exist_ok=True)
+    projects = {}
+    for url in urls:
+        projects.setdefault(url.split("/")[-3], url.split("/")[-4])
+
+    results = []
+    pending = list(reversed(urls)) # commits not entered in the pipeline yet
+    cloning = {} # clone future -> project name
+    cloned = {} # project name -> error of its clone, None if cloned
+    waiting_clone = defaultdict(list) # project name -> commits waiting for the clone of the project
+    preparing = {} # preprocessing future -> url
+    prepared = deque() # preprocessed commits waiting for a simulation worker
+    running = {} # simulation future -> url
+    start = time.time()
+    print(f"[MESSAGE:SIM] Batch simulating {len(urls)} commits of {len(projects)} projects under {sut} with {workers} simulation workers, {prepare_workers} preprocessing workers and {clone_workers} clone workers.")
+
+    def report(result):
+        results.append(result)
+        finished = len(results)
+        failed = len([r for r in results if not r["success"]])
+        elapsed = time.time() - start
+        eta = elapsed / finished * (len(urls) - finished)
+        status = "done" if result["success"] else f"failed ({result['error']})"
+        print(f"[MESSAGE:SIM] [{finished}/{len(urls)}] {result['url']} {status} in {format_seconds(result['seconds'])}")
+        print(f"[MESSAGE:SIM] Batch progress: {finished}/{len(urls)} finished, {failed} failed, {len(preparing)} preprocessing, {len(prepared)} prefetched, elapsed {format_seconds(elapsed)}, ETA {format_seconds(eta)}")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=clone_workers) as clone_executor, \
+         concurrent.futures.ProcessPoolExecutor(max_workers=prepare_workers) as prepare_executor, \
+         concurrent.futures.ProcessPoolExecutor(max_workers=workers) as simulate_executor:
+
+        def prepare(url):
+            project_name = url.split("/")[-3]
+            if cloned[project_name] is None:
+                preparing[prepare_executor.submit(prepare_commit, url, sut)] = url
+            else:
+                report({"url": url, "success": False, "error": cloned[project_name], "seconds": 0.0})
+
+        def fill():
+            # Let commits enter the pipeline while the prefetch window has room
+            while pending and sum(len(v) for v in waiting_clone.values()) + len(preparing) + len(prepared) < prefetch:
+                url = pending.pop()
+                project_name = url.split("/")[-3]
+                if project_name in cloned:
+                    prepare(url)
+                    continue
+                if project_name not in waiting_clone:
+                    # Clone every repository once, so that workers never clone the same repository concurrently
+                    cloning[clone_executor.submit(clone_repo, projects[project_name], project_name, REPOS_DIR)] = project_name
+                waiting_clone[project_name].append(url)
+            while prepared and len(running) < workers:
+                url = prepared.popleft()
+                running[simulate_executor.submit(simulate_commit, url, sut, flow_keeper)] = url
+
+        fill()
+        while cloning or preparing or running:
+            done, _ = concurrent.futures.wait(list(cloning) + list(preparing) + list(running), return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future in cloning:
+                    project_name = cloning.pop(future)
+                    try:
+                        future.result()
+                        cloned[project_name] = None
+                    except Exception as e:
+                        cloned[project_name] = f"{type(e).__name__}: {e}"
+                        print(f"[MESSAGE:SIM] Cloning {projects[project_name]}/{project_name} failed ({cloned[project_name]})")
+                    for url in waiting_clone.pop(project_name):
+                        prepare(url)
+
+                elif future in preparing:
+                    url = preparing.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        # The worker process itself died
+                        result = {"url": url, "success": False, "error": f"{type(e).__name__}: {e}", "seconds": 0.0}
+                    if result["success"]:
+                        prepared.append(url)
+                    else:
+                        result["error"] = f"Preprocessing failed: {result['error']}"
+                        report(result)
+
+                else:
+                    url = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        # The worker process itself died
+                        result = {"url": url, "success": False, "error": f"{type(e).__name__}: {e}", "seconds": 0.0}
+                    report(result)
+            fill()
+
+    # Named apart from the "<project>-<sha>-<sut>-" records that analyze.py reads
+    write_json_atomic(os.path.join(OUTPUT_DIR, f"batch-summary-{sut}.json"), {
+        "system_under_test": sut,
+        "total": len(urls),
+        "failed": len([r for r in results if not r["success"]]),
+        "elapsed": time.time() - start,
+        "results": results
+    })
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sut", type=str, default="Claude", help="The system under test")
+    parser.add_argument("--urls", type=str, default="simulation/urls.json", help="Json file of commit urls to simulate")
+    parser.add_argument("--limit", type=int, default=500, help="Maximum number of commits to simulate")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS, help="Number of simulation worker processes")
+    parser.add_argument("--prepare_workers", type=int, default=PREPARE_WORKERS, help="Number of preprocessing worker processes")
+    parser.add_argument("--clone_workers", type=int, default=CLONE_WORKERS, help="Number of repositories cloned at the same time")
+    parser.add_argument("--prefetch", type=int, default=PREFETCH_DEPTH, help="Maximum number of commits cloned, preprocessed or waiting ahead of the simulations")
+    parser.add_argument("--no_flow_keeper", action="store_true", help="Skip the flow-keeper evaluation")
+    args = parser.parse_args()
+
+    with open(args.urls, "r") as f:
+        urls = json.load(f)
+
+    run_batch(
+        urls[:args.limit], args.sut, workers=args.workers, flow_keeper=not args.no_flow_keeper,
+        prepare_workers=args.prepare_workers, clone_workers=args.clone_workers, prefetch=args.prefetch
+    )
+    print(f"RQ3 for {args.sut} is DONE !")
@@ -19,6 +19,7 @@ The reason for breaking the BLEU computation into three phases cook_refs(), cook
 
 import sys, math, re, xml.sax.saxutils
 import json
+import functools
 
 # Added to bypass NIST-style pre-processing of hyp and ref files -- wade
 nonorm = 0
@@ -214,6 +215,63 @@ def bleuFromMaps(m1, m2):
       num += 1
   return [s * 100.0 / num for s in score]
 
+# Fast path of direct_computeMaps() followed by bleuFromMaps(), for scoring the same texts against
+# each other many times. Reference n-gram counts and normalized candidates are cached, the arithmetic
+# is the one of cook_refs(), cook_test() and score_cooked(), so scores are bit-identical.
+BLEU_CACHE_SIZE = 4096
+
+@functools.lru_cache(maxsize=BLEU_CACHE_SIZE)
+def cook_text(text):
+    '''Takes a raw text and returns its tokens as direct_computeMaps() and normalize() produce them.'''
+    return tuple(normalize(splitPuncts(text.strip().lower())))
+
+@functools.lru_cache(maxsize=BLEU_CACHE_SIZE)
+def cook_reference(reference, n=4):
+    '''Takes a raw reference text and returns (reflen, maxcounts, totals), where totals[k] is the
+    number of (k + 1)-grams of the reference.'''
+    words = cook_text(reference)
+    maxcounts = count_ngrams(words, n)
+    totals = [max(len(words) - k, 0) for k in range(n)]
+    return (len(words), maxcounts, totals)
+
+def _score(testlen, reflen, correct, n=4):
+    '''score_cooked()[0] * 100 of a single cooked test, with smooth=1.'''
+    logbleu = 0.0
+    for k in range(n):
+        guess = max(testlen - k, 0)
+        addsmooth = 1 if k > 0 else 0
+        logbleu += math.log(correct[k] + addsmooth + sys.float_info.min) - math.log(guess + addsmooth + sys.float_info.min)
+    logbleu /= float(n)
+    brevPenalty = min(0, 1 - float(reflen + 1) / (testlen + 1))
+    return math.exp(logbleu + brevPenalty) * 100.0
+
+def sentence_bleu(candidate, reference, n=4):
+    '''Same as bleuFromMaps(*direct_computeMaps(candidate, reference))[0].'''
+    test = cook_text(candidate)
+    (reflen, refmaxcounts, _) = cook_reference(reference, n)
+    correct = [0] * n
+    for (ngram, count) in count_ngrams(test, n).items():
+        correct[len(ngram) - 1] += min(refmaxcounts.get(ngram, 0), count)
+    return _score(len(test), reflen, correct, n)
+
+def batch_bleu_above(candidates, reference, threshold, n=4):
+    '''Whether sentence_bleu(candidate, reference) > threshold, for many candidates scored against one reference,
+    which is cooked once. The n-gram counting of a candidate is skipped when its score cannot exceed the threshold
+    even if every candidate n-gram matched, i.e. with correct[k] bounded by the n-gram totals of both texts.'''
+    (reflen, refmaxcounts, totals) = cook_reference(reference, n)
+    above = []
+    for candidate in candidates:
+        test = cook_text(candidate)
+        upper_bound = [min(max(len(test) - k, 0), totals[k]) for k in range(n)]
+        if _score(len(test), reflen, upper_bound, n) <= threshold:
+            above.append(False)
+            continue
+        correct = [0] * n
+        for (ngram, count) in count_ngrams(test, n).items():
+            correct[len(ngram) - 1] += min(refmaxcounts.get(ngram, 0), count)
+        above.append(_score(len(test), reflen, correct, n) > threshold)
+    return above
+
 def computeMaps_multiple(jsonfile, k):
   predictionMap = {}
   goldMap = {}
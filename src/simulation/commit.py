@@ -1,29 +1,66 @@
 import os
 import json
+import uuid
+import hashlib
+import random
+import shutil
 
 from dotenv import load_dotenv
-from .utils import extract_hunks
+from collections import defaultdict
+from .utils import extract_hunks, clone_repo, create_worktree, remove_worktree, write_json_atomic
+from .artifacts import get_artifact_key, get_record_prefix, load_artifacts, save_artifacts, load_simulation_results
 from .edit_dependency import analyze_dependency
 from .partial_order import restore_edit_order
+from .piece_table import PieceTable
 
 current_path = os.path.abspath(os.path.dirname(__file__))
 root_path = os.path.abspath(os.path.join(current_path, "../../"))
 load_dotenv(dotenv_path=os.path.join(root_path, ".config"))
 OUTPUT_DIR = os.getenv("OUTPUT_DIR")
 os.makedirs(OUTPUT_DIR, exist_ok=True)
+# Progress logs are kept apart from the simulation results, which analyze.py reads from OUTPUT_DIR
+PROGRESS_DIR = os.path.join(OUTPUT_DIR, ".progress")
 
 class Commit:
-    def __init__(self, commit_url, repos_dir, system_under_test):
+    def __init__(self, commit_url, repos_dir, system_under_test, preprocess_only=False, rollout=None):
+        """
+        Args:
+            commit_url: str, the url of the commit to simulate
+            repos_dir: str, the directory of the local clones
+            system_under_test: str, the system under test
+            preprocess_only: bool, only make sure the preprocessing artifacts of the commit exist, for a simulation
+                to come. Nothing is done if the commit has already been simulated under system_under_test.
+            rollout: int | None, the seed of a reproducible rollout, recorded apart from the other rollouts.
+                None for an unseeded simulation.
+        """
         self.commit_sha = commit_url.split("/")[-1][:10]
         self.project_name = commit_url.split("/")[-3]
-        self.repo_dir = os.path.join(repos_dir, self.project_name)
+        self.repo_path = os.path.join(repos_dir, self.project_name) # the local clone, shared by all simulations of this project
+        self.repo_dir = None # the private worktree of this simulation, only created when the commit needs to be simulated
         self.commit_url = commit_url
         self.system_under_test = system_under_test
+        self.rollout = rollout
+
+        record_prefix = get_record_prefix(commit_url, system_under_test, rollout)
+        os.makedirs(os.path.dirname(record_prefix), exist_ok=True)
+        self.record_fp = f"{record_prefix}-simulation-results.json"
+        # Append-only log of the finished steps, removed once the simulation results are saved
+        os.makedirs(PROGRESS_DIR, exist_ok=True)
+        self.progress_fp = os.path.join(PROGRESS_DIR, f"{os.path.basename(record_prefix)}-simulation-progress.jsonl")
+        legacy_progress_fp = f"{record_prefix}-simulation-progress.jsonl"
+        if os.path.exists(legacy_progress_fp) and not os.path.exists(self.progress_fp):
+            # Logs of interrupted simulations used to be written next to the simulation results
+            os.replace(legacy_progress_fp, self.progress_fp)
+        # Preprocessing artifacts (snapshots, dependency edges, partial orders) are shared by all systems under test
+        self.artifact_key = get_artifact_key(commit_url)
+        if preprocess_only:
+            if not os.path.exists(self.record_fp) and not os.path.exists(self.progress_fp) and load_artifacts(commit_url) is None:
+                self.preprocess(repos_dir)
+                self.close()
+            return
 
-        record_fp = os.path.join(OUTPUT_DIR, f"{self.project_name}-{self.commit_sha}-{self.system_under_test}-simulation-results.json")
-        if os.path.exists(record_fp):
-            with open(record_fp, "r") as f:
-                record = json.load(f)
+        if os.path.exists(self.record_fp):
+            record = load_simulation_results(self.record_fp)
             self.commit_message = record["commit_message"]
             self.commit_snapshots = record["commit_snapshots"]
             self.partial_orders = record["partial_orders"]
@@ -32,35 +69,202 @@ class Commit:
             self.SUT_prediction_records = record["SUT_prediction_records"]
             print(f"[MESSAGE:SIM] Simulation results found for {self.commit_url} under {self.system_under_test}. Loaded records.")
 
+        elif os.path.exists(self.progress_fp):
+            self.resume_from_progress_log(repos_dir)
+
         else:
-            print(f"[MESSAGE:SIM] No simulation results found for {self.commit_sha}. Extracting hunks and restoring edit order.")
-            self.commit_message, self.commit_snapshots = extract_hunks(self.commit_url, repos_dir)
-            analyze_dependency(self)
-            self.partial_orders, self.allowed_next_edit_idxs = restore_edit_order(self.commit_snapshots, commit_url, mock_order=False)
+            artifacts = load_artifacts(commit_url)
+            if artifacts is not None:
+                print(f"[MESSAGE:SIM] Preprocessing artifacts found for {self.commit_url}. Skipped hunk extraction, dependency analysis and edit order restoration.")
+                self.commit_message = artifacts["commit_message"]
+                self.commit_snapshots = artifacts["commit_snapshots"]
+                self.partial_orders = artifacts["partial_orders"]
+                self.allowed_next_edit_idxs = artifacts["allowed_next_edit_idxs"]
+                clone_repo(commit_url.split("/")[-4], self.project_name, repos_dir, commit_url.split("/")[-1])
+                # The same version as the worktree of a freshly preprocessed commit
+                worktree_dir = os.path.join(repos_dir, ".worktrees", f"{self.project_name}-{self.commit_sha}-{uuid.uuid4().hex[:8]}")
+                self.repo_dir = create_worktree(self.repo_path, self.commit_sha, worktree_dir)
+            else:
+                self.preprocess(repos_dir)
             self.simulation_order = []
             self.SUT_prediction_records = []
+            self.append_progress_log({
+                "type": "header",
+                "commit_url": self.commit_url,
+                "artifact_key": self.artifact_key
+            }, truncate=True)
+
+        self.build_edit_index()
+
+    def preprocess(self, repos_dir):
+        """
+        Extract the hunks of the commit, analyze their dependency and restore their partial order,
+        then save them as the artifacts of the commit.
+        The worktree of the simulation is created on the way, at the head version.
+        """
+        print(f"[MESSAGE:SIM] No simulation results found for {self.commit_sha}. Extracting hunks and restoring edit order.")
+        self.commit_message, self.commit_snapshots = extract_hunks(self.commit_url, repos_dir)
+        worktree_dir = os.path.join(repos_dir, ".worktrees", f"{self.project_name}-{self.commit_sha}-{uuid.uuid4().hex[:8]}")
+        # analyze_dependency sends the base version of the edited files from the snapshots, without checkout
+        self.repo_dir = create_worktree(self.repo_path, self.commit_sha, worktree_dir)
+        try:
+            analyze_dependency(self)
+            self.partial_orders, self.allowed_next_edit_idxs = restore_edit_order(self.commit_snapshots, self.commit_url, mock_order=False)
+            save_artifacts(self.commit_url, self.commit_message, self.commit_snapshots, self.partial_orders, self.allowed_next_edit_idxs)
+        except BaseException:
+            self.close()
+            raise
+
+    def append_progress_log(self, entry, truncate=False):
+        """
+        Append one entry to the progress log and flush it to disk before returning.
+        """
+        with open(self.progress_fp, "w" if truncate else "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def resume_from_progress_log(self, repos_dir):
+        """
+        Restore the commit from the progress log of an interrupted simulation,
+        replay its finished steps, and continue from the last one.
+        A partially written last line, left by a crash, is dropped.
+        """
+        entries = []
+        valid_size = 0
+        with open(self.progress_fp, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    break
+                valid_size += len(line)
+        if valid_size < os.path.getsize(self.progress_fp):
+            with open(self.progress_fp, "r+b") as f:
+                f.truncate(valid_size)
+        if len(entries) == 0 or entries[0]["type"] != "header":
+            raise RuntimeError(f"[ERROR:SIM] Progress log {self.progress_fp} has no header, remove it to restart the simulation.")
+
+        header = entries[0]
+        if "artifact_key" in header:
+            artifacts = load_artifacts(self.commit_url)
+            if artifacts is None:
+                raise RuntimeError(f"[ERROR:SIM] Artifacts of progress log {self.progress_fp} are missing, remove it to restart the simulation.")
+        else:
+            # Logs written before the artifact store embed the artifacts in their header
+            artifacts = header
+            if load_artifacts(self.commit_url) is None:
+                save_artifacts(self.commit_url, header["commit_message"], header["commit_snapshots"], header["partial_orders"], header["allowed_next_edit_idxs"])
+        self.commit_message = artifacts["commit_message"]
+        self.commit_snapshots = artifacts["commit_snapshots"]
+        self.partial_orders = artifacts["partial_orders"]
+        self.allowed_next_edit_idxs = artifacts["allowed_next_edit_idxs"]
+        self.simulation_order = []
+        self.SUT_prediction_records = []
+        self.build_edit_index()
+        for entry in entries[1:]:
+            self.update_edit_status(entry["edit_idx"], "simulated", True)
+            self.update_allowed_as_next()
+            self.SUT_prediction_records.append(self.attach_live_fields(entry["record"]))
+
+        if len(self.simulation_order) == len(self.edits):
+            # Interrupted after the last step was logged but before the results were saved, save them now
+            # and replay the results as if they had been loaded from the record file
+            self.save_simulation_results()
+            self.replay_progress = []
+            print(f"[MESSAGE:SIM] Completed simulation of {self.commit_url} under {self.system_under_test} restored from its progress log.")
+            return
+
+        # The same version as the worktree of a freshly preprocessed commit
+        worktree_dir = os.path.join(repos_dir, ".worktrees", f"{self.project_name}-{self.commit_sha}-{uuid.uuid4().hex[:8]}")
+        self.repo_dir = create_worktree(self.repo_path, self.commit_sha, worktree_dir)
+        print(f"[MESSAGE:SIM] Resumed simulation of {self.commit_url} under {self.system_under_test} after {len(self.simulation_order)} simulated edits.")
+
+    def attach_live_fields(self, record):
+        """
+        The ground truth snapshots and partial order graph of a record refer to the live commit state,
+        they are left out of the progress log and attached back on resume.
+        """
+        record["gdth_snapshots"] = self.commit_snapshots
+        record["partial_order_graph"] = self.get_partial_order_graph()
+        return record
+
+    def add_prediction_record(self, edit_idx, response_message):
+        """
+        Record the response of a finished simulation step, in which edit_idx was applied, and log it to disk.
+        """
+        self.SUT_prediction_records.append(response_message)
+        record = {key: value for key, value in response_message.items() if key not in ["gdth_snapshots", "partial_order_graph"]}
+        self.append_progress_log({"type": "step", "edit_idx": edit_idx, "record": record})
+
+    def close(self):
+        """
+        Remove the worktree of this simulation and the copy made from it by the system under test.
+        Safe to call more than once.
+        """
+        if self.repo_dir is None:
+            return
+        shutil.rmtree(f"{self.repo_dir}_clone", ignore_errors=True)
+        remove_worktree(self.repo_path, self.repo_dir)
+        print(f"[MESSAGE:SIM] Removed worktree {self.repo_dir}.")
+        self.repo_dir = None
+
+    def build_edit_index(self):
+        """
+        Index the edits of the commit snapshot, so that the bookkeeping of each simulation step
+        does not scan the snapshot windows:
+            - edit_by_idx: edit index -> edit window
+            - successors: edit index -> edit indexes it points to in the partial order graph
+            - simulated_edit_idxs: indexes of simulated edits
+            - allowed_next_edit_frontier: indexes of not simulated edits pointed to by a simulated edit
+            - versions: file path -> piece table of the current version of the file
+            - edit_pieces: edit index -> (file path, index of its piece in the piece table)
+            - dirty_files: files whose content on disk may differ from the current version, all of them until the first sync
+            - unseen_changed_files: files written since the system under test last received them via take_changed_files()
+            - synced_hashes: sha1 of the content on disk of each file, as last written by sync
+        """
+        self.edits = []
+        self.edit_by_idx = {}
+        self.versions = {}
+        self.edit_pieces = {}
+        self.dirty_files = set(self.commit_snapshots)
+        self.unseen_changed_files = set(self.commit_snapshots)
+        self.synced_hashes = {}
+        for file_path, file_snapshot in self.commit_snapshots.items():
+            self.versions[file_path] = PieceTable(file_snapshot)
+            for widx, window in enumerate(file_snapshot):
+                if isinstance(window, dict):
+                    self.edits.append(window)
+                    self.edit_by_idx[window["idx"]] = window
+                    self.edit_pieces[window["idx"]] = (file_path, widx)
+
+        self.successors = defaultdict(list)
+        for edge in self.partial_orders:
+            self.successors[edge["src"]].append(edge["tgt"])
+
+        self.simulated_edit_idxs = set(idx for idx, edit in self.edit_by_idx.items() if edit["simulated"])
+        self.allowed_next_edit_frontier = set()
+        for idx in self.simulated_edit_idxs:
+            self.allowed_next_edit_frontier.update(tgt for tgt in self.successors[idx] if tgt not in self.simulated_edit_idxs)
+        # Edits currently flagged as allowed_as_next, synchronized with the frontier by update_allowed_as_next()
+        self.flagged_allowed_edit_idxs = set(idx for idx, edit in self.edit_by_idx.items() if edit["allowed_as_next"])
 
     def get_edit(self, idx):
         """
         Return edit hunk with specific index from the commit snapshot.
         """
-        for file_path, file_snapshot in self.commit_snapshots.items():
-            for window in file_snapshot:
-                if isinstance(window, dict) and window["idx"] == idx:
-                    return window
-        
-        raise ValueError(f"Edit with index {idx} not found in commit snapshot.")
+        edit = self.edit_by_idx.get(idx)
+        if edit is None:
+            raise ValueError(f"Edit with index {idx} not found in commit snapshot.")
+        return edit
     
     def get_edits(self):
         """
         Return all edits from the commit snapshot.
         """
-        edits = []
-        for file_path, file_snapshot in self.commit_snapshots.items():
-            for window in file_snapshot:
-                if isinstance(window, dict):
-                    edits.append(window)
-        return edits
+        return list(self.edits)
     
     def update_edit_status(self, idx, status_name, status):
         """
@@ -69,30 +273,49 @@ class Commit:
         assert status_name in ["simulated", "allowed_as_next"], f"Invalid status name: {status_name}. Must be 'simulated' or 'allowed_as_next'."
         edit = self.get_edit(idx)
         edit[status_name] = status
-        if status_name == "simulated" and status == True:
+        if status_name == "allowed_as_next":
+            if status:
+                self.flagged_allowed_edit_idxs.add(idx)
+            else:
+                self.flagged_allowed_edit_idxs.discard(idx)
+        elif status == True:
             self.simulation_order.append(idx)
+            # Move the frontier across the newly simulated edit
+            self.simulated_edit_idxs.add(idx)
+            self.allowed_next_edit_frontier.discard(idx)
+            self.allowed_next_edit_frontier.update(tgt for tgt in self.successors[idx] if tgt not in self.simulated_edit_idxs)
+            file_path, widx = self.edit_pieces[idx]
+            self.versions[file_path].apply(widx, edit["after"])
+            self.dirty_files.add(file_path)
+        else:
+            self.build_edit_index()
 
     def update_allowed_as_next(self):
         """
         Update the allowed next edit status based on the last edit index.
+        Only the edits entering or leaving the frontier are updated.
         """
         print("[WARNING:SIM] The criterion for allowed subsequent edit is undetermined.")
-        edits = self.get_edits()
-        simulated_edit_idxs = [edit["idx"] for edit in edits if edit["simulated"]]
-
-        for edit in edits:
-            self.update_edit_status(edit["idx"], "allowed_as_next", False)
+        # Only nodes neighboring simulated edits and have not been simulated yet are allowed as next
+        for idx in self.flagged_allowed_edit_idxs - self.allowed_next_edit_frontier:
+            self.update_edit_status(idx, "allowed_as_next", False)
+        for idx in self.allowed_next_edit_frontier - self.flagged_allowed_edit_idxs:
+            self.update_edit_status(idx, "allowed_as_next", True)
 
-        for edge in self.partial_orders:
-            # Only nodes neighboring simulated edits and have not been simulated yet are allowed as next
-            if edge["src"] in simulated_edit_idxs and edge["tgt"] not in simulated_edit_idxs:
-                self.update_edit_status(edge["tgt"], "allowed_as_next", True)
+    def get_allowed_next_edit_idxs(self):
+        """
+        Return the indexes of edits allowed as next, in ascending order (the order of the commit snapshot).
+        """
+        return sorted(self.flagged_allowed_edit_idxs)
 
-        all_not_allowed = True
-        for edit in edits:
-            if edit["allowed_as_next"]:
-                all_not_allowed = False
-                break
+    def choose_edit(self, edit_idxs):
+        """
+        Pick one of the edit indexes at random. A rollout draws from a generator seeded by the rollout
+        and the number of simulated edits, hence replays the same flow, also when resumed.
+        """
+        if self.rollout is None:
+            return random.choice(edit_idxs)
+        return random.Random(f"{self.commit_url}-{self.rollout}-{len(self.simulation_order)}").choice(edit_idxs)
 
     def get_partial_order_graph(self):
         """
@@ -107,40 +330,72 @@ class Commit:
         """
         Print the simulation status of the commit.
         """
-        edits = self.get_edits()
-        allowed_next_edit_idxs = [edit["idx"] for edit in edits if edit["allowed_as_next"] == True]
-        future_edit_idxs = [edit["idx"] for edit in edits if edit["simulated"] == False and edit["allowed_as_next"] == False]
+        allowed_next_edit_idxs = self.get_allowed_next_edit_idxs()
+        future_edit_idxs = [edit["idx"] for edit in self.edits if edit["idx"] not in self.simulated_edit_idxs and edit["idx"] not in self.flagged_allowed_edit_idxs]
 
         print(f"[MESSAGE:SIM] Simulated edits:    {self.simulation_order}")
         print(f"[MESSAGE:SIM] Allowed next edits: {allowed_next_edit_idxs}")
         print(f"[MESSAGE:SIM] Future edits:       {future_edit_idxs}")
 
-    def get_current_version(self):
+    def get_current_version(self, file_paths=None):
         """
-        Return the current version of the commit.
+        Return the current version of the commit, restricted to file_paths if given.
+        The line lists are shared with the piece tables, they must not be modified.
         """
-        current_version = {}
-        for file_path, file_snapshot in self.commit_snapshots.items():
-            current_version[file_path] = []
-            for window in file_snapshot:
-                if isinstance(window, dict):
-                    if window["simulated"]:
-                        current_version[file_path].extend(window["after"])
-                    else:
-                        current_version[file_path].extend(window["before"])
-                else:
-                    current_version[file_path].extend(window)
-        
-        return current_version
+        if file_paths is None:
+            file_paths = self.versions.keys()
+        return {file_path: self.versions[file_path].lines() for file_path in file_paths}
+
+    def hash_file_on_disk(self, file_path):
+        """
+        Return the sha1 of the content on disk of a file of the commit in the worktree, None if it does not exist.
+        """
+        try:
+            with open(os.path.join(self.repo_dir, file_path), "rb") as f:
+                return hashlib.sha1(f.read()).hexdigest()
+        except FileNotFoundError:
+            return None
+
+    def detect_dirty_files(self):
+        """
+        Mark the files whose content on disk is no longer the one last synced as dirty, e.g. modified by the system
+        under test, whether or not it reports them. Files never synced are dirty already.
+        """
+        for file_path, synced_hash in self.synced_hashes.items():
+            if file_path not in self.dirty_files and self.hash_file_on_disk(file_path) != synced_hash:
+                self.dirty_files.add(file_path)
+
+    def mark_synced(self, file_paths):
+        """
+        Remember the content on disk of files just written by sync, to detect later changes.
+        """
+        for file_path in file_paths:
+            self.synced_hashes[file_path] = self.hash_file_on_disk(file_path)
+
+    def take_dirty_files(self):
+        """
+        Return the files to write to sync the project with the current version, and consider them synced.
+        """
+        dirty_files = sorted(self.dirty_files)
+        self.dirty_files.clear()
+        self.unseen_changed_files.update(dirty_files)
+        return dirty_files
+
+    def take_changed_files(self):
+        """
+        Return the files written since the previous call, to let the system under test invalidate its caches.
+        """
+        changed_files = sorted(self.unseen_changed_files)
+        self.unseen_changed_files.clear()
+        return changed_files
     
     def get_prior_edits(self):
         """
         Return simulated edits as prior edits of this simulation.
         """
-        edits = self.get_edits()
         prior_edits = []
         for simulated_edit_idx in self.simulation_order:
-            prior_edits.append(edits[simulated_edit_idx])
+            prior_edits.append(self.edit_by_idx[simulated_edit_idx])
 
         return prior_edits
     
@@ -148,85 +403,53 @@ class Commit:
         """
         Return snapshot contains only the not simulated edits
         """
-        allowed_next_edit_snapshots = {}
-        for file_path, file_snapshot in self.commit_snapshots.items():
-            allowed_next_edit_snapshots[file_path] = []
-            for window in file_snapshot:
-                if isinstance(window, dict) and not window["simulated"]:
-                    allowed_next_edit_snapshots[file_path].append(window)
-                else:
-                    if isinstance(window, dict):
-                        to_extend_window = window["after"].copy()
-                    else:
-                        to_extend_window = window.copy()
-
-                    if len(allowed_next_edit_snapshots[file_path]) > 0 and isinstance(allowed_next_edit_snapshots[file_path][-1], list):
-                        allowed_next_edit_snapshots[file_path][-1].extend(to_extend_window)
-                    else:
-                        allowed_next_edit_snapshots[file_path].append(to_extend_window)
-
-        return allowed_next_edit_snapshots
+        return {
+            file_path: version.split_view(lambda window: not window["simulated"])
+            for file_path, version in self.versions.items()
+        }
 
     def save_simulation_results(self):
-        with open(os.path.join(OUTPUT_DIR, f"{self.project_name}-{self.commit_sha}-{self.system_under_test}-simulation-results.json"), "w") as f:
-            json.dump({
-                "commit_sha": self.commit_sha,
-                "project_name": self.project_name,
-                "repo_dir": self.repo_dir,
-                "commit_url": self.commit_url,
-                "commit_message": self.commit_message,
-                "commit_snapshots": self.commit_snapshots,
-                "partial_orders": self.partial_orders,
-                "simulation_order": self.simulation_order,
-                "SUT_prediction_records": self.SUT_prediction_records
-            }, f, indent=4)
+        """
+        Save the prediction data of this simulation. The commit snapshots and partial orders are kept once
+        in the artifacts of the commit, load_simulation_results() attaches them back.
+        """
+        write_json_atomic(self.record_fp, {
+            "commit_sha": self.commit_sha,
+            "project_name": self.project_name,
+            "repo_dir": self.repo_path,
+            "commit_url": self.commit_url,
+            "artifact_key": self.artifact_key,
+            "simulation_order": self.simulation_order,
+            "SUT_prediction_records": [
+                {key: value for key, value in record.items() if key not in ["gdth_snapshots", "partial_order_graph"]}
+                for record in self.SUT_prediction_records
+            ]
+        })
+        if os.path.exists(self.progress_fp):
+            os.remove(self.progress_fp)
 
     def get_next_edit_snapshots(self, next_edit_idx):
-        next_edit_snapshots = {}
-        for file_path, snapshot in self.commit_snapshots.items():
-            next_edit_snapshots[file_path] = []
-            for window in snapshot:
-                if isinstance(window, list):
-                    if len(next_edit_snapshots[file_path]) == 0 or isinstance(next_edit_snapshots[file_path][-1], dict):
-                        next_edit_snapshots[file_path].append(window.copy())
-                    else:
-                        next_edit_snapshots[file_path][-1].extend(window.copy())
-                elif isinstance(window, dict) and window["idx"] != next_edit_idx:
-                    if len(next_edit_snapshots[file_path]) == 0:
-                        if window["simulated"]:
-                            next_edit_snapshots[file_path].append(window["after"].copy())
-                        else:
-                            next_edit_snapshots[file_path].append(window["before"].copy())
-                    else:
-                        assert isinstance(next_edit_snapshots[file_path][-1], list)
-                        if window["simulated"]:
-                            next_edit_snapshots[file_path][-1].extend(window["after"].copy())
-                        else:
-                            next_edit_snapshots[file_path][-1].extend(window["before"].copy())
-                elif isinstance(window, dict) and window["idx"] == next_edit_idx:
-                    next_edit_snapshots[file_path].append(window.copy())
-
-        return next_edit_snapshots
+        """
+        Return snapshot of the current version contains only the next edit
+        """
+        return {
+            file_path: version.split_view(lambda window: window["idx"] == next_edit_idx)
+            for file_path, version in self.versions.items()
+        }
 
     def get_previously_applied_locations(self):
         """
         Return the locations of previously applied edits.
         """
         previously_applied_locations = []
-        for file_path, snapshot in self.commit_snapshots.items():
-            line_idx = 0
-            for window in snapshot:
-                if isinstance(window, list):
-                    line_idx += len(window)
-                else:
-                    if window["simulated"]:
-                        previously_applied_locations.append({
-                            "idx": window["idx"],
-                            "file_path": file_path,
-                            "atLines": [line_idx + i for i in range(len(window["after"]))]
-                        })
-                        line_idx += len(window["after"])
-                    else:
-                        line_idx += len(window["before"])
-
-        return previously_applied_locations
\ No newline at end of file
+        # Edit indexes follow the order of the commit snapshot
+        for idx in sorted(self.simulated_edit_idxs):
+            file_path, widx = self.edit_pieces[idx]
+            line_idx = self.versions[file_path].offset(widx)
+            previously_applied_locations.append({
+                "idx": idx,
+                "file_path": file_path,
+                "atLines": [line_idx + i for i in range(len(self.edit_by_idx[idx]["after"]))]
+            })
+
+        return previously_applied_locations
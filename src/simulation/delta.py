@@ -0,0 +1,57 @@
+def get_edit_status(snapshots):
+    """
+    Return {edit idx: [simulated, allowed_as_next]} of the edits in the snapshots.
+    """
+    edit_status = {}
+    for file_path, snapshot in snapshots.items():
+        for window in snapshot:
+            if isinstance(window, dict):
+                edit_status[window["idx"]] = [window["simulated"], window["allowed_as_next"]]
+    return edit_status
+
+def encode_delta_response(response_message, delta_state):
+    """
+    Encode a simulation response against what has already been sent to the client of the same session.
+
+    The ground truth snapshots and the partial order graph only change in the status of their edits,
+    hence they are sent in full by the first response of a session only. Every response then carries
+    `edit_status_delta`, the edits whose status changed since the previous response, which the client
+    applies to both its ground truth snapshots and the nodes of its partial order graph (the nodes are the
+    edits of the ground truth snapshots). `curr_gdth_snapshots`, the ground truth restricted to the edits
+    not simulated before this step, is replaced by `curr_gdth_edit_idxs`; those edits carry the status of the
+    previous response.
+
+    Args:
+        response_message: dict, the response of main()
+        delta_state: dict | None, the state returned by the previous call for this session, None for the first response
+    Returns:
+        encoded_response: dict, the response to send
+        delta_state: dict, the state to pass to the next call for this session
+    """
+    edit_status = get_edit_status(response_message["gdth_snapshots"])
+    encoded_response = {
+        key: value for key, value in response_message.items()
+        if key not in ["gdth_snapshots", "partial_order_graph", "curr_gdth_snapshots"]
+    }
+    if delta_state is None:
+        encoded_response["gdth_snapshots"] = response_message["gdth_snapshots"]
+        encoded_response["partial_order_graph"] = response_message["partial_order_graph"]
+        changed_edit_status = {}
+    else:
+        changed_edit_status = {
+            idx: status for idx, status in edit_status.items()
+            if delta_state["edit_status"].get(idx) != status
+        }
+
+    encoded_response["edit_status_delta"] = {
+        str(idx): {"simulated": simulated, "allowed_as_next": allowed_as_next}
+        for idx, (simulated, allowed_as_next) in changed_edit_status.items()
+    }
+    if "curr_gdth_snapshots" in response_message:
+        encoded_response["curr_gdth_edit_idxs"] = [
+            window["idx"]
+            for file_path, snapshot in response_message["curr_gdth_snapshots"].items()
+            for window in snapshot if isinstance(window, dict)
+        ]
+    encoded_response["delta"] = True
+    return encoded_response, {"edit_status": edit_status}
@@ -1,7 +1,9 @@
 import os
-import subprocess
 
 from .utils import *
+from .lsp_pool import LSP_POOL
+
+LSP_BATCHED = (os.getenv("LSP_BATCHED") or "1") != "0" # send the queries of apply_LSP up front instead of one by one
 
 def get_all_identifiers(tree):
     """
@@ -132,37 +134,99 @@ def filter_identifiers(identifiers, hunk_ranges, file_path):
                 filtered_identifiers.append(identifier)
     return filtered_identifiers
 
-def apply_LSP(workspace_dir, commit_snapshots, language, version):
-    import sys
-    curr_file_dir = os.path.dirname(os.path.abspath(__file__))
-    sys.path.append(os.path.join(curr_file_dir, ".."))
-    if language == "java":
-        from libs.LSPs.java_lsp import JavaLanguageServer
-        LSP = JavaLanguageServer(log=False)
-    elif language == "python":
-        from libs.LSPs.py_lsp import PyLanguageServer
-        LSP = PyLanguageServer(log=False)
-    elif language == "go":
-        from libs.LSPs.go_lsp import GoLanguageServer
-        LSP = GoLanguageServer(log=False)
-    elif language == "javascript":
-        from libs.LSPs.jsts_lsp import TsLanguageServer
-        LSP = TsLanguageServer("javascript", log=False)
-    elif language == "typescript":
-        from libs.LSPs.jsts_lsp import TsLanguageServer
-        LSP = TsLanguageServer("typescript", log=False)
-    else:
-        raise ValueError(f"Unsupported language: {language}")
+def get_LSP_position(identifier):
+    return {"line": identifier["position"]["start"]["line"], "character": (identifier["position"]["start"]["column"] + identifier["position"]["end"]["column"]) // 2}
+
+def match_definition(def_response, identifier, all_identifiers, abs_file_paths):
+    """
+    Match the definition response of an identifier with the identifiers in the hunks.
     
-    LSP.initialize(workspace_dir)
+    Returns:
+        is_ambiguous: bool, whether the identifier has multiple definitions inside the project
+        matched_identifier: dict | None, the identifier in the hunks defining it, if any
+    """
+    if def_response == [] or def_response[0]["result"] is None:
+        return False, None
+    def_results = def_response[0]["result"]
     
+    # check if there are multiple definitions inside the project (exclude those outside the project)
+    def_results_inside_project = []
+    for def_result in def_results:
+        if def_result["uri"][7:] in abs_file_paths:
+            def_results_inside_project.append(def_result)
+    if len(def_results_inside_project) > 1:
+        # multiple definitions can not simply determine the relation between definition and reference
+        # print(f"Multiple definitions found for {identifier['identifier']} in {identifier['abs_file_path']}")
+        return True, None
+    for def_result in def_results_inside_project:
+        # match with filtered identifiers
+        for filtered_identifier in all_identifiers:
+            if def_result["uri"][7:] == filtered_identifier["abs_file_path"] and \
+                identifier["identifier"] == filtered_identifier["identifier"] and \
+                def_result["range"]["start"]["line"] == filtered_identifier["position"]["start"]["line"]:
+                # sometimes, lsp can locate the correct line, but may not very accurate about the column, so here we only check the line
+                return False, filtered_identifier
+    return False, None
+
+def get_LSP_responses(LSP, request_ids):
+    """
+    Collect the responses of requests in flight, in the order they were sent.
+    Each response is given the timeout of one request, as if the requests were sent one by one.
+    """
+    return [LSP.get_responses([request_id])[0] for request_id in request_ids]
+
+def apply_LSP(workspace_dir, commit_snapshots, language, versions=("base", "head"), batched=LSP_BATCHED, project_dir=None):
+    """
+    Find the dependency edges between hunks from the definitions and references of their identifiers.
+    
+    The files of the commit are sent to one language server with the text of each version in turn, the other
+    files of the workspace are the same in both versions. Hence the workspace can be at either version, and
+    switching versions needs no checkout.
+    
+    Args:
+        workspace_dir: str, the project, at the base or head version
+        commit_snapshots: dict, the commit snapshots
+        language: str, the language of the project
+        versions: tuple[str], the versions to analyze, among "base" and "head"
+        batched: bool, whether to send the definition queries of all identifiers up front, then the references
+            queries of those resolved inside the project, instead of waiting for each query in turn
+        project_dir: str, the project workspace_dir is a worktree of, whose warm language server can be reused
+    
+    Returns:
+        dep_edges: dict, the dependency edges between different hunks of each version, [] if the language server timed out
+    """
+    dep_edges = {}
+    LSP = None
+    try:
+        for version in versions:
+            try:
+                if LSP is None:
+                    LSP = LSP_POOL.acquire(language, workspace_dir, project_dir)
+                dep_edges[version] = find_dependency_edges(LSP, workspace_dir, commit_snapshots, language, version, batched)
+            except TimeoutError:
+                dep_edges[version] = []
+                # Analyze the next version with another server
+                if LSP is not None:
+                    LSP_POOL.release(LSP, healthy=False)
+                    LSP = None
+    except BaseException:
+        if LSP is not None:
+            LSP_POOL.release(LSP, healthy=False)
+        raise
+    if LSP is not None:
+        LSP_POOL.release(LSP)
+    return dep_edges
+
+def find_dependency_edges(LSP, workspace_dir, commit_snapshots, language, version, batched):
     # STEP 1. Use Tree-sitter to parse all identifiers in the hunks
     all_identifiers = []
     abs_file_paths = []
     for file_path, snapshot in commit_snapshots.items():
         absolute_file_path = os.path.join(workspace_dir, file_path)
         abs_file_paths.append(absolute_file_path)
-        LSP.did_open(absolute_file_path)
+        # Open the file with the content of this version, or replace the content of the other version
+        code = "".join(get_version(snapshot, "parent" if version == "base" else "child"))
+        LSP.sync_file(absolute_file_path, code)
         hunk_ranges = []
         for hunk in snapshot:
             if isinstance(hunk, list):
@@ -180,18 +244,30 @@ def apply_LSP(workspace_dir, commit_snapshots, language, version):
                     "end": hunk["child_version_range"]["end"]
                 })
         # parse the file, keep the identifiers in the range
-        with open(absolute_file_path, "r") as f:
-            code = f.read()
         tree = parse(code, language)
         identifiers = get_all_identifiers(tree)
         filered_identifiers = filter_identifiers(identifiers, hunk_ranges, absolute_file_path)
         all_identifiers.extend(filered_identifiers)
 
     # print(f"All identifiers: {len(all_identifiers)}")
+    if batched:
+        # All files are opened above and not changed since, so the queries are pipelined without syncing the files.
+        # Responses do not depend on the order of the queries, hence STEP 2 below gets the same responses,
+        # some references are only queried for identifiers it will skip as already checked.
+        def_request_ids = [LSP.send_definitions(identifier["abs_file_path"], get_LSP_position(identifier)) for identifier in all_identifiers]
+        def_responses = get_LSP_responses(LSP, def_request_ids)
+        ref_identifier_idxs = []
+        for identifier_idx, (identifier, def_response) in enumerate(zip(all_identifiers, def_responses)):
+            is_ambiguous, matched_identifier = match_definition(def_response, identifier, all_identifiers, abs_file_paths)
+            if not is_ambiguous and (matched_identifier is not None or identifier["kind"] == "import"):
+                ref_identifier_idxs.append(identifier_idx)
+        ref_request_ids = [LSP.send_references(all_identifiers[identifier_idx]["abs_file_path"], get_LSP_position(all_identifiers[identifier_idx])) for identifier_idx in ref_identifier_idxs]
+        ref_responses = dict(zip(ref_identifier_idxs, get_LSP_responses(LSP, ref_request_ids)))
+    
     # STEP 2. Use LSP to get all identifier dependencies
     dep_edges = []
     skippable_identifiers = []
-    for identifier in all_identifiers:
+    for identifier_idx, identifier in enumerate(all_identifiers):
         definition = None
         reference = None
         if identifier['identifier'] in skippable_identifiers:
@@ -204,40 +280,20 @@ def apply_LSP(workspace_dir, commit_snapshots, language, version):
         
         # First find the definition of the identifier
         # >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
-        try:
-            location = {"line": identifier["position"]["start"]["line"], "character": (identifier["position"]["start"]["column"] + identifier["position"]["end"]["column"]) // 2}
-            def_response = LSP.definitions(identifier["abs_file_path"], location)
-        except TimeoutError:
-            return []
-        # print(f"Definition Response: \n{def_response}", location)
+        if batched:
+            def_response = def_responses[identifier_idx]
+        else:
+            def_response = LSP.definitions(identifier["abs_file_path"], get_LSP_position(identifier))
+        # print(f"Definition Response: \n{def_response}", get_LSP_position(identifier))
         
-        if def_response != [] and def_response[0]["result"] is not None:
-            # Here we dont reverse the condition to do continue, because we still have to decide if this identifier is an import statement
-            def_results = def_response[0]["result"]
-            
-            # check if there are multiple definitions inside the project (exclude those outside the project)
-            def_results_inside_project = []
-            for def_result in def_results:
-                if def_result["uri"][7:] in abs_file_paths:
-                    def_results_inside_project.append(def_result)
-            if len(def_results_inside_project) > 1:
-                # multiple definitions can not simply determine the relation between definition and reference
-                # print(f"Multiple definitions found for {identifier['identifier']} in {identifier['abs_file_path']}")
-                continue
-            for def_result in def_results_inside_project:
-                if def_result["uri"][7:] not in abs_file_paths:
-                    continue
-                else:
-                    # match with filtered identifiers
-                    for filtered_identifier in all_identifiers:
-                        if def_result["uri"][7:] == filtered_identifier["abs_file_path"] and \
-                            identifier["identifier"] == filtered_identifier["identifier"] and \
-                            def_result["range"]["start"]["line"] == filtered_identifier["position"]["start"]["line"]:
-                            # sometimes, lsp can locate the correct line, but may not very accurate about the column, so here we only check the line
-                            filtered_identifier["dependency_checked"] = True
-                            definition = filtered_identifier.copy()
-                            # print(f"Definition: {definition}")
-                            break
+        # Here we dont continue when there is no definition, because we still have to decide if this identifier is an import statement
+        is_ambiguous, matched_identifier = match_definition(def_response, identifier, all_identifiers, abs_file_paths)
+        if is_ambiguous:
+            continue
+        if matched_identifier is not None:
+            matched_identifier["dependency_checked"] = True
+            definition = matched_identifier.copy()
+            # print(f"Definition: {definition}")
         
         if definition is None and identifier["kind"] != "import": 
             # if this identifier is not defined in the codebase, skip
@@ -251,10 +307,10 @@ def apply_LSP(workspace_dir, commit_snapshots, language, version):
 
         # Then find the reference of the identifier
         # >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
-        try:
-            ref_response = LSP.references(identifier["abs_file_path"], {"line": identifier["position"]["start"]["line"], "character": (identifier["position"]["start"]["column"] + identifier["position"]["end"]["column"]) // 2})
-        except TimeoutError:
-            return []
+        if batched:
+            ref_response = ref_responses[identifier_idx]
+        else:
+            ref_response = LSP.references(identifier["abs_file_path"], get_LSP_position(identifier))
         
         if ref_response == [] or "result" not in ref_response[0] or ref_response[0]["result"] is None:
             # print(f"Reference Response is empty")
@@ -367,8 +423,6 @@ def apply_LSP(workspace_dir, commit_snapshots, language, version):
         else:
             filtered_dep_edges.append(dep_edge)
     
-    LSP.close()
-    
     return filtered_dep_edges
 
 def analyze_dependency(COMMIT, to_remove_consistent_edges=False):
@@ -381,47 +435,21 @@ def analyze_dependency(COMMIT, to_remove_consistent_edges=False):
     """
     print("[WARNING:SIM] Assume simulated commit is a python project.")
     language = "python"
-    commit_sha = COMMIT.commit_sha
     
     # STEP 1. Analyze Import-use case and dependency case
-    # STEP 1.1. Extract the dependency graph of the codebase at commit base version
-    # First clean the untracked files
+    # The base and head versions of the edited files are sent from the snapshots to the language server,
+    # so the worktree is neither cleaned nor checked out, and stays at the version it was created at
     workspace_dir = COMMIT.repo_dir
-
-    result = subprocess.run(
-        ["git", "clean", "-fd"],
-        cwd=workspace_dir,
-        capture_output=True,
-        text=True
-    )
-    if result.returncode != 0:
-        raise RuntimeError(f"Git clean failed:\n{result.stderr}")
+    dep_edges = apply_LSP(workspace_dir, COMMIT.commit_snapshots, language, versions=("base", "head"), project_dir=COMMIT.repo_path)
     
-    # Then force switch commit
-    result = subprocess.run(
-        ["git", "checkout", "-f", f"{commit_sha}^"],
-        cwd=workspace_dir,
-        capture_output=True,
-        text=True
-    )
-    if result.returncode != 0:
-        raise RuntimeError(f"Git checkout failed:\n{result.stderr}")
-    
-    base_hunk_dependency_edges = apply_LSP(workspace_dir, COMMIT.commit_snapshots, language, version="base")
+    # STEP 1.1. Extract the dependency graph of the codebase at commit base version
+    base_hunk_dependency_edges = dep_edges["base"]
     print(f"[MESSAGE:SIM] Base hunk dependency edges: {len(base_hunk_dependency_edges)}")
     for edge in base_hunk_dependency_edges:
         print(f"\t>> Dependency: {edge['callee_hunk_idx']} --- depeneded by ---> {edge['caller_hunk_idx']}, is import use: {edge['is_import_use']}, reason: share identifier {edge['callee_detail']['identifier']}")
     
     # STEP 1.2. Extract the dependency graph of the codebase at commit head version
-    # First clean the untracked files
-    clean_command = ["git", "-C", workspace_dir, "clean", "-fd"]
-    subprocess.run(clean_command, shell=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-    # Then force switch commit
-    command = ["git", "-C", workspace_dir, "checkout", "-f", f"{commit_sha}"]
-    subprocess.run(command, shell=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    
-    head_hunk_dependency_edges = apply_LSP(workspace_dir, COMMIT.commit_snapshots, language, version="head")
+    head_hunk_dependency_edges = dep_edges["head"]
     print(f"[MESSAGE:SIM] Head hunk dependency edges: {len(head_hunk_dependency_edges)}")
     for edge in head_hunk_dependency_edges:
         print(f"\t>> Dependency: {edge['callee_hunk_idx']} --- depeneded by ---> {edge['caller_hunk_idx']}, is import use: {edge['is_import_use']}, reason: share identifier {edge['callee_detail']['identifier']}")
@@ -1,6 +1,6 @@
 import os
 import json
-from .main import main
+from .main import main, SESSIONS
 if __name__ == "__main__":
     to_simulate_fps = [
         "simulation/manual_dataset/pytorch_geometric-60c2c29c9bc80e722e13f1ddf57db949f5ec944.json",
@@ -59,22 +59,25 @@ if __name__ == "__main__":
         with open(filepath, "r") as f:
             data = json.load(f)
         print(f"Simulation commit: {data['commit_url']}")
-        edit_hunk_num = 0
-        for edit_file_path, snapshot in data["commit_snapshots"].items():
-            for window in snapshot:
-                if isinstance(window, dict):
-                    edit_hunk_num += 1
+        input = {
+            "commit_url": data["commit_url"],
+            "system_under_test": sut,
+            "status": "init",
+            "suggestion_type": "naive"
+        }
+        response = main(input)
+        session_id = response["session_id"]
 
-        for i in range(edit_hunk_num):
-            if i == 0:
-                status = "init"
-            else:
-                status = "suggestion"
-
-            input = {
-                "commit_url": data["commit_url"],
-                "system_under_test": sut,
-                "status": status,
-                "suggestion_type": "naive"
-            }
-            main(input)
+        try:
+            # A resumed simulation starts from its last finished step, hence loop until done instead of counting edits
+            while response["status"] != "done":
+                input = {
+                    "commit_url": data["commit_url"],
+                    "system_under_test": sut,
+                    "status": "suggestion",
+                    "suggestion_type": "naive",
+                    "session_id": session_id
+                }
+                response = main(input)
+        finally:
+            SESSIONS.remove(session_id)
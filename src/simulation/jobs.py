@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import uuid
+import threading
+import traceback
+import concurrent.futures
+
+from dotenv import load_dotenv
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+root_path = os.path.abspath(os.path.join(current_path, "../../"))
+load_dotenv(dotenv_path=os.path.join(root_path, ".config"))
+SIMULATION_WORKERS = int(os.getenv("SIMULATION_WORKERS") or 4) # number of simulation steps running at the same time
+JOB_TTL = float(os.getenv("JOB_TTL") or 3600) # seconds a finished job is kept for polling
+KEEP_ALIVE_INTERVAL = 15 # seconds between keep-alive comments of an idle event stream
+
+class Job:
+    def __init__(self, job_id, json_input):
+        self.job_id = job_id
+        self.json_input = json_input
+        self.status = "queued" # one of ["queued", "running", "done", "failed"]
+        self.events = []
+        self.result = None
+        self.error = None
+        self.finished_at = None
+        self.condition = threading.Condition()
+
+    def emit(self, stage, data=None):
+        """
+        Append a stage event and wake up the clients waiting for new events.
+        """
+        with self.condition:
+            self.events.append({
+                "seq": len(self.events),
+                "stage": stage,
+                "time": time.time(),
+                "data": data if data is not None else {}
+            })
+            self.condition.notify_all()
+
+    def finish(self, status, result=None, error=None):
+        """
+        Set the final status of the job and append its terminal event (`done` or `failed`) at once,
+        so that a client never sees a finished job without its terminal event.
+        """
+        with self.condition:
+            self.result = result
+            self.error = error
+            self.status = status
+            self.finished_at = time.monotonic()
+            self.emit(status, {"error": error} if status == "failed" else None)
+
+    def snapshot(self, with_result=True):
+        with self.condition:
+            job_info = {
+                "job_id": self.job_id,
+                "status": self.status,
+                "events": list(self.events),
+            }
+            if with_result and self.status == "done":
+                job_info["result"] = self.result
+            if self.status == "failed":
+                job_info["error"] = self.error
+            return job_info
+
+    def wait_events(self, start, timeout):
+        """
+        Block until there are events after `start` or the job is finished, return the new events.
+        """
+        with self.condition:
+            if len(self.events) <= start and self.status in ["queued", "running"]:
+                self.condition.wait(timeout)
+            return self.events[start:], self.status in ["done", "failed"]
+
+def parse_last_event_id(last_event_id):
+    """
+    Return the seq of the first event to stream after the Last-Event-ID header, 0 if it is missing or malformed.
+    """
+    try:
+        return max(int(last_event_id if last_event_id is not None else -1) + 1, 0)
+    except ValueError:
+        return 0
+
+def stream_events(job, start, stream_timeout, keep_alive_interval=KEEP_ALIVE_INTERVAL):
+    """
+    Yield the events of the job from seq `start` as Server-Sent Events, the `done` event carries the result.
+    The stream ends after the terminal event (`done` or `failed`), or after stream_timeout seconds,
+    then the client reconnects with the Last-Event-ID header.
+    """
+    deadline = time.monotonic() + stream_timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        events, finished = job.wait_events(start, timeout=min(keep_alive_interval, remaining))
+        if not events and not finished:
+            yield ": keep-alive\n\n"
+            continue
+        for event in events:
+            data = dict(event)
+            if event["stage"] == "done":
+                data["result"] = job.snapshot()["result"]
+            yield f"id: {event['seq']}\nevent: {event['stage']}\ndata: {json.dumps(data)}\n\n"
+            if event["stage"] in ["done", "failed"]:
+                return
+        start += len(events)
+        if finished and not events:
+            # The terminal event was already sent, before the client reconnected
+            break
+
+class JobManager:
+    """
+    Run simulation steps on a worker pool, so that HTTP requests only submit and poll jobs.
+    """
+    def __init__(self, runner, max_workers=SIMULATION_WORKERS, ttl=JOB_TTL):
+        self.runner = runner
+        self.ttl = ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="simulation-job")
+
+    def submit(self, json_input):
+        job = Job(uuid.uuid4().hex, json_input)
+        with self._lock:
+            self._prune()
+            self._jobs[job.job_id] = job
+        job.emit("queued")
+        self._executor.submit(self._run, job)
+        return job.job_id
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            raise KeyError(f"Job {job_id} does not exist or has expired.")
+        return job
+
+    def _run(self, job):
+        with job.condition:
+            job.status = "running"
+        job.emit("started")
+        try:
+            result = self.runner(job.json_input, progress_callback=job.emit)
+        except Exception as e:
+            traceback.print_exc()
+            job.finish("failed", error=str(e))
+            return
+        job.finish("done", result=result)
+
+    def _prune(self):
+        # Must be called with self._lock held
+        now = time.monotonic()
+        for job_id, job in list(self._jobs.items()):
+            if job.finished_at is not None and now - job.finished_at > self.ttl:
+                del self._jobs[job_id]
@@ -0,0 +1,152 @@
+import os
+import sys
+import atexit
+import threading
+
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+root_path = os.path.abspath(os.path.join(current_path, "../../"))
+load_dotenv(dotenv_path=os.path.join(root_path, ".config"))
+LSP_POOL_SIZE = int(os.getenv("LSP_POOL_SIZE") or 2) # number of idle language servers kept warm per process
+LSP_MAX_USES = int(os.getenv("LSP_MAX_USES") or 20) # number of dependency analyses a language server serves before it is restarted
+LSP_HEALTH_TIMEOUT = float(os.getenv("LSP_HEALTH_TIMEOUT") or 2) # seconds a pooled language server has to answer the health check before reuse
+
+def start_language_server(language):
+    """
+    Start the language server of the given language, not yet initialized.
+    """
+    sys.path.append(os.path.join(current_path, ".."))
+    if language == "java":
+        from libs.LSPs.java_lsp import JavaLanguageServer
+        return JavaLanguageServer(log=False)
+    elif language == "python":
+        from libs.LSPs.py_lsp import PyLanguageServer
+        return PyLanguageServer(log=False)
+    elif language == "go":
+        from libs.LSPs.go_lsp import GoLanguageServer
+        return GoLanguageServer(log=False)
+    elif language == "javascript":
+        from libs.LSPs.jsts_lsp import TsLanguageServer
+        return TsLanguageServer("javascript", log=False)
+    elif language == "typescript":
+        from libs.LSPs.jsts_lsp import TsLanguageServer
+        return TsLanguageServer("typescript", log=False)
+    else:
+        raise ValueError(f"Unsupported language: {language}")
+
+class LanguageServerPool:
+    """
+    Initialized language servers kept warm between dependency analyses of the same process.
+
+    Idle servers are keyed by (language, project directory). A server is preferably reused for the same
+    workspace, e.g. the base then the head version of a commit in its worktree, otherwise its workspace
+    folder is switched to the worktree of another commit of the same project. Servers must answer a health
+    check request before reuse, hung or exited ones are closed. Servers are restarted after `max_uses` analyses,
+    and at most `size` idle servers are kept, the least recently used are closed first. A size of 0 closes
+    every server once released. All bookkeeping is done under `lock`, the pool is shared by the threads of a process.
+    """
+    def __init__(self, size=LSP_POOL_SIZE, max_uses=LSP_MAX_USES, health_timeout=LSP_HEALTH_TIMEOUT):
+        self.size = size
+        self.max_uses = max_uses
+        self.health_timeout = health_timeout
+        self.idle = OrderedDict() # server -> (key, workspace_dir), least recently released first
+        self.servers = {} # server -> {"key": key, "workspace_dir": workspace_dir, "uses": int}, for acquired and idle servers
+        self.lock = threading.Lock()
+
+    def acquire(self, language, workspace_dir, project_dir=None):
+        """
+        Return an initialized language server with workspace_dir as its only workspace folder and no opened file.
+        It must be given back with release().
+
+        Args:
+            language: str, the language of the project
+            workspace_dir: str, the directory to analyze
+            project_dir: str, the project the workspace belongs to, servers of the same project can switch
+                their workspace, default workspace_dir
+        """
+        key = (language, project_dir or workspace_dir)
+        with self.lock:
+            candidates = [server for server, (server_key, _) in self.idle.items() if server_key == key]
+            same_workspace = [server for server in candidates if self.idle[server][1] == workspace_dir]
+            server = (same_workspace or candidates or [None])[-1]
+            if server is not None:
+                del self.idle[server]
+
+        if server is not None and not server.is_responsive(self.health_timeout):
+            print(f"[WARNING:SIM] Pooled {language} language server exited or hung, starting a new one.")
+            self._close(server, graceful=False)
+            server = None
+
+        if server is None:
+            server = start_language_server(language)
+            server.initialize(workspace_dir)
+            with self.lock:
+                self.servers[server] = {"key": key, "workspace_dir": workspace_dir, "uses": 1}
+            return server
+
+        with self.lock:
+            previous_workspace_dir = self.servers[server]["workspace_dir"]
+            self.servers[server]["workspace_dir"] = workspace_dir
+            self.servers[server]["uses"] += 1
+        if previous_workspace_dir != workspace_dir:
+            server.change_workspace_folders(added=[workspace_dir], removed=[previous_workspace_dir])
+        return server
+
+    def release(self, server, healthy=True):
+        """
+        Give back a server acquired from the pool.
+
+        Args:
+            server: LanguageServer, the acquired server
+            healthy: bool, False if the server misbehaved, e.g. timed out, then it is closed
+        """
+        with self.lock:
+            uses = self.servers[server]["uses"]
+        if healthy and server.is_alive() and uses < self.max_uses:
+            try:
+                # The files on disk may change before the next use, e.g. the server moves to the worktree of another commit
+                server.close_all_files()
+                # Nobody reads the notifications of an idle server, drop them instead of letting the queue grow
+                server.drain_notifications()
+            except OSError:
+                healthy = False
+        else:
+            healthy = False
+
+        to_close = []
+        with self.lock:
+            if healthy and server in self.servers:
+                self.idle[server] = (self.servers[server]["key"], self.servers[server]["workspace_dir"])
+            else:
+                to_close.append(server)
+            while len(self.idle) > self.size:
+                to_close.append(self.idle.popitem(last=False)[0])
+        for server in to_close:
+            self._close(server)
+
+    def close(self):
+        """
+        Close all idle servers.
+        """
+        with self.lock:
+            to_close = list(self.idle)
+            self.idle.clear()
+        for server in to_close:
+            self._close(server)
+
+    def _close(self, server, graceful=True):
+        with self.lock:
+            self.servers.pop(server, None)
+        try:
+            if graceful and server.is_alive():
+                server.close()
+            else:
+                server.process.kill()
+                server.process.wait()
+        except Exception as e:
+            print(f"[WARNING:SIM] Failed to close language server: {e}")
+
+LSP_POOL = LanguageServerPool()
+atexit.register(LSP_POOL.close)
@@ -1,10 +1,15 @@
 import os
-import copy
 import json
 import random
 
+from collections import defaultdict
+
 from .utils import *
 from .commit import Commit
+from .artifacts import load_simulation_results
+from .session import SessionRegistry
+from .replay import ReplayStore, ReplayCursor
+from .delta import encode_delta_response
 from dotenv import load_dotenv
 from optimization.rerank import rerank
 
@@ -14,16 +19,59 @@ load_dotenv(dotenv_path=os.path.join(root_path, ".config"))
 REPOS_DIR = os.getenv("REPOS_DIR") # this directory should be the absolute path to the repository directory inside backend host
 OUTPUT_DIR = os.getenv("OUTPUT_DIR")
 os.makedirs(REPOS_DIR, exist_ok=True)
-COMMIT = None
+SESSIONS = SessionRegistry(on_evict=lambda session: session.commit.close()) # release the worktree of evicted sessions
+REPLAY = ReplayStore() # recorded simulations, replayed without rebuilding their Commit
 
-def main(json_input: dict):
-    global COMMIT
-    
+def main(json_input: dict, progress_callback=None):
+    """
+    Run one simulation step.
+
+    Args:
+        json_input: dict, with keys:
+            - commit_url: str, the url of the simulated commit
+            - system_under_test: str, the system under test
+            - status: str, one of ["init", "suggestion"]
+            - suggestion_type: str, the type of suggestion
+            - session_id: str, the session returned by the init step, required by the suggestion step
+            - delta: bool, optional, send the structures that do not change between steps only once per session, see encode_delta_response()
+            - rollout: int, optional, the seed of a reproducible rollout of the simulation, see Commit.choose_edit()
+        progress_callback: callable | None, called as progress_callback(stage, data) when a stage of this step finishes
+
+    Returns:
+        response_message: dict, the simulation result of this step, with the key "session_id" attached
+    """
     commit_url = json_input["commit_url"]
     system_under_test = json_input["system_under_test"]
     status = json_input["status"]
     suggestion_type = json_input["suggestion_type"]
     assert suggestion_type in ["Original suggestion", "Flow-aligned suggestion"]
+    if progress_callback is None:
+        progress_callback = lambda stage, data=None: None
+
+    # Recorded simulations are served step by step from the replay store
+    rollout = json_input.get("rollout")
+    if status == "init" and REPLAY.has(commit_url, system_under_test, rollout):
+        print("[MESSAGE:SIM] This commit has been simulated before. Returning the previous results.")
+        cursor = REPLAY.open_cursor(commit_url, system_under_test, rollout)
+        session_id = SESSIONS.create(cursor)
+        progress_callback("commit_prepared", {"session_id": session_id, "edit_num": len(cursor.record)})
+        session = SESSIONS.get(session_id)
+        with session.lock:
+            response_message = cursor.next_step()
+            if json_input.get("delta"):
+                response_message, session.delta_state = encode_delta_response(response_message, None)
+        return {**response_message, "session_id": session_id}
+
+    if status == "suggestion":
+        if json_input.get("session_id") is None:
+            raise ValueError("[ERROR:SIM] At src/simulation/main.py: main(), Missing session_id. Please run the init step first.")
+        session = SESSIONS.get(json_input["session_id"])
+        if isinstance(session.commit, ReplayCursor):
+            with session.lock:
+                response_message = session.commit.next_step()
+                if json_input.get("delta"):
+                    response_message, session.delta_state = encode_delta_response(response_message, session.delta_state)
+            return {**response_message, "session_id": session.session_id}
 
     if system_under_test == "CoEdPilot":
         import systemUnderTest.CoEdPilot.main as SUT
@@ -38,207 +86,274 @@ def main(json_input: dict):
 
     if status == "init":
         # Parse edit hunks and edit orders from given commit URL
-        COMMIT = Commit(commit_url, REPOS_DIR, system_under_test)
-
-        # If this commit under this system under test has been simulated before, return the previous results
-        if len(COMMIT.SUT_prediction_records) == len(COMMIT.get_edits()):
-            print("[MESSAGE:SIM] This commit has been simulated before. Returning the previous results.")
-            response_message = COMMIT.SUT_prediction_records[len(COMMIT.replay_progress)]
-            COMMIT.replay_progress.append(COMMIT.simulation_order[len(COMMIT.replay_progress)])
-            return response_message
-        
-        # Select init edit and update edits status
-        init_edit_idx = random.choice(COMMIT.allowed_next_edit_idxs)
-        COMMIT.update_edit_status(init_edit_idx, "simulated", True)
-        COMMIT.update_allowed_as_next()
+        COMMIT = Commit(commit_url, REPOS_DIR, system_under_test, rollout=rollout)
+        session_id = SESSIONS.create(COMMIT)
+        progress_callback("commit_prepared", {"session_id": session_id, "edit_num": len(COMMIT.get_edits())})
+        session = SESSIONS.get(session_id)
+        with session.lock:
+            response_message = init_step(COMMIT, SUT, system_under_test, progress_callback)
+            if json_input.get("delta"):
+                response_message, session.delta_state = encode_delta_response(response_message, None)
+        return {**response_message, "session_id": session_id}
 
-        # Setup the system under test
-        print(f"[MESSAGE:SIM] Setting up {system_under_test} for commit {commit_url}...")
-        
+    elif status == "suggestion":
+        with session.lock:
+            response_message = suggestion_step(session.commit, SUT, commit_url, suggestion_type, progress_callback)
+            if json_input.get("delta"):
+                response_message, session.delta_state = encode_delta_response(response_message, session.delta_state)
+        return {**response_message, "session_id": session.session_id}
+
+def init_step(COMMIT, SUT, system_under_test, progress_callback):
+    """
+    Select the init edit of the commit and set up the system under test.
+    """
+    commit_url = COMMIT.commit_url
+
+    # If this commit under this system under test has been simulated before, return the previous results
+    if len(COMMIT.SUT_prediction_records) == len(COMMIT.get_edits()):
+        print("[MESSAGE:SIM] This commit has been simulated before. Returning the previous results.")
+        response_message = COMMIT.SUT_prediction_records[len(COMMIT.replay_progress)]
+        COMMIT.replay_progress.append(COMMIT.simulation_order[len(COMMIT.replay_progress)])
+        return response_message
+    
+    # If this simulation is resumed from its progress log, set up the system under test on the current version
+    # and return the init response with the restored state, the following suggestion steps continue from there
+    if len(COMMIT.simulation_order) > 0:
+        print(f"[MESSAGE:SIM] Resuming {system_under_test} for commit {commit_url} from step {len(COMMIT.simulation_order)}...")
         json_input = {
             "id": COMMIT.commit_sha,
             "project_name": COMMIT.project_name,
             "status": "init",
             "repo_dir": COMMIT.repo_dir,
-            "prior_edits": COMMIT.get_prior_edits(), # Prior edit is the init edit
-            "edit_description": COMMIT.commit_message
+            "prior_edits": COMMIT.get_prior_edits(),
+            "edit_description": COMMIT.commit_message,
+            "changed_files": COMMIT.take_changed_files()
         }
         SUT.main(json_input)
+        sync_project(COMMIT)
+        progress_callback("sut_ready", {"init_edit_idx": COMMIT.simulation_order[0]})
+        response_message = {
+            **COMMIT.SUT_prediction_records[0],
+            # The edits applied so far, the project files are at the version after the last finished step
+            "next_edit_snapshots": COMMIT.SUT_prediction_records[-1]["next_edit_snapshots"],
+            "partial_order_graph": COMMIT.get_partial_order_graph(),
+            "resumed_steps": len(COMMIT.SUT_prediction_records)
+        }
+        return response_message
 
-        print(f"[MESSAGE:SIM] Successfully set up {system_under_test} as System Under Test.")
+    # Select init edit and update edits status
+    init_edit_idx = COMMIT.choose_edit(COMMIT.allowed_next_edit_idxs)
+    COMMIT.update_edit_status(init_edit_idx, "simulated", True)
+    COMMIT.update_allowed_as_next()
 
-        # Prepare the initial pred snapshot, where only contain the init edit
-        pred_snapshots = copy.deepcopy(COMMIT.get_next_edit_snapshots(init_edit_idx))
-        
-        # Update the project status with the new edit index
-        sync_project(COMMIT.get_current_version(), COMMIT.repo_dir)
-        evaluation_entropy = {
-            "entropy": {
-                "coedit": round(random.uniform(0, 16), 2),
-                "solo": round(random.uniform(0, 16), 2)
-            }
+    # Setup the system under test
+    print(f"[MESSAGE:SIM] Setting up {system_under_test} for commit {commit_url}...")
+    
+    json_input = {
+        "id": COMMIT.commit_sha,
+        "project_name": COMMIT.project_name,
+        "status": "init",
+        "repo_dir": COMMIT.repo_dir,
+        "prior_edits": COMMIT.get_prior_edits(), # Prior edit is the init edit
+        "edit_description": COMMIT.commit_message,
+        "changed_files": COMMIT.take_changed_files()
+    }
+    SUT.main(json_input)
+
+    print(f"[MESSAGE:SIM] Successfully set up {system_under_test} as System Under Test.")
+    progress_callback("sut_ready", {"init_edit_idx": init_edit_idx})
+
+    # Prepare the initial pred snapshot, where only contain the init edit
+    pred_snapshots = COMMIT.get_next_edit_snapshots(init_edit_idx)
+    
+    # Update the project status with the new edit index
+    sync_project(COMMIT)
+    evaluation_entropy = {
+        "entropy": {
+            "coedit": round(random.uniform(0, 16), 2),
+            "solo": round(random.uniform(0, 16), 2)
+        }
+    }
+    response_message =  {
+        "pred_snapshots": pred_snapshots,
+        "gdth_snapshots": COMMIT.commit_snapshots,
+        "evaluations": {
+                "flow_pattern": {
+                    "flow_keeping": [init_edit_idx],
+                    "flow_jumping": [],
+                    "flow_breaking": [],
+                    "flow_reverting": []
+                },
+                "matched_locations": [],
+            },
+        "status": "init",
+        "next_edit_snapshots": pred_snapshots,
+        "partial_order_graph": COMMIT.get_partial_order_graph(),
+        "evaluation_entropy": evaluation_entropy,
+    }
+    COMMIT.add_prediction_record(init_edit_idx, response_message)
+    return response_message
+
+def suggestion_step(COMMIT, SUT, commit_url, suggestion_type, progress_callback):
+    """
+    Acquire the subsequent edit recommendation from the system under test, evaluate it and apply the next edit.
+    """
+    edits = COMMIT.get_edits()
+    unsimulated_edits = [edit for edit in edits if edit["simulated"] == False]
+    # Check 1: commit URL matches
+    assert COMMIT.commit_url == commit_url, "[ERROR:SIM] At src/simulation/main.py: main(), Commit URL mismatch. Please ensure the same commit is used for both init and suggestion steps."
+
+    # If this commit under this system under test has been simulated before, return the previous results
+    if len(COMMIT.SUT_prediction_records) == len(COMMIT.get_edits()):
+        print("[MESSAGE:SIM] This commit has been simulated before. Returning the previous results.")
+        response_message = COMMIT.SUT_prediction_records[len(COMMIT.replay_progress)]
+        COMMIT.replay_progress.append(COMMIT.simulation_order[len(COMMIT.replay_progress)])
+        return response_message
+    
+    # Check 2: exist edits to simulate
+    assert unsimulated_edits != [], "[ERROR:SIM] At src/simulation/main.py: main(), No unsimulated edits found. Please check the commit snapshot."
+    
+    # Print current simulation status
+    COMMIT.simulation_status()
+
+    # Acquire subsequent edit recommendation from system under test
+    # NOTE: This snapshots are a comparison between: 
+    # NOTE: Current simulation status V.S. suggested edit version
+    # NOTE: Not the commit base version V.S. suggested edit version
+    json_input = {
+        "id": COMMIT.commit_sha,
+        "project_name": COMMIT.project_name,
+        "status": "suggestion",
+        "repo_dir": COMMIT.repo_dir,
+        "prior_edits": COMMIT.get_prior_edits(),
+        "edit_description": COMMIT.commit_message,
+        "changed_files": COMMIT.take_changed_files(), # files rewritten by the simulator since the previous call
+    }
+    pred_snapshots, costs = SUT.main(json_input)
+    # Systems under test may apply their suggestions to the project files, the next sync restores the files
+    # found changed on disk, since systems under test do not report every file they modify
+    pred_snapshots = indexing_edits_within_snapshots(pred_snapshots)
+    progress_callback("sut_done", {"costs": costs})
+    if suggestion_type == "flow-keeping":
+        pred_snapshots, rerank_cost = rerank(pred_snapshots, [COMMIT.get_edit(COMMIT.simulation_order[-1])])
+        progress_callback("rerank_done", {"costs": rerank_cost})
+    
+    # Compare predicted snapshots with current ground-truth snapshots
+    # NOTE: COMMIT.get_not_simulated_edit_snapshots() returns the gold
+    # NOTE: Current simulation status V.S commit head version
+    # NOTE: Both are built fresh, their edit windows are copies frozen with the current edit status
+    # NOTE: and share the edit lines with the commit, so they are stored in the records as they are
+    current_snapshots = COMMIT.get_not_simulated_edit_snapshots()
+    previously_applied_locations = COMMIT.get_previously_applied_locations()
+    # with open("./current_snapshots.json", "w") as f:
+    #     json.dump(current_snapshots, f, indent=4)
+    # with open("./pred_snapshots.json", "w") as f:
+    #     json.dump(pred_snapshots, f, indent=4)
+    flow_pattern, traditional_metrics, matched_locations, pred_snapshots = evaluate(pred_snapshots, current_snapshots, previously_applied_locations)
+    print(f"[MESSAGE:SIM] Flow pattern: {json.dumps(flow_pattern, indent=4)}")
+    progress_callback("evaluation_done", {"flow_pattern": flow_pattern, "metrics": traditional_metrics})
+    
+    # Update simulation progress for COMMIT
+    new_edit_idx = update_simulation_progress(COMMIT, matched_locations)
+    progress_callback("edit_applied", {"edit_idx": new_edit_idx})
+    next_edit_snapshots = COMMIT.get_next_edit_snapshots(new_edit_idx)
+
+    # Update the project status with the new edit index
+    sync_project(COMMIT)
+
+    # If all edits have been simulated, return the final results
+    edits = COMMIT.get_edits()
+    unsimulated_edits = [edit for edit in edits if edit["simulated"] == False]
+    evaluation_entropy = {
+        "entropy": {
+            "coedit": round(random.uniform(0, 16), 2),
+            "solo": round(random.uniform(0, 16), 2)
         }
+    }
+    if len(unsimulated_edits) == 0:
+        print("[MESSAGE:SIM] All edits have been simulated. Simulation completed.")
+        # NOTE: The pred_snapshots are a comparison between:
+        # NOTE: The current version V.S. suggested edit version
+        # NOTE: The next_edit_snapshots are a comparsion between:
+        # NOTE: The current version V.S. the next step version with next edit applied
         response_message =  {
             "pred_snapshots": pred_snapshots,
             "gdth_snapshots": COMMIT.commit_snapshots,
+            "curr_gdth_snapshots": current_snapshots,
+            "previously_applied_locations": previously_applied_locations,
             "evaluations": {
-                    "flow_pattern": {
-                        "flow_keeping": [init_edit_idx],
-                        "flow_jumping": [],
-                        "flow_breaking": [],
-                        "flow_reverting": []
-                    },
-                    "matched_locations": [],
-                },
-            "status": "init",
-            "next_edit_snapshots": pred_snapshots,
+                "flow_pattern": flow_pattern,
+                "matched_locations": matched_locations,
+                "precision": traditional_metrics["precision"],
+                "recall": traditional_metrics["recall"],
+                "f1_score": traditional_metrics["f1_score"],
+                "tp": traditional_metrics["tp"],
+                "fp": traditional_metrics["fp"],
+                "fn": traditional_metrics["fn"],
+                "time": costs["time"],
+                "token": costs["token"],
+                "price": costs["price"],
+            },
+            "status": "done",
+            "next_edit_snapshots": next_edit_snapshots,
             "partial_order_graph": COMMIT.get_partial_order_graph(),
             "evaluation_entropy": evaluation_entropy,
         }
-        COMMIT.SUT_prediction_records.append(response_message)
-        return response_message
-
-    elif status == "suggestion":
-        # Environment check
-        if COMMIT is None:
-            raise ValueError("COMMIT is not initialized. Please run the init step first.")
-        edits = COMMIT.get_edits()
-        unsimulated_edits = [edit for edit in edits if edit["simulated"] == False]
-        # Check 1: commit URL matches
-        assert COMMIT.commit_url == json_input["commit_url"], "[ERROR:SIM] At src/simulation/main.py: main(), Commit URL mismatch. Please ensure the same commit is used for both init and suggestion steps."
-
-        # If this commit under this system under test has been simulated before, return the previous results
-        if len(COMMIT.SUT_prediction_records) == len(COMMIT.get_edits()):
-            print("[MESSAGE:SIM] This commit has been simulated before. Returning the previous results.")
-            response_message = COMMIT.SUT_prediction_records[len(COMMIT.replay_progress)]
-            COMMIT.replay_progress.append(COMMIT.simulation_order[len(COMMIT.replay_progress)])
-            return response_message
-        
-        # Check 2: exist edits to simulate
-        assert unsimulated_edits != [], "[ERROR:SIM] At src/simulation/main.py: main(), No unsimulated edits found. Please check the commit snapshot."
-        
-        # Print current simulation status
-        COMMIT.simulation_status()
-
-        # Acquire subsequent edit recommendation from system under test
-        # NOTE: This snapshots are a comparison between: 
-        # NOTE: Current simulation status V.S. suggested edit version
-        # NOTE: Not the commit base version V.S. suggested edit version
+        COMMIT.add_prediction_record(new_edit_idx, response_message)
+        COMMIT.save_simulation_results()
         json_input = {
             "id": COMMIT.commit_sha,
             "project_name": COMMIT.project_name,
-            "status": "suggestion",
+            "status": "end",
             "repo_dir": COMMIT.repo_dir,
             "prior_edits": COMMIT.get_prior_edits(),
-            "edit_description": COMMIT.commit_message,
+            "edit_description": COMMIT.commit_message
         }
-        pred_snapshots, costs = SUT.main(json_input)
-        pred_snapshots = indexing_edits_within_snapshots(pred_snapshots)
-        if suggestion_type == "flow-keeping":
-            pred_snapshots, rerank_cost = rerank(pred_snapshots, [COMMIT.get_edit(COMMIT.simulation_order[-1])])
-        
-        # Compare predicted snapshots with current ground-truth snapshots
-        # NOTE: COMMIT.get_not_simulated_edit_snapshots() returns the gold
-        # NOTE: Current simulation status V.S commit head version
-        # Deepcopy is necessary as edit status will have update
-        current_snapshots = copy.deepcopy(COMMIT.get_not_simulated_edit_snapshots())
-        previously_applied_locations = copy.deepcopy(COMMIT.get_previously_applied_locations())
-        # with open("./current_snapshots.json", "w") as f:
-        #     json.dump(current_snapshots, f, indent=4)
-        # with open("./pred_snapshots.json", "w") as f:
-        #     json.dump(pred_snapshots, f, indent=4)
-        flow_pattern, traditional_metrics, matched_locations, pred_snapshots = evaluate(pred_snapshots, current_snapshots, previously_applied_locations)
-        print(f"[MESSAGE:SIM] Flow pattern: {json.dumps(flow_pattern, indent=4)}")
-        
-        # Update simulation progress for COMMIT
-        new_edit_idx = update_simulation_progress(COMMIT, matched_locations)
-        next_edit_snapshots = copy.deepcopy(COMMIT.get_next_edit_snapshots(new_edit_idx))
-
-        # Update the project status with the new edit index
-        sync_project(COMMIT.get_current_version(), COMMIT.repo_dir)
-
-        # If all edits have been simulated, return the final results
-        edits = COMMIT.get_edits()
-        unsimulated_edits = [edit for edit in edits if edit["simulated"] == False]
-        evaluation_entropy = {
-            "entropy": {
-                "coedit": round(random.uniform(0, 16), 2),
-                "solo": round(random.uniform(0, 16), 2)
-            }
+        SUT.main(json_input)
+        COMMIT.close()
+    else:
+        response_message =  {
+            "pred_snapshots": pred_snapshots,
+            "gdth_snapshots": COMMIT.commit_snapshots,
+            "curr_gdth_snapshots": current_snapshots,
+            "previously_applied_locations": previously_applied_locations,
+            "evaluations": {
+                "flow_pattern": flow_pattern,
+                "matched_locations": matched_locations,
+                "precision": traditional_metrics["precision"],
+                "recall": traditional_metrics["recall"],
+                "f1_score": traditional_metrics["f1_score"],
+                "tp": traditional_metrics["tp"],
+                "fp": traditional_metrics["fp"],
+                "fn": traditional_metrics["fn"],
+                "time": costs["time"],
+                "token": costs["token"],
+                "price": costs["price"],
+            },
+            "status": "suggestion",
+            "next_edit_snapshots": next_edit_snapshots,
+            "partial_order_graph": COMMIT.get_partial_order_graph(),
+            "evaluation_entropy": evaluation_entropy,
         }
-        if len(unsimulated_edits) == 0:
-            print("[MESSAGE:SIM] All edits have been simulated. Simulation completed.")
-            # NOTE: The pred_snapshots are a comparison between:
-            # NOTE: The current version V.S. suggested edit version
-            # NOTE: The next_edit_snapshots are a comparsion between:
-            # NOTE: The current version V.S. the next step version with next edit applied
-            response_message =  {
-                "pred_snapshots": pred_snapshots,
-                "gdth_snapshots": COMMIT.commit_snapshots,
-                "curr_gdth_snapshots": current_snapshots,
-                "previously_applied_locations": previously_applied_locations,
-                "evaluations": {
-                    "flow_pattern": flow_pattern,
-                    "matched_locations": matched_locations,
-                    "precision": traditional_metrics["precision"],
-                    "recall": traditional_metrics["recall"],
-                    "f1_score": traditional_metrics["f1_score"],
-                    "tp": traditional_metrics["tp"],
-                    "fp": traditional_metrics["fp"],
-                    "fn": traditional_metrics["fn"],
-                    "time": costs["time"],
-                    "token": costs["token"],
-                    "price": costs["price"],
-                },
-                "status": "done",
-                "next_edit_snapshots": next_edit_snapshots,
-                "partial_order_graph": COMMIT.get_partial_order_graph(),
-                "evaluation_entropy": evaluation_entropy,
-            }
-            COMMIT.SUT_prediction_records.append(response_message)
-            COMMIT.save_simulation_results()
-            json_input = {
-                "id": COMMIT.commit_sha,
-                "project_name": COMMIT.project_name,
-                "status": "end",
-                "repo_dir": COMMIT.repo_dir,
-                "prior_edits": COMMIT.get_prior_edits(),
-                "edit_description": COMMIT.commit_message
-            }
-            SUT.main(json_input)
-        else:
-            response_message =  {
-                "pred_snapshots": pred_snapshots,
-                "gdth_snapshots": COMMIT.commit_snapshots,
-                "curr_gdth_snapshots": current_snapshots,
-                "previously_applied_locations": previously_applied_locations,
-                "evaluations": {
-                    "flow_pattern": flow_pattern,
-                    "matched_locations": matched_locations,
-                    "precision": traditional_metrics["precision"],
-                    "recall": traditional_metrics["recall"],
-                    "f1_score": traditional_metrics["f1_score"],
-                    "tp": traditional_metrics["tp"],
-                    "fp": traditional_metrics["fp"],
-                    "fn": traditional_metrics["fn"],
-                    "time": costs["time"],
-                    "token": costs["token"],
-                    "price": costs["price"],
-                },
-                "status": "suggestion",
-                "next_edit_snapshots": next_edit_snapshots,
-                "partial_order_graph": COMMIT.get_partial_order_graph(),
-                "evaluation_entropy": evaluation_entropy,
-            }
-            COMMIT.SUT_prediction_records.append(response_message)
-        
-        return response_message
+        COMMIT.add_prediction_record(new_edit_idx, response_message)
+    
+    return response_message
 
-def sync_project(current_version, repo_dir):
-    for rel_file_path, file_content in current_version.items():
-        file_path = os.path.join(repo_dir, rel_file_path)
-        with open(file_path, "w") as f:
-            f.write("".join(file_content))
+def sync_project(COMMIT):
+    """
+    Write the files changed since the last sync to the worktree of the commit, each one atomically,
+    including the files whose content on disk was modified since, e.g. by the system under test.
+    Untouched files keep their content and mtime, so that caches of the system under test stay valid.
+
+    Returns:
+        dirty_files: list[str], the relative paths of the written files
+    """
+    COMMIT.detect_dirty_files()
+    dirty_files = COMMIT.take_dirty_files()
+    for rel_file_path, file_content in COMMIT.get_current_version(dirty_files).items():
+        write_text_atomic(os.path.join(COMMIT.repo_dir, rel_file_path), "".join(file_content))
+    COMMIT.mark_synced(dirty_files)
+    return dirty_files
 
 def evaluate(pred_snapshots, gdth_snapshots, previously_applied_locations):
     """
@@ -282,76 +397,81 @@ def evaluate(pred_snapshots, gdth_snapshots, previously_applied_locations):
     for loc in gdth_replace_locations + gdth_insert_locations:
         assert "idx" in loc and "allowed_as_next" in loc, "[ERROR:SIM] At src/simulation/main.py: evaluate(), Ground truth locations must contain 'idx' and 'allowed_as_next' fields."
     
-    # first classify the flow-keeping, jumping
-    matched_locations = []
+    # Index gold and previously applied locations by file and lines, so that each predicted location
+    # is only compared with the locations it may overlap with
+    gdth_replace_index = index_locations_by_line(gdth_replace_locations)
+    gdth_insert_index = defaultdict(list)
+    for gdth_loc in gdth_insert_locations:
+        gdth_insert_index[(gdth_loc["file_path"], tuple(gdth_loc["atLines"]))].append(gdth_loc)
+    previously_applied_index = index_locations_by_line(previously_applied_locations)
+    # Map predicted edit idx to its window, the first one of each file
+    pred_windows = defaultdict(list)
+    for file_path, snapshots in pred_snapshots.items():
+        file_pred_idxs = set()
+        for window in snapshots:
+            if isinstance(window, list) or window["idx"] in file_pred_idxs:
+                continue
+            file_pred_idxs.add(window["idx"])
+            pred_windows[window["idx"]].append(window)
+
+    # Collect the ground truth locations each predicted location may match with
+    pred_candidates = []
     for pred_loc in pred_locations:
         pred_at_lines = pred_loc["atLines"]
         if pred_loc["editType"] == "replace":
-            for gdth_loc in gdth_replace_locations:
-                if gdth_loc["file_path"] != pred_loc["file_path"]:
-                    continue
-                gdth_at_lines = gdth_loc["atLines"]
-                if overlap_percentage(pred_at_lines, gdth_at_lines) > 0.5 and get_bleu(pred_loc["after"], gdth_loc["after"]) > 50:
-                    matched_locations.append({
-                        "atLines": pred_at_lines,
-                        "editType": pred_loc["editType"],
-                        "confidence": pred_loc["confidence"],
-                        "suggestionRank": pred_loc["suggestionRank"],
-                        "predIdx": pred_loc["idx"],
-                        "matchWith": gdth_loc["idx"],
-                        "flowKeeping": True if gdth_loc["allowed_as_next"] else False,
-                    })
-                    for file_path, snapshots in pred_snapshots.items():
-                        for window in snapshots:
-                            if isinstance(window, list):
-                                continue
-                            if window["idx"] == pred_loc["idx"]:
-                                window["matchWith"] = gdth_loc["idx"]
-                                window["flowKeeping"] = True if gdth_loc["allowed_as_next"] else False
-                                if window["flowKeeping"]:
-                                    flow_pattern["flow_keeping"].append(pred_loc["idx"])
-                                else:
-                                    flow_pattern["flow_jumping"].append(pred_loc["idx"])
-                                break
-                    break
+            candidates = [
+                gdth_loc for gdth_loc in overlapping_locations(gdth_replace_index, pred_loc["file_path"], pred_at_lines)
+                if overlap_percentage(pred_at_lines, gdth_loc["atLines"]) > 0.5
+            ]
         else:
-            for gdth_loc in gdth_insert_locations:
-                if gdth_loc["file_path"] != pred_loc["file_path"]:
-                    continue
-                gdth_at_lines = gdth_loc["atLines"]
-                if pred_at_lines == gdth_at_lines and get_bleu(pred_loc["after"], gdth_loc["after"]) > 50:
-                    matched_locations.append({
-                        "atLines": pred_at_lines,
-                        "editType": pred_loc["editType"],
-                        "confidence": pred_loc["confidence"],
-                        "suggestionRank": pred_loc["suggestionRank"],
-                        "predIdx": pred_loc["idx"],
-                        "matchWith": gdth_loc["idx"],
-                        "flowKeeping": True if gdth_loc["allowed_as_next"] else False,
-                    })
-                    for file_path, snapshots in pred_snapshots.items():
-                        for window in snapshots:
-                            if isinstance(window, list):
-                                continue
-                            if window["idx"] == pred_loc["idx"]:
-                                window["matchWith"] = gdth_loc["idx"]
-                                window["flowKeeping"] = True if gdth_loc["allowed_as_next"] else False
-                                if window["flowKeeping"]:
-                                    flow_pattern["flow_keeping"].append(pred_loc["idx"])
-                                else:
-                                    flow_pattern["flow_jumping"].append(pred_loc["idx"])
-                                break
-                    break
+            candidates = gdth_insert_index.get((pred_loc["file_path"], tuple(pred_at_lines)), [])
+        pred_candidates.append(candidates)
+
+    # Score the predicted locations of each ground truth location in one batch, its after content is tokenized once
+    gdth_preds = {} # id(gdth_loc) -> (gdth_loc, positions of the predicted locations to score)
+    for pred_pos, candidates in enumerate(pred_candidates):
+        for gdth_loc in candidates:
+            gdth_preds.setdefault(id(gdth_loc), (gdth_loc, []))[1].append(pred_pos)
+    bleu_matched = {} # (predicted location position, id(gdth_loc)) -> whether BLEU > 50
+    for gdth_loc, pred_positions in gdth_preds.values():
+        above = get_bleu_above_batch([pred_locations[pred_pos]["after"] for pred_pos in pred_positions], gdth_loc["after"], 50)
+        for pred_pos, is_above in zip(pred_positions, above):
+            bleu_matched[(pred_pos, id(gdth_loc))] = is_above
+
+    # first classify the flow-keeping, jumping
+    matched_locations = []
+    for pred_pos, (pred_loc, candidates) in enumerate(zip(pred_locations, pred_candidates)):
+        pred_at_lines = pred_loc["atLines"]
+        for gdth_loc in candidates:
+            if bleu_matched[(pred_pos, id(gdth_loc))]:
+                matched_locations.append({
+                    "atLines": pred_at_lines,
+                    "editType": pred_loc["editType"],
+                    "confidence": pred_loc["confidence"],
+                    "suggestionRank": pred_loc["suggestionRank"],
+                    "predIdx": pred_loc["idx"],
+                    "matchWith": gdth_loc["idx"],
+                    "flowKeeping": True if gdth_loc["allowed_as_next"] else False,
+                })
+                for window in pred_windows[pred_loc["idx"]]:
+                    window["matchWith"] = gdth_loc["idx"]
+                    window["flowKeeping"] = True if gdth_loc["allowed_as_next"] else False
+                    if window["flowKeeping"]:
+                        flow_pattern["flow_keeping"].append(pred_loc["idx"])
+                    else:
+                        flow_pattern["flow_jumping"].append(pred_loc["idx"])
+                break
 
     # then classify the flow-reverting and flow-breaking
+    matched_pred_idxs = set(flow_pattern["flow_keeping"] + flow_pattern["flow_jumping"])
     for pred_loc in pred_locations:
         # Filter out predicted hunks already classified as flow-keeping and flow-breaking
-        if pred_loc["idx"] in flow_pattern["flow_keeping"] + flow_pattern["flow_jumping"]:
+        if pred_loc["idx"] in matched_pred_idxs:
             continue
         pred_at_lines = pred_loc["atLines"]
         is_flow_reverting = False
-        for prev_apply_loc in previously_applied_locations:
-            if prev_apply_loc["file_path"] == pred_loc["file_path"] and overlap_percentage(pred_at_lines, prev_apply_loc["atLines"]) > 0.5:
+        for prev_apply_loc in overlapping_locations(previously_applied_index, pred_loc["file_path"], pred_at_lines):
+            if overlap_percentage(pred_at_lines, prev_apply_loc["atLines"]) > 0.5:
                 flow_pattern["flow_reverting"].append(pred_loc["idx"])
                 is_flow_reverting = True
                 break
@@ -402,40 +522,43 @@ def update_simulation_progress(COMMIT, matched_locations):
     
     # Otherwise, randomly select from allowed next edit idxs as the subsequent edit
     if new_edit_idx is None:
-        edits = COMMIT.get_edits()
-        allowed_next_edit_idxs = [edit["idx"] for edit in edits if edit["allowed_as_next"] == True]
+        allowed_next_edit_idxs = COMMIT.get_allowed_next_edit_idxs()
         if len(allowed_next_edit_idxs) > 0:
-            new_edit_idx = random.choice(allowed_next_edit_idxs)
+            new_edit_idx = COMMIT.choose_edit(allowed_next_edit_idxs)
         else:
-            new_edit_idx = random.choice([edit["idx"] for edit in edits if edit["simulated"] == False])
+            new_edit_idx = COMMIT.choose_edit([edit["idx"] for edit in COMMIT.get_edits() if edit["simulated"] == False])
         COMMIT.update_edit_status(new_edit_idx, "simulated", True)
         print(f"[MESSAGE:SUT] Suggestion does not match with any edit, randomly pick Edit {new_edit_idx} as subsequent edit, apply to project")
     
     COMMIT.update_allowed_as_next()
     return new_edit_idx
 
-def rq3_origin(url, sut):
+def rq3_origin(url, sut, rollout=None):
     init_input = {
         "commit_url": url,
         "system_under_test": sut,
         "status": "init",
-        "suggestion_type": "naive"
+        "suggestion_type": "Original suggestion",
+        "rollout": rollout
     }
     response = main(init_input)
-    edit_num = 0
-    for file_path, snapshot in response["gdth_snapshots"].items():
-        for window in snapshot:
-            if isinstance(window, dict):
-                edit_num += 1
-
-    for i in range(edit_num - 1):
-        input = {
-            "commit_url": url,
-            "system_under_test": sut,
-            "status": "suggestion",
-            "suggestion_type": "naive"
-        }
-        main(input)
+    session_id = response["session_id"]
+
+    try:
+        # A resumed simulation starts from its last finished step, hence loop until done instead of counting edits
+        while response["status"] != "done":
+            input = {
+                "commit_url": url,
+                "system_under_test": sut,
+                "status": "suggestion",
+                "suggestion_type": "Original suggestion",
+                "session_id": session_id,
+                "rollout": rollout
+            }
+            response = main(input)
+    finally:
+        # Also release the worktree when the simulation fails halfway
+        SESSIONS.remove(session_id)
 
 def rq3_flow_keeper(url, sut):
     # Find the simulation output of commit url
@@ -444,8 +567,7 @@ def rq3_flow_keeper(url, sut):
     if os.path.exists(os.path.join(OUTPUT_DIR, f"{project_name}-{commit_sha}-{sut}-simulation-results-flow-keeper.json")):
         return None
     assert os.path.exists(os.path.join(OUTPUT_DIR, f"{project_name}-{commit_sha}-{sut}-simulation-results.json"))
-    with open(os.path.join(OUTPUT_DIR, f"{project_name}-{commit_sha}-{sut}-simulation-results.json"), "r") as f:
-        data = json.load(f)
+    data = load_simulation_results(os.path.join(OUTPUT_DIR, f"{project_name}-{commit_sha}-{sut}-simulation-results.json"))
 
     simulation_order = data["simulation_order"]
     gdth_snapshots = data["commit_snapshots"]
@@ -484,8 +606,7 @@ def rq3_flow_keeper(url, sut):
         }
         all_evaluations.append(evaluations)
 
-    with open(os.path.join(OUTPUT_DIR, f"{project_name}-{commit_sha}-{sut}-simulation-results-flow-keeper.json"), "w") as f:
-        json.dump(all_evaluations, f, indent=4)
+    write_json_atomic(os.path.join(OUTPUT_DIR, f"{project_name}-{commit_sha}-{sut}-simulation-results-flow-keeper.json"), all_evaluations)
 
 if __name__ == "__main__":
     # sut = "CoEdPilot"
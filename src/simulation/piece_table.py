@@ -0,0 +1,82 @@
+from itertools import chain
+
+class PieceTable:
+    """
+    The current version of one file of a commit, as one piece per window of the file snapshot.
+
+    A piece refers, without copying, to the lines of its window: the context lines, or the "before"
+    or "after" lines of an edit depending on whether the edit is simulated. Applying an edit only
+    swaps the lines of its piece, and the line offsets of pieces are kept in a Fenwick tree, so that
+    a simulation step costs O(log windows) instead of O(lines of the file).
+    """
+    def __init__(self, file_snapshot):
+        self.windows = file_snapshot
+        self.pieces = []
+        for window in file_snapshot:
+            if isinstance(window, list):
+                self.pieces.append(window)
+            else:
+                self.pieces.append(window["after"] if window["simulated"] else window["before"])
+        # Fenwick tree over the number of lines of each piece
+        self.tree = [0] * (len(self.pieces) + 1)
+        for piece_idx, piece in enumerate(self.pieces):
+            self._add(piece_idx, len(piece))
+        self.lines_cache = None
+
+    def _add(self, piece_idx, delta):
+        i = piece_idx + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def offset(self, piece_idx):
+        """
+        Return the line index of the first line of a piece in the current version.
+        """
+        offset = 0
+        i = piece_idx
+        while i > 0:
+            offset += self.tree[i]
+            i -= i & -i
+        return offset
+
+    def apply(self, piece_idx, lines):
+        """
+        Make a piece refer to other lines, e.g. the "after" lines of a newly simulated edit.
+        """
+        self._add(piece_idx, len(lines) - len(self.pieces[piece_idx]))
+        self.pieces[piece_idx] = lines
+        self.lines_cache = None
+
+    def lines(self):
+        """
+        Return the lines of the current version, materialized once per change of the file.
+        The returned list is shared, it must not be modified.
+        """
+        if self.lines_cache is None:
+            self.lines_cache = list(chain.from_iterable(self.pieces))
+        return self.lines_cache
+
+    def split_view(self, is_split):
+        """
+        Return a snapshot of the current version, in which the edit windows selected by is_split are kept
+        and the lines of every run of other pieces are merged into one list.
+
+        The kept windows are shallow copies, which freeze the edit status at the time of the call and share
+        their "before" and "after" lists with the commit snapshot. Those lists are never modified once the
+        hunks are extracted, so the snapshot can be mutated or stored without deep copying it.
+
+        Args:
+            is_split: Callable[[dict], bool], whether an edit window is kept as a window
+        Returns:
+            snapshot: list[list[str] | dict], the snapshot of the file
+        """
+        snapshot = []
+        for window, piece in zip(self.windows, self.pieces):
+            if isinstance(window, dict) and is_split(window):
+                snapshot.append(window.copy())
+            elif len(snapshot) > 0 and isinstance(snapshot[-1], list):
+                snapshot[-1].extend(piece)
+            else:
+                snapshot.append(piece.copy())
+        return snapshot
@@ -0,0 +1,162 @@
+import os
+import json
+import mmap
+import threading
+
+from collections import OrderedDict
+from dotenv import load_dotenv
+from .utils import write_text_atomic
+from .artifacts import get_record_prefix, load_simulation_results
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+root_path = os.path.abspath(os.path.join(current_path, "../../"))
+load_dotenv(dotenv_path=os.path.join(root_path, ".config"))
+OUTPUT_DIR = os.getenv("OUTPUT_DIR")
+REPLAY_DIR = os.path.join(OUTPUT_DIR, ".replay")
+REPLAY_CACHE_SIZE = int(os.getenv("REPLAY_CACHE_SIZE") or 32) # number of recorded simulations kept open
+
+class ReplayRecord:
+    """
+    A recorded simulation, read from its step file: one json line with what all steps share
+    (the commit snapshots with their final edit status and the partial orders), then one json line per step.
+    The step file is memory-mapped and its line offsets indexed, so that step k is parsed on its own.
+    `cursors` counts the replay sessions reading the record, the replay store closes it once it is evicted
+    and no longer read.
+    """
+    def __init__(self, commit_url, system_under_test, step_fp):
+        self.commit_url = commit_url
+        self.system_under_test = system_under_test
+        self.cursors = 0
+        self.evicted = False
+        with open(step_fp, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offsets = [0]
+        while True:
+            end = self.mm.find(b"\n", self.offsets[-1])
+            if end == -1:
+                break
+            self.offsets.append(end + 1)
+        shared = self._read_line(0)
+        self.commit_snapshots = shared["commit_snapshots"]
+        self.partial_orders = shared["partial_orders"]
+        self.edits = [window for snapshot in self.commit_snapshots.values() for window in snapshot if isinstance(window, dict)]
+
+    def _read_line(self, line_idx):
+        return json.loads(self.mm[self.offsets[line_idx]:self.offsets[line_idx + 1]])
+
+    def __len__(self):
+        return len(self.offsets) - 2
+
+    def get_step(self, step):
+        """
+        Return the response of the given step, the same as the recorded prediction record.
+        """
+        if not 0 <= step < len(self):
+            raise ValueError(f"[ERROR:SIM] Recorded simulation of {self.commit_url} under {self.system_under_test} has no step {step}.")
+        response_message = self._read_line(step + 1)
+        response_message["gdth_snapshots"] = self.commit_snapshots
+        response_message["partial_order_graph"] = {
+            "nodes": list(self.edits),
+            "edges": self.partial_orders
+        }
+        return response_message
+
+    def close(self):
+        self.mm.close()
+
+class ReplayCursor:
+    """
+    The position of a replay session in a recorded simulation, held by the session in place of a Commit.
+    """
+    def __init__(self, record, store):
+        self.record = record
+        self.store = store
+        self.commit_url = record.commit_url
+        self.step = 0
+        self.closed = False
+
+    def next_step(self):
+        response_message = self.record.get_step(self.step)
+        self.step += 1
+        return response_message
+
+    def close(self):
+        # The record belongs to the replay store, which closes it once evicted and released by every cursor
+        if not self.closed:
+            self.closed = True
+            self.store.release(self.record)
+
+class ReplayStore:
+    """
+    Thread-safe store of recorded simulations, serving their steps without rebuilding a Commit,
+    hence without touching git, the language server or the system under test.
+    The least recently used records are evicted first when more than `cache_size` are open, an evicted record
+    is closed once the last replay session reading it is closed.
+    """
+    def __init__(self, cache_size=REPLAY_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_record_fp(self, commit_url, system_under_test, rollout=None):
+        return f"{get_record_prefix(commit_url, system_under_test, rollout)}-simulation-results.json"
+
+    def get_step_fp(self, commit_url, system_under_test, rollout=None):
+        record_name = os.path.basename(get_record_prefix(commit_url, system_under_test, rollout))
+        return os.path.join(REPLAY_DIR, f"{record_name}-steps.jsonl")
+
+    def has(self, commit_url, system_under_test, rollout=None):
+        """
+        Whether the simulation of the commit under the system under test has been recorded.
+        """
+        return os.path.exists(self.get_record_fp(commit_url, system_under_test, rollout))
+
+    def open_cursor(self, commit_url, system_under_test, rollout=None):
+        """
+        Return a cursor at the first step of the recorded simulation of the commit under the system under test.
+        Its step file is written from the simulation results the first time it is replayed.
+        The cursor must be closed once the replay session ends.
+        """
+        key = (commit_url, system_under_test, rollout)
+        with self._lock:
+            record = self._records.get(key)
+            if record is not None:
+                self._records.move_to_end(key)
+                record.cursors += 1
+                return ReplayCursor(record, self)
+
+            record_fp = self.get_record_fp(commit_url, system_under_test, rollout)
+            step_fp = self.get_step_fp(commit_url, system_under_test, rollout)
+            if not os.path.exists(step_fp) or os.path.getmtime(step_fp) < os.path.getmtime(record_fp):
+                self.write_steps(record_fp, step_fp)
+            record = ReplayRecord(commit_url, system_under_test, step_fp)
+            record.cursors += 1
+            self._records[key] = record
+            # Evicted records stay readable by the sessions still replaying them, until they are released
+            while len(self._records) > self.cache_size:
+                evicted = self._records.popitem(last=False)[1]
+                evicted.evicted = True
+                if evicted.cursors == 0:
+                    evicted.close()
+            return ReplayCursor(record, self)
+
+    def release(self, record):
+        """
+        Called when a cursor of the record is closed, the record is closed if it was evicted and has no cursor left.
+        """
+        with self._lock:
+            record.cursors -= 1
+            if record.evicted and record.cursors == 0:
+                record.close()
+
+    def write_steps(self, record_fp, step_fp):
+        record = load_simulation_results(record_fp)
+        lines = [json.dumps({"commit_snapshots": record["commit_snapshots"], "partial_orders": record["partial_orders"]})]
+        for prediction_record in record["SUT_prediction_records"]:
+            lines.append(json.dumps({
+                key: value for key, value in prediction_record.items()
+                if key not in ["gdth_snapshots", "partial_order_graph"]
+            }))
+        os.makedirs(REPLAY_DIR, exist_ok=True)
+        write_text_atomic(step_fp, "\n".join(lines) + "\n")
+        print(f"[MESSAGE:SIM] Indexed recorded simulation {record_fp} for replay.")
@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import argparse
+import statistics
+import traceback
+import concurrent.futures
+
+from dotenv import load_dotenv
+from .utils import clone_repo, write_json_atomic
+from .artifacts import get_record_prefix, load_simulation_results
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+root_path = os.path.abspath(os.path.join(current_path, "../../"))
+load_dotenv(dotenv_path=os.path.join(root_path, ".config"))
+REPOS_DIR = os.getenv("REPOS_DIR")
+ROLLOUTS = int(os.getenv("ROLLOUTS") or 5)
+ROLLOUT_WORKERS = int(os.getenv("ROLLOUT_WORKERS") or ROLLOUTS)
+# Systems under test that cannot run several simulations at once in the same host:
+# CoEdPilot loads its models on the single GPU given by DEVICE_ID in every process
+SEQUENTIAL_SUTS = ["CoEdPilot"]
+
+def get_rollout_metrics(record):
+    """
+    Sum the flow patterns and the traditional metrics over the suggestion steps of one simulation.
+
+    Returns:
+        metrics: dict, the number of flow-keeping, flow-jumping, flow-breaking and flow-reverting suggestions,
+            their rates among all suggestions, tp, fp, fn, precision, recall and f1_score
+    """
+    metrics = {"flow_keeping": 0, "flow_jumping": 0, "flow_breaking": 0, "flow_reverting": 0, "tp": 0, "fp": 0, "fn": 0}
+    for prediction_record in record["SUT_prediction_records"][1:]:
+        for pattern in ["flow_keeping", "flow_jumping", "flow_breaking", "flow_reverting"]:
+            metrics[pattern] += len(prediction_record["evaluations"]["flow_pattern"][pattern])
+        for key in ["tp", "fp", "fn"]:
+            metrics[key] += prediction_record["evaluations"][key]
+
+    suggestion_num = metrics["flow_keeping"] + metrics["flow_jumping"] + metrics["flow_breaking"] + metrics["flow_reverting"]
+    for pattern in ["flow_keeping", "flow_jumping", "flow_breaking", "flow_reverting"]:
+        metrics[f"{pattern}_rate"] = metrics[pattern] / suggestion_num if suggestion_num > 0 else 0
+    metrics["precision"] = metrics["tp"] / (metrics["tp"] + metrics["fp"]) if metrics["tp"] + metrics["fp"] > 0 else 0
+    metrics["recall"] = metrics["tp"] / (metrics["tp"] + metrics["fn"]) if metrics["tp"] + metrics["fn"] > 0 else 0
+    precision, recall = metrics["precision"], metrics["recall"]
+    metrics["f1_score"] = 2 * precision * recall / (precision + recall) if (precision + recall) > 0 else 0
+    return metrics
+
+def aggregate_rollout_metrics(metrics_list):
+    """
+    Return the mean and the sample variance of each metric over the rollouts.
+    """
+    aggregated = {}
+    for key in metrics_list[0]:
+        values = [metrics[key] for metrics in metrics_list]
+        aggregated[key] = {
+            "mean": statistics.mean(values),
+            "variance": statistics.variance(values) if len(values) > 1 else 0.0
+        }
+    return aggregated
+
+def simulate_rollout(url, sut, rollout):
+    """
+    Simulate one seeded rollout of a commit inside a worker process.
+
+    Returns:
+        result: dict, with keys "rollout", "success", "error", "seconds" and "metrics"
+    """
+    # Import inside the worker, so that the parent process does not load any system under test
+    from .main import rq3_origin
+
+    start = time.time()
+    metrics = None
+    try:
+        rq3_origin(url, sut, rollout=rollout)
+        metrics = get_rollout_metrics(load_simulation_results(f"{get_record_prefix(url, sut, rollout)}-simulation-results.json"))
+        error = None
+    except Exception as e:
+        traceback.print_exc()
+        error = f"{type(e).__name__}: {e}"
+    return {
+        "rollout": rollout,
+        "success": error is None,
+        "error": error,
+        "seconds": time.time() - start,
+        "metrics": metrics
+    }
+
+def run_rollouts(url, sut, rollouts=ROLLOUTS, workers=ROLLOUT_WORKERS):
+    """
+    Simulate seeded rollouts of the same commit under the same system under test, and aggregate their metrics.
+    The commit is preprocessed once, all rollouts reuse its artifacts (snapshots, dependency edges, partial orders).
+
+    Args:
+        url: str, the commit url
+        sut: str, the system under test
+        rollouts: int, the number of rollouts, seeded 0 to rollouts - 1
+        workers: int, the number of rollouts simulated at the same time
+
+    Returns:
+        summary: dict, with the result of each rollout and the mean and variance of their metrics
+    """
+    from .commit import Commit
+
+    if sut in SEQUENTIAL_SUTS:
+        workers = 1
+    os.makedirs(REPOS_DIR, exist_ok=True)
+    clone_repo(url.split("/")[-4], url.split("/")[-3], REPOS_DIR, url.split("/")[-1])
+    Commit(url, REPOS_DIR, sut, preprocess_only=True, rollout=0)
+
+    print(f"[MESSAGE:SIM] Simulating {rollouts} rollouts of {url} under {sut} with {workers} workers.")
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(simulate_rollout, url, sut, rollout) for rollout in range(rollouts)]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            results.append(result)
+            status = "done" if result["success"] else f"failed ({result['error']})"
+            print(f"[MESSAGE:SIM] [{len(results)}/{rollouts}] Rollout {result['rollout']} {status}")
+    results.sort(key=lambda result: result["rollout"])
+
+    metrics_list = [result["metrics"] for result in results if result["success"]]
+    summary = {
+        "commit_url": url,
+        "system_under_test": sut,
+        "rollouts": rollouts,
+        "failed": len([result for result in results if not result["success"]]),
+        "aggregated_metrics": aggregate_rollout_metrics(metrics_list) if metrics_list else None,
+        "results": results
+    }
+    # Next to the records of the rollouts, apart from the records analyzed by analyze.py
+    rollout_dir = os.path.dirname(get_record_prefix(url, sut, 0))
+    write_json_atomic(os.path.join(rollout_dir, f"{os.path.basename(get_record_prefix(url, sut))}-rollouts-summary.json"), summary)
+    return summary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", type=str, required=True, help="The commit url to simulate")
+    parser.add_argument("--sut", type=str, default="Claude", help="The system under test")
+    parser.add_argument("--rollouts", type=int, default=ROLLOUTS, help="Number of seeded rollouts")
+    parser.add_argument("--workers", type=int, default=ROLLOUT_WORKERS, help="Number of rollouts simulated at the same time")
+    args = parser.parse_args()
+
+    summary = run_rollouts(args.url, args.sut, rollouts=args.rollouts, workers=args.workers)
+    print(json.dumps(summary["aggregated_metrics"], indent=4))
@@ -0,0 +1,90 @@
+import os
+import time
+import uuid
+import threading
+
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+root_path = os.path.abspath(os.path.join(current_path, "../../"))
+load_dotenv(dotenv_path=os.path.join(root_path, ".config"))
+SESSION_TTL = float(os.getenv("SESSION_TTL") or 3600) # seconds an idle session is kept alive
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS") or 64) # maximum number of live sessions, least recently used are evicted first
+
+class Session:
+    def __init__(self, session_id, commit):
+        self.session_id = session_id
+        self.commit = commit
+        self.lock = threading.Lock() # serialize the simulation steps of the same session
+        self.last_access = time.monotonic()
+        self.delta_state = None # what the client has received, for delta encoded responses
+
+class SessionRegistry:
+    """
+    Thread-safe registry of simulation sessions, one Commit per session.
+    Idle sessions are evicted after `ttl` seconds, and the least recently used
+    session is evicted when more than `max_sessions` sessions are alive.
+    """
+    def __init__(self, ttl=SESSION_TTL, max_sessions=MAX_SESSIONS, on_evict=None):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.on_evict = on_evict
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, commit):
+        """
+        Register a new session for the given commit and return its session id.
+        """
+        session_id = uuid.uuid4().hex
+        with self._lock:
+            self._sessions[session_id] = Session(session_id, commit)
+            evicted = self._collect_evicted()
+        self._evict(evicted)
+        return session_id
+
+    def get(self, session_id):
+        """
+        Return the session with the given id and mark it as recently used.
+        """
+        with self._lock:
+            evicted = self._collect_evicted()
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.last_access = time.monotonic()
+                self._sessions.move_to_end(session_id)
+        self._evict(evicted)
+        if session is None:
+            raise ValueError(f"[ERROR:SIM] Session {session_id} does not exist or has expired. Please run the init step first.")
+        return session
+
+    def remove(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self._evict([session])
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def _collect_evicted(self):
+        # Must be called with self._lock held
+        evicted = []
+        now = time.monotonic()
+        for session_id, session in list(self._sessions.items()):
+            if now - session.last_access > self.ttl:
+                evicted.append(self._sessions.pop(session_id))
+        while len(self._sessions) > self.max_sessions:
+            _, session = self._sessions.popitem(last=False)
+            evicted.append(session)
+        return evicted
+
+    def _evict(self, sessions):
+        for session in sessions:
+            print(f"[MESSAGE:SIM] Session {session.session_id} for {session.commit.commit_url} evicted.")
+            if self.on_evict is not None:
+                # Wait for the running step of this session to finish before releasing its resources
+                with session.lock:
+                    self.on_evict(session)
@@ -1,33 +1,112 @@
 import os
 import re
+import json
 import time
+import shutil
+import tempfile
+import bisect
 import requests
-import platform
 import subprocess
 
 from dotenv import load_dotenv
 from collections import defaultdict
-from tree_sitter import Language, Parser
-from .bleu import direct_computeMaps, bleuFromMaps
+from .bleu import sentence_bleu, batch_bleu_above
+from libs import git_mirror
+from libs.syntax import parse, SyntaxIndex
 
 curr_file_dir = os.path.dirname(os.path.abspath(__file__))
 load_dotenv(os.path.join(curr_file_dir, "../../.config"))
 OPENAI_KEY = os.getenv("OPENAI_TOKEN")
 OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
+MIRRORS_DIR = os.getenv("MIRRORS_DIR") or os.path.join(os.getenv("REPOS_DIR") or "", ".mirrors") # bare mirrors shared by all local clones
 
-def clone_repo(user_name: str, project_name: str, target_dir: str):
+def clone_repo(user_name: str, project_name: str, target_dir: str, commit_sha: str = None):
     """
-    Clone the repository to local
-    
+    Clone the repository to local, borrowing its objects from the bare mirror under MIRRORS_DIR, see libs/git_mirror.py.
+
     Args:
         user_name: str, the user name of the repository
         project_name: str, the name of the repository
         target_dir: str, the target directory to clone the repository
+        commit_sha: str | None, the commit that must exist in the clone
     Returns:
         None
     """
-    command = f"git clone https://github.com/{user_name}/{project_name}.git {target_dir}/{project_name}"
-    subprocess.run(command, shell=True)
+    git_mirror.clone_repo(user_name, project_name, target_dir, MIRRORS_DIR, commit_sha)
+
+def create_worktree(repo_path: str, commit: str, worktree_dir: str) -> str:
+    """
+    Check out the given commit into a detached git worktree of repo_path.
+    The worktree shares the object store with repo_path, so that every simulation
+    owns a working copy without cloning the repository again.
+
+    Args:
+        repo_path: str, the path of the local clone
+        commit: str, the commit (or revision like `sha^`) to check out
+        worktree_dir: str, the directory of the new worktree
+    Returns:
+        worktree_dir: str, the absolute path of the new worktree
+    """
+    worktree_dir = os.path.abspath(worktree_dir)
+    os.makedirs(os.path.dirname(worktree_dir), exist_ok=True)
+    # The worktree list of the clone is shared by the concurrent simulations, e.g. the workers of batch.py
+    with git_mirror.repo_lock(repo_path):
+        # Drop the records of worktrees whose directory has been removed, e.g. after a crash
+        subprocess.run(["git", "-C", repo_path, "worktree", "prune"], capture_output=True, text=True)
+        result = subprocess.run(
+            ["git", "-C", repo_path, "worktree", "add", "--detach", "--force", worktree_dir, commit],
+            capture_output=True,
+            text=True
+        )
+    if result.returncode != 0:
+        raise RuntimeError(f"Git worktree add failed:\n{result.stderr}")
+    return worktree_dir
+
+def remove_worktree(repo_path: str, worktree_dir: str) -> None:
+    """
+    Remove the worktree created by create_worktree, including its untracked files.
+    """
+    with git_mirror.repo_lock(repo_path):
+        result = subprocess.run(
+            ["git", "-C", repo_path, "worktree", "remove", "--force", worktree_dir],
+            capture_output=True,
+            text=True
+        )
+        if result.returncode != 0:
+            # The worktree directory is broken or already removed, clean it up manually
+            shutil.rmtree(worktree_dir, ignore_errors=True)
+            subprocess.run(["git", "-C", repo_path, "worktree", "prune"], capture_output=True, text=True)
+
+def write_json_atomic(file_path: str, data, indent=4):
+    """
+    Write json to a temporary file next to the target, then rename it over the target,
+    so that concurrent writers and readers never see a partially written file.
+    """
+    fd, tmp_file_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_path)), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, indent=indent)
+        os.replace(tmp_file_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
+        raise
+
+def write_text_atomic(file_path: str, content: str):
+    """
+    Write text the same way as write_json_atomic(), keeping the permissions of the file it replaces.
+    """
+    fd, tmp_file_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_path)), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        if os.path.exists(file_path):
+            os.chmod(tmp_file_path, os.stat(file_path).st_mode & 0o7777)
+        os.replace(tmp_file_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
+        raise
 
 def detect_extension(file_names: list[str]):
     # 使用os.path.basename 获取文件名
@@ -113,13 +192,10 @@ def check_language(file_path: str): # Also used in optimization/utils.py
     else:
         return None
 
-def find_code_structure(code, line_index, language): # Also used in optimization/utils.py
-    # Initialize Tree-sitter parser and set language
-    parser = get_parser(language)
-
-    # Parse code to generate syntax tree
-    tree = parser.parse(bytes(code, "utf8"))
-    root_node = tree.root_node
+def find_code_structure(code, line_index, language, index=None): # Also used in optimization/utils.py
+    # Parse code to generate syntax tree, unless the line index of this file is given
+    if index is None:
+        index = SyntaxIndex(parse(code, language))
 
     # Define node types for different languages
     def get_declaration_text_py(node):
@@ -436,108 +512,55 @@ def find_code_structure(code, line_index, language): # Also used in optimization
         for child in node.children:
             print_node_structure(child, level + 1)
             
-    # Traverse the syntax tree to find the structure path of the line number
-    def traverse(node, current_structure=[]):
-        # Check if the current node contains the line number
-        if node.start_point[0] <= line_index <= node.end_point[0]:
-            # If it is a class definition, add to structure path
-            if node.type == node_types['class']:
-                class_declaration, class_name = node_types["get_signature_fn"](node)
-                current_structure.append({
-                    "type": "class",
-                    "name": class_name,
-                    "signature": class_declaration,
-                    "at_line": node.start_point[0]
-                })
+    # Return the structure entry of a node containing the line number, None if it is not part of the structure path
+    def visit(node):
+        # If it is a class definition, add to structure path
+        if node.type == node_types['class']:
+            class_declaration, class_name = node_types["get_signature_fn"](node)
+            return {
+                "type": "class",
+                "name": class_name,
+                "signature": class_declaration,
+                "at_line": node.start_point[0]
+            }
 
-            # If it is a function definition, add to structure path
-            elif node.type == node_types['function']:
-                function_declaration, function_name = node_types["get_signature_fn"](node)
-                current_structure.append({
-                    "type": "function",
-                    "name": function_name,
-                    "signature": function_declaration,
-                    "at_line": node.start_point[0]
-                })
-
-            # If it is a function call, add to structure path
-            elif node.type == node_types['call']:
-                function_name, call_signature = node_types["get_call_info_fn"](node)
-                if function_name:
-                    # Find which specific argument the line belongs to
-                    argument_info = find_argument_in_call(node, line_index)
-                    
-                    call_entry = {
-                        "type": "call",
-                        "name": function_name,
-                        "signature": call_signature,
-                        "at_line": node.start_point[0]
-                    }
-                    
-                    current_structure.append(call_entry)
+        # If it is a function definition, add to structure path
+        elif node.type == node_types['function']:
+            function_declaration, function_name = node_types["get_signature_fn"](node)
+            return {
+                "type": "function",
+                "name": function_name,
+                "signature": function_declaration,
+                "at_line": node.start_point[0]
+            }
 
-            elif node_types.get('method') and node.type == node_types['method']:
-                
-                method_declaration, method_name = node_types["get_signature_fn"](node)
-                current_structure.append({
-                    "type": "method",
-                    "name": method_name,
-                    "signature": method_declaration,
+        # If it is a function call, add to structure path
+        elif node.type == node_types['call']:
+            function_name, call_signature = node_types["get_call_info_fn"](node)
+            if function_name:
+                return {
+                    "type": "call",
+                    "name": function_name,
+                    "signature": call_signature,
                     "at_line": node.start_point[0]
-                })
-                
-            # Check the child in recursion
-            for child in node.children:
-                result = traverse(child, current_structure)
-                if result:
-                    return result
+                }
 
-            # return the current structure path
-            return current_structure
+        elif node_types.get('method') and node.type == node_types['method']:
+            method_declaration, method_name = node_types["get_signature_fn"](node)
+            return {
+                "type": "method",
+                "name": method_name,
+                "signature": method_declaration,
+                "at_line": node.start_point[0]
+            }
 
-        return []
+        return None
 
     # Get the structural path of the line number
-    structure_path = traverse(root_node)
+    structure_path = index.resolve(line_index, visit)
     return structure_path
 
-def get_parser(language): # Also used in optimization/utils.py
-    assert language in ["python"], "Currently only Python is supported"
-    system = platform.system().lower()
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    tree_sitter_dir = os.path.normpath(os.path.join(base_dir, "../libs/tree-sitter"))
-    if system == "darwin":
-        build_file_path = os.path.join(tree_sitter_dir, "macos_build/my-languages.so")
-    elif system == "linux":
-        build_file_path = os.path.join(tree_sitter_dir, "linux_build/my-languages.so")
-    elif system == "windows":
-        build_file_path = os.path.join(tree_sitter_dir, "windows_build/my-languages.dll")
-    try:
-        LANGUAGES = Language(build_file_path, language)
-    except:
-        # build so
-        Language.build_library(
-            build_file_path,
-            [
-                os.path.join(tree_sitter_dir, "tree-sitter-python"),
-                os.path.join(tree_sitter_dir, "tree-sitter-go"),
-                os.path.join(tree_sitter_dir, "tree-sitter-java"),
-                os.path.join(tree_sitter_dir, "tree-sitter-javascript"),
-                os.path.join(tree_sitter_dir, "tree-sitter-typescript")
-            ]
-        )
-        LANGUAGES = Language(build_file_path, language)
-    
-    parser = Parser()
-    parser.set_language(LANGUAGES)
-    return parser
-
-def parse(code, language):
-    parser = get_parser(language)
-    tree = parser.parse(bytes(code, "utf8"))
-    return tree
-
-def find_control_flow(code, line_index, language): # Also used in optimization/utils.py
+def find_control_flow(code, line_index, language, index=None): # Also used in optimization/utils.py
 
     def get_statement(node, source_bytes):
         start = node.start_byte
@@ -548,56 +571,47 @@ def find_control_flow(code, line_index, language): # Also used in optimization/u
             colon_index = end
         return source_bytes[start:colon_index + 1].decode("utf-8").strip()
     
-    def traverse(node, source_bytes, line_index, current_structure=[]):
-        CONTROL_FLOW_TYPES = {
-            "if_statement",
-            "while_statement",
-            "for_statement",
-            "try_statement",
-            "with_statement",
-            "match_statement",
-            "except_clause",  # optional: narrower scope
-            "else_clause",
-            "finally_clause"
-        }
-
-        # Check if the current node contains the line number
-        if node.start_point[0] <= line_index <= node.end_point[0]:
-            # complete here, extract the control flow structure
-            if node.type in CONTROL_FLOW_TYPES:
-                statement = get_statement(node, source_bytes)
-                current_structure.append({
-                    "type": node.type,
-                    "statement": statement,
-                    "start_line": node.start_point[0],
-                    "end_line": node.end_point[0]
-                })
-
-            for child in node.children:
-                result = traverse(child, source_bytes, line_index, current_structure)
-                if result:
-                    return result
-                
-            return current_structure
+    CONTROL_FLOW_TYPES = {
+        "if_statement",
+        "while_statement",
+        "for_statement",
+        "try_statement",
+        "with_statement",
+        "match_statement",
+        "except_clause",  # optional: narrower scope
+        "else_clause",
+        "finally_clause"
+    }
 
-        return []
+    # Return the control flow entry of a node containing the line number, None if it is not a control flow statement
+    def visit(node):
+        if node.type in CONTROL_FLOW_TYPES:
+            statement = get_statement(node, source_bytes)
+            return {
+                "type": node.type,
+                "statement": statement,
+                "start_line": node.start_point[0],
+                "end_line": node.end_point[0]
+            }
+        return None
 
     assert language == "python", "Currently only python is supported"
-    parser = get_parser(language)
-
-    # Parse the code
-    tree = parser.parse(bytes(code, "utf8"))
-    root_node = tree.root_node
+    # Parse the code, unless the line index of this file is given
+    if index is None:
+        index = SyntaxIndex(parse(code, language))
+    source_bytes = bytes(code, "utf8")
 
-    structure_path = traverse(root_node, bytes(code, "utf8"), line_index)
+    structure_path = index.resolve(line_index, visit)
     return structure_path
 
 def extract_hunks(commit_url: str, REPOS_PATH: str) -> tuple:
     """
-    Given commit url, extract edit hunks from the commit, with its file path and code logic path
+    Given commit url, extract edit hunks from the commit, with its file path and code logic path.
+    Only reads from the git object store, the working directory of the clone is left untouched.
     
     Args:
         commit_url: str, the url of the commit
+        REPOS_PATH: str, the directory of the local clones
         
     Returns:
         commit_message: str, the message of the commit
@@ -608,10 +622,9 @@ def extract_hunks(commit_url: str, REPOS_PATH: str) -> tuple:
     user_name = commit_url.split("/")[-4]
     repo_path = os.path.join(REPOS_PATH, project_name)
 
-    # if not exist, clone to local
+    # if not exist or the commit is missing, clone or fetch to local
     os.makedirs(REPOS_PATH, exist_ok=True)
-    if not os.path.exists(repo_path):
-        clone_repo(user_name, project_name, REPOS_PATH)
+    clone_repo(user_name, project_name, REPOS_PATH, commit_sha)
     
     command = f"git -C {repo_path} show {commit_sha} --pretty=%B --no-patch"
     try:
@@ -620,12 +633,6 @@ def extract_hunks(commit_url: str, REPOS_PATH: str) -> tuple:
         raise ValueError(f'1 {commit_url} Error: Error in retrieving commit message')
     commit_message = result.stdout.strip()
 
-    command = f"git -C {repo_path} checkout --force {commit_sha}^"
-    try:
-        result = subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    except:
-        raise ValueError(f'2 {commit_url} Error: Error in git checkout')
-    
     command = f'git -C {repo_path} diff -U10000000 {commit_sha}^ {commit_sha}'
     try:
         result = subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
@@ -705,6 +712,8 @@ def extract_hunks(commit_url: str, REPOS_PATH: str) -> tuple:
             else:
                 file_content += "".join(window["before"])
 
+        # Parse each file once, all hunks of the file share the same line index
+        index = None
         for widx, window in enumerate(snapshot):
             if type(window) is list:
                 continue
@@ -730,8 +739,10 @@ def extract_hunks(commit_url: str, REPOS_PATH: str) -> tuple:
                 window["suffix"] = next_window[:min(3, len(next_window))]
                     
             if language is not None:
-                structural_path = find_code_structure(file_content, line_index, language)
-                control_flow = find_control_flow(file_content, line_index, language)
+                if index is None:
+                    index = SyntaxIndex(parse(file_content, language))
+                structural_path = find_code_structure(file_content, line_index, language, index)
+                control_flow = find_control_flow(file_content, line_index, language, index)
             else:
                 structural_path = []
                 control_flow = []
@@ -759,11 +770,23 @@ def get_version(snapshot, version):
         
     return version_content
 
-def add_info_to_snapshots(snapshots):
+def add_info_to_snapshots(snapshots, fields=("structural_path", "control_flow")):
+    """
+    Add version ranges, prefix, suffix and file path to each edit window, plus the requested syntax fields.
+
+    Args:
+        snapshots: dict, the snapshots to enrich in place
+        fields: tuple[str], the syntax fields to compute, among "structural_path" and "control_flow".
+            Files are only parsed when some field is requested.
+    Returns:
+        snapshots: dict, the enriched snapshots
+    """
     for rel_file_path, snapshot in snapshots.items():
         pre_edit_line_idx = 0
         post_edit_line_idx = 0
-        parent_version_content = "".join(get_version(snapshot, "parent"))
+        # Parse each file once, all hunks of the file share the same line index
+        parent_version_content = None
+        index = None
         for widx, window in enumerate(snapshot):
             if isinstance(window, list):
                 pre_edit_line_idx += len(window)
@@ -803,20 +826,30 @@ def add_info_to_snapshots(snapshots):
             else:
                 window["suffix"] = next_window[:min(3, len(next_window))]
 
-            structural_path = find_code_structure(parent_version_content, line_index, language)
-            control_flow = find_control_flow(parent_version_content, line_index, language)
-
-            window["control_flow"] = control_flow
-            window["structural_path"] = structural_path
+            if fields and index is None:
+                parent_version_content = "".join(get_version(snapshot, "parent"))
+                index = SyntaxIndex(parse(parent_version_content, language))
+            if "control_flow" in fields:
+                window["control_flow"] = find_control_flow(parent_version_content, line_index, language, index)
+            if "structural_path" in fields:
+                window["structural_path"] = find_code_structure(parent_version_content, line_index, language, index)
             window["file_path"] = rel_file_path
 
     return snapshots
 
-def snapshot_2_locations(snapshots):
+def snapshot_2_locations(snapshots, fields=()):
     """
     Convert snapshots to edit locations.
+
+    Args:
+        snapshots: dict, the snapshots to convert
+        fields: tuple[str], the syntax fields to attach to insert locations, e.g. ("structural_path",).
+            They cost a parse of each file, hence are only computed when requested.
+    Returns:
+        replace_edit_locations: list[dict], the locations of replace edits
+        insert_edit_locations: list[dict], the locations of insert edits
     """
-    enriched_snapshots = add_info_to_snapshots(snapshots)
+    enriched_snapshots = add_info_to_snapshots(snapshots, fields)
     replace_edit_locations = []
     insert_edit_locations = []
 
@@ -850,10 +883,11 @@ def snapshot_2_locations(snapshots):
                         "atLines": [line_idx],
                         "editType": "insert",
                         "after": window["after"],
-                        "structural_path": window["structural_path"],
                         "confidence": window.get("confidence", None),
                         "suggestionRank": None
                     }
+                    for field in fields:
+                        loc[field] = window[field]
                     if "idx" in window:
                         loc["idx"] = window["idx"]
                     if "allowed_as_next" in window:
@@ -875,6 +909,42 @@ def overlap_percentage(list_a, list_b):
     avg_len = (len(list_a) + len(list_b)) / 2
     return len(overlap) / avg_len if avg_len > 0 else 0.0
 
+def index_locations_by_line(locations):
+    """
+    Index locations by file, then by the first line of their atLines, for overlapping_locations().
+    Locations without lines can not overlap with anything and are left out.
+
+    Returns:
+        location_index: dict, key is file path, value is (first lines, running max of last lines, entries),
+            entries are (first line, last line, order, location) sorted by first line
+    """
+    location_index = defaultdict(list)
+    for order, loc in enumerate(locations):
+        if loc["atLines"]:
+            location_index[loc["file_path"]].append((min(loc["atLines"]), max(loc["atLines"]), order, loc))
+    for file_path, entries in location_index.items():
+        entries.sort(key=lambda entry: entry[0])
+        max_last_lines = []
+        for entry in entries:
+            max_last_lines.append(max(entry[1], max_last_lines[-1]) if max_last_lines else entry[1])
+        location_index[file_path] = ([entry[0] for entry in entries], max_last_lines, entries)
+    return location_index
+
+def overlapping_locations(location_index, file_path, at_lines):
+    """
+    Return the indexed locations of file_path whose lines may overlap with at_lines, in their original order.
+    """
+    if not at_lines or file_path not in location_index:
+        return []
+    first_line, last_line = min(at_lines), max(at_lines)
+    first_lines, max_last_lines, entries = location_index[file_path]
+    # Entries before lo end before at_lines starts, entries from hi start after at_lines ends
+    lo = bisect.bisect_left(max_last_lines, first_line)
+    hi = bisect.bisect_right(first_lines, last_line)
+    candidates = [entry for entry in entries[lo:hi] if entry[1] >= first_line]
+    candidates.sort(key=lambda entry: entry[2])
+    return [entry[3] for entry in candidates]
+
 def indexing_edits_within_snapshots(snapshots): # Also used in optimization/utils.py
     """
     Indexing edits within snapshots.
@@ -899,9 +969,17 @@ def get_bleu(pred, gdth):
     if isinstance(gdth, list):
         gdth = "".join(gdth)
 
-    (goldMap, predictionMap) = direct_computeMaps(pred, gdth)
-    bleu_score = bleuFromMaps(goldMap, predictionMap)
-    return bleu_score[0]
+    return sentence_bleu(pred, gdth)
+
+def get_bleu_above_batch(preds, gdth, threshold):
+    """
+    Whether get_bleu(pred, gdth) > threshold for each prediction, the ground truth is tokenized once
+    and the n-gram counting is skipped when the lengths alone rule a prediction out.
+    """
+    preds = ["".join(pred) if isinstance(pred, list) else pred for pred in preds]
+    if isinstance(gdth, list):
+        gdth = "".join(gdth)
+    return batch_bleu_above(preds, gdth, threshold)
 
 def deduplicate_edits(edit_list):
     seen = set()
@@ -1,7 +1,8 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 import sys
 import os
+import gzip
 import configparser
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -10,43 +11,81 @@ sys.path.insert(0, src_path)
 
 # import main
 from simulation.main import main
+from simulation.jobs import JobManager, parse_last_event_id, stream_events
 
 app = Flask(__name__)
 CORS(app) 
+JOBS = JobManager(main)
+GZIP_MIN_SIZE = 1024 # responses smaller than this are not worth compressing
+# Each open event stream holds a server thread, streams are closed after this many seconds and the client reconnects with Last-Event-ID
+SSE_STREAM_TIMEOUT = float(os.getenv("SSE_STREAM_TIMEOUT") or 300)
+SERVER_THREADS = int(os.getenv("SERVER_THREADS") or 16) # threads serving requests, including open event streams
+
+@app.after_request
+def compress_response(response):
+    """
+    Gzip JSON responses when the client accepts it. Streamed responses (SSE) are left untouched.
+    """
+    if (
+        'gzip' not in request.headers.get('Accept-Encoding', '').lower()
+        or response.direct_passthrough
+        or response.is_streamed
+        or response.mimetype != 'application/json'
+        or 'Content-Encoding' in response.headers
+    ):
+        return response
+    data = response.get_data()
+    if len(data) < GZIP_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=5))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Content-Length'] = str(len(response.get_data()))
+    response.vary.add('Accept-Encoding')
+    return response
+
+def parse_simulate_request(request_data):
+    """
+    Validate the request data and construct the input for main function.
+
+    Returns:
+        input_data: dict | None, the input for main function, None if the request is invalid
+        error: str | None, the reason why the request is invalid
+    """
+    if not request_data:
+        return None, 'Request data is empty'
+
+    # Parse request data
+    commit_url = request_data.get('commit_url')
+    system_under_test = request_data.get('system_under_test')
+    status = request_data.get('status')
+    suggestion_type = request_data.get('suggestion_type')
+
+    # Validate required parameters
+    if not commit_url or not system_under_test or not status or not suggestion_type:
+        return None, 'Missing required parameters: commit_url, system_under_test, status, suggestion_type'
+
+    # Construct input for main function
+    input_data = {
+        "commit_url": commit_url,
+        "system_under_test": system_under_test,
+        "status": status,
+        "suggestion_type": suggestion_type,
+        "session_id": request_data.get('session_id'),
+        "delta": bool(request_data.get('delta'))
+    }
+    return input_data, None
 
 @app.route('/api/simulate', methods=['POST'])
 def simulate():
     try:
         # get request_data
-        request_data = request.get_json()
-        
-        if not request_data:
+        input_data, error = parse_simulate_request(request.get_json())
+        if error:
             return jsonify({
                 'success': False,
-                'error': 'Request data is empty'
+                'error': error
             }), 400
         
-        # Parse request data
-        commit_url = request_data.get('commit_url')
-        system_under_test = request_data.get('system_under_test')
-        status = request_data.get('status')
-        suggestion_type = request_data.get('suggestion_type')
-        
-        # Validate required parameters
-        if not commit_url or not system_under_test or not status or not suggestion_type:
-            return jsonify({
-                'success': False,
-                'error': 'Missing required parameters: commit_url, system_under_test, status, suggestion_type'
-            }), 400
-        
-        # Construct input for main function
-        input_data = {
-            "commit_url": commit_url,
-            "system_under_test": system_under_test,
-            "status": status,
-            "suggestion_type": suggestion_type
-        }
-        
         # Invoke main function
         response_message = main(input_data)
         # return
@@ -62,6 +101,59 @@ def simulate():
             'error': f'Internal server error: {str(e)}'
         }), 500
 
+@app.route('/api/simulate/jobs', methods=['POST'])
+def submit_simulation_job():
+    """
+    Submit a simulation step to the worker pool, return the job id immediately.
+    """
+    input_data, error = parse_simulate_request(request.get_json())
+    if error:
+        return jsonify({
+            'success': False,
+            'error': error
+        }), 400
+
+    job_id = JOBS.submit(input_data)
+    return jsonify({
+        'success': True,
+        'data': {'job_id': job_id}
+    }), 202
+
+@app.route('/api/simulate/jobs/<job_id>', methods=['GET'])
+def poll_simulation_job(job_id):
+    """
+    Return the status, the stage events and (if finished) the result of a simulation job.
+    """
+    try:
+        job = JOBS.get(job_id)
+    except KeyError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 404
+    return jsonify({
+        'success': True,
+        'data': job.snapshot()
+    })
+
+@app.route('/api/simulate/jobs/<job_id>/events', methods=['GET'])
+def stream_simulation_job(job_id):
+    """
+    Stream the stage events of a simulation job as Server-Sent Events.
+    The last event is either `done`, carrying the simulation result, or `failed`.
+    The stream is closed after SSE_STREAM_TIMEOUT seconds to free its server thread, EventSource clients
+    reconnect with the Last-Event-ID header and resume after the last received event.
+    """
+    try:
+        job = JOBS.get(job_id)
+    except KeyError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 404
+    start = parse_last_event_id(request.headers.get('Last-Event-ID'))
+    return Response(stream_with_context(stream_events(job, start, SSE_STREAM_TIMEOUT)), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({
@@ -83,7 +175,7 @@ if __name__ == '__main__':
 
     try:
         from waitress import serve
-        serve(app, host=host, port=port)
+        serve(app, host=host, port=port, threads=SERVER_THREADS)
         print("Server closed.")
     except Exception as e:
         print(f"Failed to start server: {e}") 
\ No newline at end of file
@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# The simulation modules are imported from src as top-level packages, as the servers do
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../src")))
+# Set before .config is loaded on import, so that the tests never write to the real output directory
+os.environ["OUTPUT_DIR"] = tempfile.mkdtemp(prefix="editflow-test-")
@@ -0,0 +1,65 @@
+import threading
+import concurrent.futures
+
+import pytest
+
+from simulation import batch
+
+def make_url(project, sha):
+    return f"https://github.com/user/{project}/commit/{sha}"
+
+@pytest.fixture
+def pipeline(monkeypatch, tmp_path):
+    calls = {"clone": [], "prepare": [], "simulate": []}
+    lock = threading.Lock()
+    failing = {"clone": set(), "prepare": set()}
+
+    def clone_repo(user_name, project_name, repos_dir):
+        with lock:
+            calls["clone"].append(project_name)
+        if project_name in failing["clone"]:
+            raise RuntimeError("clone failed")
+
+    def prepare_commit(url, sut):
+        with lock:
+            calls["prepare"].append(url)
+        error = "broken commit" if url in failing["prepare"] else None
+        return {"url": url, "success": error is None, "error": error, "seconds": 0.0}
+
+    def simulate_commit(url, sut, flow_keeper=True):
+        with lock:
+            # Only preprocessed commits are simulated
+            assert url in calls["prepare"]
+            calls["simulate"].append(url)
+        return {"url": url, "success": True, "error": None, "seconds": 0.0}
+
+    monkeypatch.setattr(batch, "clone_repo", clone_repo)
+    monkeypatch.setattr(batch, "prepare_commit", prepare_commit)
+    monkeypatch.setattr(batch, "simulate_commit", simulate_commit)
+    # The stages are patched in this process, so run every pool on threads
+    monkeypatch.setattr(batch.concurrent.futures, "ProcessPoolExecutor", concurrent.futures.ThreadPoolExecutor)
+    monkeypatch.setattr(batch, "REPOS_DIR", str(tmp_path / "repos"))
+    monkeypatch.setattr(batch, "OUTPUT_DIR", str(tmp_path))
+    return calls, failing
+
+def test_every_commit_is_simulated_once(pipeline):
+    calls, _ = pipeline
+    urls = [make_url(project, sha) for project in ["a", "b", "c"] for sha in range(4)]
+    results = batch.run_batch(urls, "sut", workers=2, prepare_workers=2, clone_workers=2, prefetch=3)
+    assert sorted(r["url"] for r in results) == sorted(urls)
+    assert all(r["success"] for r in results)
+    assert sorted(calls["simulate"]) == sorted(urls)
+    # Every repository is cloned once, however many of its commits are simulated
+    assert sorted(calls["clone"]) == ["a", "b", "c"]
+
+def test_failures_are_reported_without_simulation(pipeline):
+    calls, failing = pipeline
+    urls = [make_url("a", 0), make_url("a", 1), make_url("b", 0), make_url("b", 1)]
+    failing["clone"].add("a")
+    failing["prepare"].add(make_url("b", 0))
+    results = {r["url"]: r for r in batch.run_batch(urls, "sut", workers=1, prepare_workers=1, clone_workers=1, prefetch=1)}
+    assert len(results) == len(urls)
+    assert results[make_url("a", 0)]["error"] == results[make_url("a", 1)]["error"] == "RuntimeError: clone failed"
+    assert results[make_url("b", 0)]["error"] == "Preprocessing failed: broken commit"
+    assert results[make_url("b", 1)]["success"]
+    assert calls["simulate"] == [make_url("b", 1)]
@@ -0,0 +1,90 @@
+import copy
+import json
+
+from simulation.delta import encode_delta_response
+
+def make_snapshots():
+    return {
+        "a.py": [["import os\n"], {"idx": 0, "before": ["x = 1\n"], "after": ["x = 2\n"], "simulated": False, "allowed_as_next": True}],
+        "b.py": [
+            {"idx": 1, "before": [], "after": ["y = x\n"], "simulated": False, "allowed_as_next": False},
+            ["pass\n"],
+            {"idx": 2, "before": ["z = 0\n"], "after": [], "simulated": False, "allowed_as_next": False}
+        ]
+    }
+
+def make_response(snapshots, status):
+    edits = [window for snapshot in snapshots.values() for window in snapshot if isinstance(window, dict)]
+    return {
+        "status": status,
+        "pred_snapshots": {},
+        "gdth_snapshots": snapshots,
+        "curr_gdth_snapshots": {
+            file_path: [copy.copy(window) for window in snapshot if isinstance(window, dict) and not window["simulated"]]
+            for file_path, snapshot in snapshots.items()
+        },
+        "partial_order_graph": {"nodes": edits, "edges": [{"src": 0, "tgt": 1}, {"src": 1, "tgt": 2}]}
+    }
+
+def edit_status(snapshots):
+    return {
+        window["idx"]: (window["simulated"], window["allowed_as_next"])
+        for snapshot in snapshots.values() for window in snapshot if isinstance(window, dict)
+    }
+
+class Client:
+    """
+    Decodes delta encoded responses as described by encode_delta_response().
+    """
+    def __init__(self):
+        self.gdth_snapshots = None
+        self.partial_order_graph = None
+
+    def receive(self, encoded_response):
+        encoded_response = json.loads(json.dumps(encoded_response)) # as sent over HTTP
+        if "gdth_snapshots" in encoded_response:
+            self.gdth_snapshots = encoded_response["gdth_snapshots"]
+            self.partial_order_graph = encoded_response["partial_order_graph"]
+        previous_status = edit_status(self.gdth_snapshots)
+        windows = [window for snapshot in self.gdth_snapshots.values() for window in snapshot if isinstance(window, dict)]
+        for window in windows + self.partial_order_graph["nodes"]:
+            window.update(encoded_response["edit_status_delta"].get(str(window["idx"]), {}))
+        curr_gdth_edit_idxs = encoded_response.get("curr_gdth_edit_idxs", [])
+        return previous_status, curr_gdth_edit_idxs
+
+def test_delta_round_trip():
+    snapshots = make_snapshots()
+    client = Client()
+    delta_state = None
+    steps = [
+        ("init", lambda: snapshots["a.py"][1].update(simulated=True)),
+        ("suggestion", lambda: snapshots["b.py"][0].update(simulated=True, allowed_as_next=True)),
+        ("suggestion", lambda: snapshots["b.py"][2].update(allowed_as_next=True)),
+        ("done", lambda: snapshots["b.py"][2].update(simulated=True)),
+    ]
+    for status, apply_step in steps:
+        response = make_response(snapshots, status)
+        expected_curr_idxs = [window["idx"] for snapshot in response["curr_gdth_snapshots"].values() for window in snapshot]
+        expected_curr_status = edit_status(response["curr_gdth_snapshots"])
+        apply_step()
+        encoded_response, delta_state = encode_delta_response(response, delta_state)
+        previous_status, curr_gdth_edit_idxs = client.receive(encoded_response)
+
+        assert encoded_response["delta"] and encoded_response["status"] == status
+        assert edit_status(client.gdth_snapshots) == edit_status(snapshots)
+        assert edit_status({"nodes": client.partial_order_graph["nodes"]}) == edit_status(snapshots)
+        assert client.partial_order_graph["edges"] == response["partial_order_graph"]["edges"]
+        # The current ground truth edits carry the status of the previous response
+        assert curr_gdth_edit_idxs == expected_curr_idxs
+        if status != "init":
+            assert {idx: previous_status[idx] for idx in curr_gdth_edit_idxs} == expected_curr_status
+
+def test_only_first_response_carries_snapshots():
+    snapshots = make_snapshots()
+    first, delta_state = encode_delta_response(make_response(snapshots, "init"), None)
+    snapshots["a.py"][1]["simulated"] = True
+    second, _ = encode_delta_response(make_response(snapshots, "suggestion"), delta_state)
+    assert "gdth_snapshots" in first and "partial_order_graph" in first
+    assert "gdth_snapshots" not in second and "partial_order_graph" not in second
+    assert first["edit_status_delta"] == {}
+    assert second["edit_status_delta"] == {"0": {"simulated": True, "allowed_as_next": True}}
@@ -0,0 +1,78 @@
+import json
+import threading
+
+from simulation.jobs import Job, JobManager, parse_last_event_id, stream_events
+
+def parse_stream(chunks):
+    events = []
+    for chunk in chunks:
+        if chunk.startswith(":"):
+            continue
+        fields = dict(line.split(": ", 1) for line in chunk.strip().split("\n"))
+        events.append({"id": int(fields["id"]), "event": fields["event"], "data": json.loads(fields["data"])})
+    return events
+
+def test_parse_last_event_id():
+    assert parse_last_event_id(None) == 0
+    assert parse_last_event_id("3") == 4
+    assert parse_last_event_id("-7") == 0
+    assert parse_last_event_id("not-a-number") == 0
+
+def test_finish_appends_terminal_event_with_status():
+    job = Job("job", {})
+    job.emit("queued")
+    job.finish("done", result={"status": "init"})
+    events, finished = job.wait_events(1, timeout=0)
+    assert finished
+    assert [event["stage"] for event in events] == ["done"]
+    assert job.snapshot()["result"] == {"status": "init"}
+
+def test_stream_ends_with_result():
+    job = Job("job", {})
+    job.emit("queued")
+    job.emit("started")
+    job.finish("done", result={"status": "init"})
+    events = parse_stream(stream_events(job, 0, stream_timeout=5))
+    assert [event["event"] for event in events] == ["queued", "started", "done"]
+    assert events[-1]["data"]["result"] == {"status": "init"}
+
+def test_stream_resumes_after_last_event_id():
+    job = Job("job", {})
+    job.emit("queued")
+    job.emit("started")
+    job.finish("failed", error="boom")
+    events = parse_stream(stream_events(job, parse_last_event_id("0"), stream_timeout=5))
+    assert [event["id"] for event in events] == [1, 2]
+    assert events[-1]["data"]["data"] == {"error": "boom"}
+    # A client reconnecting after the terminal event gets an empty stream instead of waiting
+    assert parse_stream(stream_events(job, parse_last_event_id("2"), stream_timeout=5)) == []
+
+def test_stream_closes_after_timeout():
+    job = Job("job", {})
+    job.emit("queued")
+    chunks = list(stream_events(job, 1, stream_timeout=0.2, keep_alive_interval=0.05))
+    assert chunks and all(chunk == ": keep-alive\n\n" for chunk in chunks)
+
+def test_stream_waits_for_running_job():
+    release = threading.Event()
+    def runner(json_input, progress_callback):
+        progress_callback("commit_prepared", {"edit_num": 2})
+        release.wait(5)
+        return {"status": "done"}
+
+    jobs = JobManager(runner, max_workers=1)
+    job = jobs.get(jobs.submit({}))
+    threading.Timer(0.2, release.set).start()
+    events = parse_stream(stream_events(job, 0, stream_timeout=5))
+    assert [event["event"] for event in events] == ["queued", "started", "commit_prepared", "done"]
+    assert events[-1]["data"]["result"] == {"status": "done"}
+
+def test_failed_job_reports_error():
+    def runner(json_input, progress_callback):
+        raise RuntimeError("boom")
+
+    jobs = JobManager(runner, max_workers=1)
+    job = jobs.get(jobs.submit({}))
+    events = parse_stream(stream_events(job, 0, stream_timeout=5))
+    assert events[-1]["event"] == "failed"
+    assert job.snapshot()["error"] == "boom"
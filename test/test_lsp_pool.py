@@ -0,0 +1,104 @@
+import pytest
+
+from simulation import lsp_pool
+from simulation.lsp_pool import LanguageServerPool
+
+class FakeProcess:
+    def __init__(self):
+        self.killed = False
+
+    def kill(self):
+        self.killed = True
+
+    def wait(self):
+        return 0
+
+class FakeServer:
+    def __init__(self):
+        self.process = FakeProcess()
+        self.workspace_folders = []
+        self.alive = True
+        self.responsive = True
+        self.closed = False
+
+    def initialize(self, workspace_dir):
+        self.workspace_folders = [workspace_dir]
+
+    def change_workspace_folders(self, added, removed):
+        self.workspace_folders = [folder for folder in self.workspace_folders if folder not in removed] + added
+
+    def is_alive(self):
+        return self.alive and not self.process.killed
+
+    def is_responsive(self, timeout):
+        return self.responsive
+
+    def close_all_files(self):
+        pass
+
+    def drain_notifications(self):
+        return []
+
+    def close(self):
+        self.closed = True
+
+@pytest.fixture
+def started(monkeypatch):
+    servers = []
+    def start_language_server(language):
+        servers.append(FakeServer())
+        return servers[-1]
+    monkeypatch.setattr(lsp_pool, "start_language_server", start_language_server)
+    return servers
+
+def test_released_server_is_reused(started):
+    pool = LanguageServerPool(size=2, max_uses=10)
+    server = pool.acquire("python", "/repo/base")
+    pool.release(server)
+    assert pool.acquire("python", "/repo/base") is server
+    assert len(started) == 1
+
+def test_reused_server_switches_workspace_of_same_project(started):
+    pool = LanguageServerPool(size=2, max_uses=10)
+    server = pool.acquire("python", "/worktrees/a", project_dir="/repo")
+    pool.release(server)
+    assert pool.acquire("python", "/worktrees/b", project_dir="/repo") is server
+    assert server.workspace_folders == ["/worktrees/b"]
+    # Servers of other projects or languages are not shared
+    assert pool.acquire("python", "/worktrees/c", project_dir="/other") is not server
+    assert pool.acquire("go", "/worktrees/b", project_dir="/repo") is not server
+
+def test_hung_server_is_replaced(started):
+    pool = LanguageServerPool(size=2, max_uses=10)
+    server = pool.acquire("python", "/repo")
+    pool.release(server)
+    server.responsive = False
+    replacement = pool.acquire("python", "/repo")
+    assert replacement is not server
+    assert server.process.killed and not server.closed
+    assert server not in pool.servers
+
+def test_server_is_restarted_after_max_uses(started):
+    pool = LanguageServerPool(size=2, max_uses=2)
+    server = pool.acquire("python", "/repo")
+    pool.release(server)
+    assert pool.acquire("python", "/repo") is server
+    pool.release(server)
+    assert server.closed
+    assert pool.acquire("python", "/repo") is not server
+
+def test_unhealthy_server_is_closed_on_release(started):
+    pool = LanguageServerPool(size=2, max_uses=10)
+    server = pool.acquire("python", "/repo")
+    pool.release(server, healthy=False)
+    assert server.closed and not pool.idle
+
+def test_least_recently_released_servers_are_closed_first(started):
+    pool = LanguageServerPool(size=1, max_uses=10)
+    first = pool.acquire("python", "/repo/a")
+    second = pool.acquire("python", "/repo/b")
+    pool.release(first)
+    pool.release(second)
+    assert first.closed and not second.closed
+    pool.close()
+    assert second.closed and not pool.servers
@@ -0,0 +1,60 @@
+import random
+
+from simulation.piece_table import PieceTable
+
+def make_file_snapshot(rng, window_num):
+    snapshot = []
+    for widx in range(window_num):
+        if widx % 2 == 0:
+            snapshot.append([f"context {widx} {i}\n" for i in range(rng.randint(0, 4))])
+        else:
+            snapshot.append({
+                "idx": widx,
+                "before": [f"before {widx} {i}\n" for i in range(rng.randint(0, 3))],
+                "after": [f"after {widx} {i}\n" for i in range(rng.randint(0, 3))],
+                "simulated": rng.random() < 0.3,
+                "allowed_as_next": False
+            })
+    return snapshot
+
+def naive_pieces(snapshot):
+    return [
+        window if isinstance(window, list) else (window["after"] if window["simulated"] else window["before"])
+        for window in snapshot
+    ]
+
+def test_matches_naive_list_edits():
+    rng = random.Random(0)
+    for _ in range(50):
+        snapshot = make_file_snapshot(rng, rng.randint(1, 20))
+        table = PieceTable(snapshot)
+        edit_widxs = [widx for widx, window in enumerate(snapshot) if isinstance(window, dict)]
+        rng.shuffle(edit_widxs)
+        for widx in [None] + edit_widxs:
+            if widx is not None:
+                snapshot[widx]["simulated"] = True
+                table.apply(widx, snapshot[widx]["after"])
+            pieces = naive_pieces(snapshot)
+            assert table.lines() == [line for piece in pieces for line in piece]
+            for piece_idx in range(len(pieces)):
+                assert table.offset(piece_idx) == sum(len(piece) for piece in pieces[:piece_idx])
+
+def test_split_view_merges_unsplit_pieces():
+    snapshot = [
+        ["a\n"],
+        {"idx": 0, "before": ["b\n"], "after": ["B\n"], "simulated": True, "allowed_as_next": False},
+        ["c\n"],
+        {"idx": 1, "before": ["d\n"], "after": ["D\n"], "simulated": False, "allowed_as_next": True},
+        ["e\n"]
+    ]
+    table = PieceTable(snapshot)
+    view = table.split_view(lambda window: not window["simulated"])
+    assert view[0] == ["a\n", "B\n", "c\n"]
+    assert view[1] == snapshot[3] and view[1] is not snapshot[3]
+    assert view[2] == ["e\n"]
+    # The view is frozen, later edits of the commit do not change it
+    snapshot[3]["simulated"] = True
+    table.apply(3, snapshot[3]["after"])
+    assert view[1]["simulated"] is False
+    assert view[0] == ["a\n", "B\n", "c\n"]
+    assert table.lines() == ["a\n", "B\n", "c\n", "D\n", "e\n"]
@@ -0,0 +1,54 @@
+import json
+import pytest
+
+from simulation.replay import ReplayStore
+
+def write_record(store, name, step_num):
+    commit_url = f"https://github.com/user/{name}/commit/{'0' * 40}"
+    edits = [{"idx": idx, "before": [], "after": [f"line {idx}\n"], "simulated": True, "allowed_as_next": False} for idx in range(step_num)]
+    record = {
+        "commit_snapshots": {"a.py": edits},
+        "partial_orders": [],
+        "SUT_prediction_records": [{"status": "init" if step == 0 else "suggestion", "step": step} for step in range(step_num)]
+    }
+    with open(store.get_record_fp(commit_url, "SUT"), "w") as f:
+        json.dump(record, f)
+    return commit_url
+
+def test_cursor_replays_recorded_steps():
+    store = ReplayStore(cache_size=2)
+    commit_url = write_record(store, "steps", 3)
+    assert store.has(commit_url, "SUT")
+    cursor = store.open_cursor(commit_url, "SUT")
+    assert [cursor.next_step()["step"] for _ in range(3)] == [0, 1, 2]
+    with pytest.raises(ValueError):
+        cursor.next_step()
+    cursor.close()
+
+def test_cached_record_is_shared_and_stays_open():
+    store = ReplayStore(cache_size=2)
+    commit_url = write_record(store, "shared", 2)
+    first = store.open_cursor(commit_url, "SUT")
+    second = store.open_cursor(commit_url, "SUT")
+    assert first.record is second.record and first.record.cursors == 2
+    first.close()
+    first.close() # closing twice releases the record once
+    second.close()
+    assert first.record.cursors == 0 and not first.record.mm.closed
+
+def test_evicted_record_is_closed_by_its_last_cursor():
+    store = ReplayStore(cache_size=1)
+    cursor = store.open_cursor(write_record(store, "first", 2), "SUT")
+    store.open_cursor(write_record(store, "second", 2), "SUT").close()
+    record = cursor.record
+    assert record.evicted and not record.mm.closed
+    assert cursor.next_step()["step"] == 0 # still readable by the open cursor
+    cursor.close()
+    assert record.mm.closed
+
+def test_unused_record_is_closed_on_eviction():
+    store = ReplayStore(cache_size=1)
+    cursor = store.open_cursor(write_record(store, "first", 2), "SUT")
+    cursor.close()
+    store.open_cursor(write_record(store, "second", 2), "SUT").close()
+    assert cursor.record.evicted and cursor.record.mm.closed
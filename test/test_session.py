@@ -0,0 +1,62 @@
+import time
+import pytest
+
+from simulation.session import SessionRegistry
+
+class FakeCommit:
+    def __init__(self, name):
+        self.commit_url = f"https://github.com/user/project/commit/{name}"
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+def make_registry(**kwargs):
+    return SessionRegistry(on_evict=lambda session: session.commit.close(), **kwargs)
+
+def test_get_returns_created_session():
+    sessions = make_registry()
+    commit = FakeCommit("a")
+    session_id = sessions.create(commit)
+    assert sessions.get(session_id).commit is commit
+    with pytest.raises(ValueError):
+        sessions.get("missing")
+
+def test_idle_sessions_expire_after_ttl():
+    sessions = make_registry(ttl=0.1)
+    commit = FakeCommit("a")
+    session_id = sessions.create(commit)
+    time.sleep(0.2)
+    with pytest.raises(ValueError):
+        sessions.get(session_id)
+    assert commit.closed
+    assert len(sessions) == 0
+
+def test_access_keeps_session_alive():
+    sessions = make_registry(ttl=0.3)
+    session_id = sessions.create(FakeCommit("a"))
+    for _ in range(3):
+        time.sleep(0.15)
+        sessions.get(session_id)
+    assert len(sessions) == 1
+
+def test_least_recently_used_session_is_evicted():
+    sessions = make_registry(max_sessions=2)
+    commits = [FakeCommit(name) for name in "abc"]
+    first_id = sessions.create(commits[0])
+    second_id = sessions.create(commits[1])
+    sessions.get(first_id) # the second session is now the least recently used
+    sessions.create(commits[2])
+    assert len(sessions) == 2
+    assert commits[1].closed and not commits[0].closed
+    with pytest.raises(ValueError):
+        sessions.get(second_id)
+
+def test_remove_releases_session():
+    sessions = make_registry()
+    commit = FakeCommit("a")
+    session_id = sessions.create(commit)
+    sessions.remove(session_id)
+    sessions.remove(session_id)
+    assert commit.closed
+    assert len(sessions) == 0